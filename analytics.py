@@ -0,0 +1,93 @@
+"""
+Read-only analytics copy of gbdb.sqlite, which recap (and anything else doing heavy reads) queries instead
+of the live database
+
+> "Why not just read gbdb.sqlite?"
+Recap queries can take a while, and the whole time they hold a read transaction on the database the archiver
+is writing to. With WAL that doesn't block the writes, but it does stop checkpoints from finishing, so the
+WAL grows and every write (and read) gets slower until the query is done. Counting against a copy means recap
+never touches the live database at all.
+
+The copy is made with `VACUUM INTO`, which reads the source in a single transaction, so it's a consistent
+snapshot as of when it started. It's only a read, so it doesn't need the bot's write lock, and the daily
+rollups (see rollups.py) are already caught up in it: the archiver catches them up in the same transaction as
+every batch it writes (cogs/_archiver/writer.py). It's written next to the old copy and swapped in with a
+rename, so readers see either the old snapshot or the new one, never half of one.
+
+> "Why not sqlite's backup API, like cogs/backup.py?"
+The backup API starts over whenever the source is written to mid-copy, which for the archive is all the time.
+That's fine for a nightly backup at 3am, less so for a snapshot every hour.
+
+When the snapshot was taken is saved in it (`analytics_snapshot`), see `snapshot_taken_at` and `snapshot_age`.
+
+Usage
+    python analytics.py [gbdb.sqlite] [gbdb.analytics.sqlite]
+"""
+
+import argparse
+import datetime as dt
+import os
+import sqlite3
+import stat
+import time
+from contextlib import closing
+
+import archive
+
+SNAPSHOT_TABLE = "analytics_snapshot"
+
+
+def take_snapshot(source: str, destination: str) -> int:
+    """
+    Copies `source` to `destination` (replacing the previous copy) with VACUUM INTO. Blocking, returns when
+    the snapshot was taken (epoch ms)
+    """
+    partial = destination + ".tmp"
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    with closing(archive.connect(source, read_only=True)) as conn:
+        taken_at = archive.now_ms()
+        conn.execute("VACUUM INTO ?", (partial,))
+
+    with closing(sqlite3.connect(partial)) as conn, conn:
+        conn.execute(f"CREATE TABLE {SNAPSHOT_TABLE} (source TEXT NOT NULL, takenAt INTEGER NOT NULL)")
+        conn.execute(f"INSERT INTO {SNAPSHOT_TABLE} (source, takenAt) VALUES (?, ?)", (source, taken_at))
+
+    # Nothing should be writing to the copy, recap_cache and friends belong in the live database
+    os.chmod(partial, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.replace(partial, destination)
+    return taken_at
+
+
+def snapshot_taken_at(path: str) -> int | None:
+    """When the snapshot at `path` was taken (epoch ms). None if there isn't one, or it's the live database"""
+    if not os.path.exists(path):
+        return None
+    with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+        try:
+            row = conn.execute(f"SELECT takenAt FROM {SNAPSHOT_TABLE}").fetchone()
+        except sqlite3.OperationalError:
+            return None
+    return row[0] if row else None
+
+
+def snapshot_age(path: str) -> dt.timedelta | None:
+    """How old the snapshot at `path` is. None if it isn't a snapshot"""
+    taken_at = snapshot_taken_at(path)
+    if taken_at is None:
+        return None
+    return dt.timedelta(milliseconds=archive.now_ms() - taken_at)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Take a read-only analytics snapshot of the archive")
+    parser.add_argument("source", nargs="?", default="gbdb.sqlite")
+    parser.add_argument("destination", nargs="?", default="gbdb.analytics.sqlite")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    take_snapshot(args.source, args.destination)
+    size = os.path.getsize(args.destination)
+    elapsed = time.perf_counter() - start
+    print(f"Snapshot of {args.source} at {args.destination} ({size:,} bytes) in {elapsed:.1f}s")
@@ -0,0 +1,387 @@
+"""
+Schema for the archiver tables (message, reaction, command), shared by the archiver cog, recap, and the migrator.
+
+Schema v2
+- Integer rowid primary keys, instead of uuid4 strings. Rows are appended to the end of the table's B-tree
+  instead of landing at random spots in it.
+- No timestamp strings. Discord snowflakes (ids) already encode when they were created, so each table's
+  snowflake column doubles as its (indexed) time axis. See TIME_COLUMN.
+    - message: messageID
+    - command: interactionID
+    - reaction: snowflake, made from the time the reaction was added (the messageID is the reacted-to message)
+- Reaction strings and command names are stored once in a lookup table (reaction_name, command_name),
+  and referenced by id.
+
+Messages are partitioned by year (message_2025, message_2026, etc.), with a `message` view unioning them
+together. See the partitions section below.
+
+The v1 tables (uuid keys, text timestamps) are renamed to *_v1 the first time the bot starts on an old
+database, and copied over by migrate_archive.py.
+"""
+
+import datetime as dt
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from contextlib import closing
+from typing import Any, NamedTuple, Sequence
+
+ARCHIVE_TABLES = ("message", "reaction", "command")
+
+# The snowflake column each table's time filters (year, day, hour, etc.) range scan over
+TIME_COLUMN = {
+    "message": "messageID",
+    "reaction": "snowflake",
+    "command": "interactionID",
+}
+
+# First millisecond of 2015, the zero point of every Discord snowflake
+# https://discord.com/developers/docs/reference#snowflakes
+DISCORD_EPOCH = 1_420_070_400_000
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS command_name (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reaction_name (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS command (
+        id INTEGER PRIMARY KEY,
+        userID INTEGER,
+        commandID INTEGER REFERENCES command_name (id),
+        interactionID INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reaction (
+        id INTEGER PRIMARY KEY,
+        userID INTEGER,
+        reactionID INTEGER REFERENCES reaction_name (id),
+        messageID INTEGER,
+        snowflake INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS message (
+        id INTEGER PRIMARY KEY,
+        userID INTEGER,
+        messageID INTEGER,
+        channelID INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS message_time ON message (messageID)",
+    "CREATE INDEX IF NOT EXISTS reaction_time ON reaction (snowflake)",
+    "CREATE INDEX IF NOT EXISTS command_time ON command (interactionID)",
+]
+
+# The v1 tables used a TEXT (uuid4) id. If this returns "TEXT" for a table, it hasn't been migrated yet
+V1_CHECK = "SELECT type FROM pragma_table_info(?) WHERE name = 'id'"
+
+# Moves v1 tables out of the way, so the v2 tables can be created with their names
+V1_RENAME = "ALTER TABLE {table} RENAME TO {table}_v1"
+
+# Names are inserted into their lookup table first (if they're new), then rows reference them by id
+INSERT_NAME = {
+    "command": "INSERT OR IGNORE INTO command_name (name) VALUES (?)",
+    "reaction": "INSERT OR IGNORE INTO reaction_name (name) VALUES (?)",
+}
+
+# Rows are queued in the same column order these statements expect
+# Messages are written to their year's partition instead, see insert_message()
+INSERT_ROW = {
+    "command": """
+        INSERT INTO command (userID, commandID, interactionID)
+        VALUES (?, (SELECT id FROM command_name WHERE name = ?), ?)
+    """,
+    "reaction": """
+        INSERT INTO reaction (userID, reactionID, messageID, snowflake)
+        VALUES (?, (SELECT id FROM reaction_name WHERE name = ?), ?, ?)
+    """,
+}
+
+# Where the name sits within a queued command/reaction row
+NAME_INDEX = 1
+
+
+def now_ms() -> int:
+    """Current time as epoch milliseconds"""
+    return time.time_ns() // 1_000_000
+
+
+def snowflake_to_ms(snowflake: int) -> int:
+    """When a snowflake was created, as epoch milliseconds. The top 42 bits are ms since the Discord epoch"""
+    return (snowflake >> 22) + DISCORD_EPOCH
+
+
+def ms_to_snowflake(ms: int) -> int:
+    """The smallest snowflake that could have been created at `ms`, used as a range boundary"""
+    return (ms - DISCORD_EPOCH) << 22
+
+
+def now_snowflake() -> int:
+    """Snowflake for right now, for events Discord doesn't give us an id for (reactions)"""
+    return ms_to_snowflake(now_ms())
+
+
+def snowflake_to_datetime(snowflake: int) -> dt.datetime:
+    """When a snowflake was created, as a naive local datetime"""
+    return dt.datetime.fromtimestamp(snowflake_to_ms(snowflake) / 1000)
+
+
+def datetime_to_snowflake(when: dt.datetime) -> int:
+    """Naive datetimes are treated as local time, like the rest of the archive"""
+    return ms_to_snowflake(int(when.timestamp() * 1000))
+
+
+def snowflake_range(start: dt.datetime, end: dt.datetime) -> tuple[int, int]:
+    """
+    Snowflakes created in [start, end), for `TIME_COLUMN >= ? AND TIME_COLUMN < ?` range scans.
+    Works just as well for years as it does for days or hours.
+    """
+    return datetime_to_snowflake(start), datetime_to_snowflake(end)
+
+
+def year_range(year: int) -> tuple[int, int]:
+    return snowflake_range(dt.datetime(year, 1, 1), dt.datetime(year + 1, 1, 1))
+
+
+def new_names(table: str, rows: Sequence[Sequence[Any]]) -> list[tuple[str]]:
+    """The distinct names a batch of rows reference, as parameters for INSERT_NAME[table]"""
+    if table not in INSERT_NAME:
+        return []
+    return [(name,) for name in {row[NAME_INDEX] for row in rows}]
+
+
+# Partitions
+# The message table is split up by year, so the table (and indexes) the archiver writes to stay small, and
+# a finished year can be recapped without getting in the way of live writes.
+#
+# - The archiver writes each message into message_{year}, creating the partition the first time it sees a year
+# - `message` is a view that unions every partition, for anything that just wants all messages
+# - Once a year is over, its partition is made read-only, and optionally moved into its own database file
+#   (attached to the connection as archive_{year}). See `CommandUsage.finalize_past_years`.
+#
+# Partitions are tracked in the message_partition table.
+
+PARTITION_REGISTRY = """
+    CREATE TABLE IF NOT EXISTS message_partition (
+        year INTEGER PRIMARY KEY,
+        file TEXT,
+        readOnly INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+SELECT_PARTITIONS = "SELECT year, file, readOnly FROM message_partition ORDER BY year"
+
+
+class MessagePartition(NamedTuple):
+    year: int
+    # Separate database file this partition was moved to, None if it's still in gbdb.sqlite
+    file: str | None = None
+    readOnly: bool = False
+
+    @property
+    def table(self) -> str:
+        return f"message_{self.year}"
+
+    @property
+    def schema(self) -> str:
+        return f"archive_{self.year}" if self.file else "main"
+
+    @property
+    def qualified(self) -> str:
+        return f"{self.schema}.{self.table}"
+
+
+def message_year(message_id: int) -> int:
+    """The (local) year a message belongs to, which decides its partition"""
+    return snowflake_to_datetime(message_id).year
+
+
+def rows_by_year(rows: Sequence[Sequence[Any]]) -> dict[int, list[Sequence[Any]]]:
+    """Splits queued message rows (userID, messageID, channelID) up by partition"""
+    years = defaultdict(list)
+    for row in rows:
+        years[message_year(row[1])].append(row)
+    return years
+
+
+def insert_message(year: int) -> str:
+    return f"INSERT INTO message_{year} (userID, messageID, channelID) VALUES (?, ?, ?)"
+
+
+# Each partition's indexes (time, user+time, channel+time, like the old message table), suffix -> columns
+PARTITION_INDEXES = {
+    "time": "messageID",
+    "user_time": "userID, messageID",
+    "channel_time": "channelID, messageID",
+}
+
+
+def partition_table_statements(year: int, schema: str = "main") -> list[str]:
+    """The partition table and its indexes"""
+    return [partition_create_table(year, schema), *partition_index_statements(year, schema)]
+
+
+def partition_create_table(year: int, schema: str = "main") -> str:
+    return f"""
+        CREATE TABLE IF NOT EXISTS {schema}.message_{year} (
+            id INTEGER PRIMARY KEY,
+            userID INTEGER,
+            messageID INTEGER,
+            channelID INTEGER
+        )
+    """
+
+
+def partition_index_statements(year: int, schema: str = "main") -> list[str]:
+    table = f"message_{year}"
+    return [
+        f"CREATE INDEX IF NOT EXISTS {schema}.{table}_{suffix} ON {table} ({columns})"
+        for suffix, columns in PARTITION_INDEXES.items()
+    ]
+
+
+def reindex_statements(partition: MessagePartition) -> list[str]:
+    """Rebuilds the partition's indexes, packed full instead of left half empty by out of order inserts"""
+    return [f"REINDEX {partition.schema}.{partition.table}_{suffix}" for suffix in PARTITION_INDEXES]
+
+
+def union_view(name: str, tables: Sequence[str]) -> str:
+    selects = [f"SELECT id, userID, messageID, channelID FROM {table}" for table in tables]
+    return f"CREATE VIEW {name} AS " + " UNION ALL ".join(selects)
+
+
+def view_statements(partitions: Sequence[MessagePartition]) -> list[str]:
+    """
+    (Re)creates the `message` view over the partitions in gbdb.sqlite.
+
+    Views in the main database can't reference attached databases, so partitions moved to their own file are
+    left out. Connections that attach them get a temp view that includes them, see attach_statements().
+    """
+    main_tables = [partition.table for partition in partitions if not partition.file]
+    statements = ["DROP VIEW IF EXISTS main.message"]
+    if main_tables:
+        statements.append(union_view("main.message", main_tables))
+    return statements
+
+
+def new_partition_statements(year: int, partitions: Sequence[MessagePartition]) -> list[str]:
+    """Creates a partition for `year`, registers it, and adds it to the view"""
+    return [
+        *partition_table_statements(year),
+        f"INSERT OR IGNORE INTO message_partition (year, file, readOnly) VALUES ({year}, NULL, 0)",
+        *view_statements([*partitions, MessagePartition(year)]),
+    ]
+
+
+def read_only_statements(partition: MessagePartition) -> list[str]:
+    """Triggers that refuse any change to a finished year's partition"""
+    statements = []
+    for action in ("INSERT", "UPDATE", "DELETE"):
+        trigger = f"{partition.schema}.{partition.table}_read_only_{action.lower()}"
+        statements.append(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {trigger} BEFORE {action} ON {partition.table}
+            BEGIN
+                SELECT RAISE(ABORT, '{partition.table} is read-only');
+            END
+            """
+        )
+    return statements
+
+
+def attach_statements(partitions: Sequence[MessagePartition]) -> list[str]:
+    """
+    Attaches every partition that lives in its own file, and shadows the main `message` view with a temp
+    view that includes them. Ran by each connection that reads messages, outside of any transaction.
+    """
+    attached = [partition for partition in partitions if partition.file]
+    if not attached:
+        return []
+
+    statements = [attach_statement(partition) for partition in attached]
+    return statements + temp_view_statements(partitions)
+
+
+def attach_statement(partition: MessagePartition) -> str:
+    path = partition.file.replace("'", "''")
+    return f"ATTACH DATABASE '{path}' AS {partition.schema}"
+
+
+def temp_view_statements(partitions: Sequence[MessagePartition]) -> list[str]:
+    """(Re)creates this connection's temp `message` view, only needed once a partition has its own file"""
+    if not any(partition.file for partition in partitions):
+        return []
+    return [
+        "DROP VIEW IF EXISTS temp.message",
+        union_view("temp.message", [partition.qualified for partition in partitions]),
+    ]
+
+
+def load_partitions(conn: sqlite3.Connection) -> list[MessagePartition]:
+    return [MessagePartition(*row) for row in conn.execute(SELECT_PARTITIONS)]
+
+
+def count_statement(old: MessagePartition, new: MessagePartition) -> str:
+    """Both copies of a partition's row count, to check a move before the old copy is dropped"""
+    return f"SELECT (SELECT COUNT(*) FROM {old.qualified}), (SELECT COUNT(*) FROM {new.qualified})"
+
+
+def copy_partition(database: str, year: int, destination: str) -> int:
+    """
+    Copies a read-only partition out of `database` into its own file at `destination`. The indexes are
+    built after the rows are in, and the file is vacuumed, so the copy is compact. Blocking, ran in a thread.
+    Returns how many rows were copied.
+
+    The copy is written next to `destination` and renamed into place once its row count matches, so
+    `destination` only ever holds a complete copy. Copying again, after a move that didn't finish, starts over.
+    """
+    partial = destination + ".tmp"
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    old, new = MessagePartition(year), MessagePartition(year, file=destination)
+    with closing(sqlite3.connect(f"file:{partial}", uri=True)) as conn:
+        conn.execute("PRAGMA busy_timeout = 5000")
+        # Nothing in `database` is written to, the partition is read-only by now
+        conn.execute(f"ATTACH DATABASE 'file:{database}?mode=ro' AS {new.schema}_source")
+        source = f"{new.schema}_source.{old.table}"
+        with conn:
+            conn.execute(partition_create_table(year))
+            conn.execute(f"INSERT INTO main.{old.table} SELECT * FROM {source}")
+        with conn:
+            for statement in [*partition_index_statements(year), *read_only_statements(old)]:
+                conn.execute(statement)
+
+        copied = conn.execute(f"SELECT COUNT(*) FROM main.{old.table}").fetchone()[0]
+        expected = conn.execute(f"SELECT COUNT(*) FROM {source}").fetchone()[0]
+        conn.execute(f"DETACH DATABASE {new.schema}_source")
+        if copied != expected:
+            raise RuntimeError(f"Copied {copied} of {expected} rows from {old.table}, not moving it")
+        conn.execute("VACUUM")
+
+    os.replace(partial, destination)
+    return copied
+
+
+def connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    """
+    Opens a (blocking) connection to the archive for scripts like recap, with any partitions that were
+    moved to their own file attached. `read_only` connections (and what they attach) can't write at all,
+    for reading the analytics copy, which is read-only on disk
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True) if read_only else sqlite3.connect(path)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    for statement in attach_statements(load_partitions(conn)):
+        conn.execute(statement)
+    return conn
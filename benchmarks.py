@@ -0,0 +1,272 @@
+"""
+Benchmark suite for recap and the archiver, ran against a synthetic archive (see synthetic_archive.py)
+
+Times every recap statistic (SQL, rollups, streaming, numpy, per-user, the /recap snapshot), the archiver's
+insert paths (a batch write with its rollup catch-up, spooling), and reports the database's size. Results
+are written as JSON, and can be compared against an earlier run to catch regressions.
+
+Usage
+    python benchmarks.py [--scale 10] [--years 3] [--repeat 3] [--output results.json]
+    python benchmarks.py --database gbdb.sqlite               (benchmark a copy of an archive instead)
+    python benchmarks.py --compare baseline.json              (exits with 1 if anything got slower)
+"""
+
+import argparse
+import asyncio
+import datetime as dt
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+
+import archive
+import recap
+import synthetic_archive
+from cogs._archiver.spool import Spool
+from cogs._archiver.writer import ArchiveWriter
+from database import Database
+
+# Rows per archiver batch, same as Goonbot.archiver_flush_rows
+BATCH_SIZE = 200
+
+# How much slower than the baseline a benchmark can get before --compare calls it a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+class Result(NamedTuple):
+    name: str
+    # Fastest and median of `repeat` runs, in seconds
+    best: float
+    median: float
+    repeat: int
+    # Rows the benchmark went through, for throughput. None if it doesn't apply
+    rows: int | None = None
+
+
+def run(name: str, function: Callable[[], Any], repeat: int, rows: int | None = None) -> Result:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    result = Result(name, min(durations), statistics.median(durations), repeat, rows)
+    throughput = f", {rows / result.best:,.0f} rows/s" if rows else ""
+    print(f"  {name:<45} {result.best * 1000:>10.1f}ms{throughput}")
+    return result
+
+
+def recap_benchmarks(year: int) -> dict[str, Callable[[], Any]]:
+    """Every recap statistic, for `year`"""
+    this_year = recap.Filter(between=archive.year_range(year))
+    return {
+        # Pushed down into SQL
+        "recap.count(message)": lambda: recap.count("message", this_year),
+        "recap.count_chatters": lambda: recap.count_chatters(this_year),
+        "recap.count_by(message, channel)": lambda: recap.count_by("message", "channel", this_year),
+        "recap.count_reactions": lambda: recap.count_reactions(this_year),
+        "recap.count_commands": lambda: recap.count_commands(this_year),
+        "recap.count_per_day(message)": lambda: recap.count_per_day("message", this_year),
+        "recap.count_per_hour(message)": lambda: recap.count_per_hour("message", this_year),
+        # Rollups
+        "recap.total_from_rollup(message_daily)": lambda: recap.total_from_rollup("message_daily", year),
+        "recap.messages_per_day": lambda: recap.messages_per_day(year),
+        "recap.top_chatters": lambda: recap.top_chatters(5, year),
+        "recap.top_reactions": lambda: recap.top_reactions(5, year),
+        "recap.top_commands": lambda: recap.top_commands(5, year),
+        # Streaming and numpy
+        "recap.stream_recap": lambda: recap.stream_recap(this_year),
+        "recap.busiest_hours": lambda: recap.busiest_hours(this_year, window=3),
+        "recap.busiest_day": lambda: recap.busiest_day(this_year),
+        "recap.weekday_hour_heatmap": lambda: recap.weekday_hour_heatmap(None, this_year),
+        # Per-user, and the /recap snapshot from scratch
+        "recap.build_user_recaps": lambda: recap.build_user_recaps(year),
+        "recap.refresh_snapshot (cold)": lambda: recap.refresh_snapshot(year, {}),
+    }
+
+
+def archiver_batches(generator: synthetic_archive.Generator, date: dt.date) -> list[dict[str, list[tuple]]]:
+    """A day of synthetic rows, split into batches like the write-behind queue makes"""
+    day = generator.day(date)
+    rows = [(table, row) for table, table_rows in day.items() for row in table_rows]
+    batches = []
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch = {}
+        for table, row in rows[i : i + BATCH_SIZE]:
+            batch.setdefault(table, []).append(row)
+        batches.append(batch)
+    return batches
+
+
+async def write_batches(database: str, batches: list[dict[str, list[tuple]]]):
+    """The archiver's write path (ArchiveWriter.write_rows), each batch and its rollup catch-up together"""
+    db = Database(database)
+    await db.connect()
+    try:
+        writer = ArchiveWriter(db)
+        await writer.load_partitions()
+        for batch in batches:
+            await writer.write_rows(batch)
+    finally:
+        await db.close()
+
+
+def spool_batches(batches: list[dict[str, list[tuple]]]):
+    """The archiver's fallback when the database is locked, appending (and fsyncing) batches to the spool"""
+    with tempfile.TemporaryDirectory() as tmp:
+        spool = Spool(Path(tmp) / "archiver.spool")
+        for batch in batches:
+            spool.append(batch)
+        # And reading them back, like a replay does
+        for _ in spool.records(0):
+            pass
+
+
+def archiver_benchmarks(database: str, repeat: int, seed: int | None) -> list[Result]:
+    """
+    Each repeat writes a different day (starting tomorrow), so none of them are writing rows (and names) the
+    previous one already did, which would be cheaper than the archiver's real writes
+    """
+    generator = synthetic_archive.Generator(synthetic_archive.SyntheticConfig(seed=seed))
+    tomorrow = dt.date.today() + dt.timedelta(days=1)
+    days = [archiver_batches(generator, tomorrow + dt.timedelta(days=i)) for i in range(repeat)]
+    # Days vary a little in size, so throughput is for the average one
+    day_rows = [sum(len(rows) for batch in batches for rows in batch.values()) for batches in days]
+    rows = round(statistics.mean(day_rows))
+    unwritten = iter(days)
+
+    def write_next_day():
+        asyncio.run(write_batches(database, next(unwritten)))
+
+    return [
+        run("archiver.write_batches", write_next_day, repeat, rows),
+        run("archiver.spool_batches", lambda: spool_batches(days[0]), repeat, rows),
+    ]
+
+
+def copy_database(source: str, destination: str):
+    """Compacted copy of `source`, so benchmarking an archive never writes to it"""
+    conn = archive.connect(source, read_only=True)
+    conn.execute("VACUUM INTO ?", (destination,))
+    conn.close()
+
+
+def database_size(database: str) -> dict[str, Any]:
+    conn = archive.connect(database)
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    size = {
+        "bytes": os.path.getsize(database),
+        "pageSize": page_size,
+        "pages": conn.execute("PRAGMA page_count").fetchone()[0],
+        "freePages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+        "rows": {},
+    }
+    for table in archive.ARCHIVE_TABLES:
+        size["rows"][table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    size["bytesPerRow"] = size["bytes"] / (sum(size["rows"].values()) or 1)
+    try:
+        # Bytes used by each table and index, if sqlite was compiled with the dbstat table
+        size["objects"] = dict(
+            conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC").fetchall()
+        )
+    except sqlite3.OperationalError:
+        pass
+    conn.close()
+    return size
+
+
+def git_commit() -> str | None:
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def compare(results: dict[str, Any], baseline_path: str) -> list[str]:
+    """Benchmarks that got slower than REGRESSION_THRESHOLD times the baseline's best time"""
+    baseline = {result["name"]: result for result in json.loads(Path(baseline_path).read_text())["results"]}
+    regressions = []
+    for result in results["results"]:
+        before = baseline.get(result["name"])
+        if before and result["best"] > before["best"] * REGRESSION_THRESHOLD:
+            ratio = result["best"] / before["best"]
+            timing = f"{before['best'] * 1000:.1f}ms -> {result['best'] * 1000:.1f}ms"
+            regressions.append(f"{result['name']}: {timing} ({ratio:.2f}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recap and the archiver")
+    parser.add_argument("--database", help="Benchmark a copy of an archive instead of generating one")
+    parser.add_argument("--scale", type=float, default=1, help="Multiplies the default daily volume")
+    parser.add_argument("--years", type=int, default=synthetic_archive.SyntheticConfig().years)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="Earlier results to check for regressions")
+    args = parser.parse_args()
+
+    defaults = synthetic_archive.SyntheticConfig()
+    config = defaults._replace(
+        years=args.years,
+        messages_per_day=defaults.messages_per_day * args.scale,
+        commands_per_day=defaults.commands_per_day * args.scale,
+        seed=args.seed,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, "synthetic.sqlite")
+        if args.database is None:
+            print(f"Generating a synthetic archive ({args.years} years, {args.scale}x volume)")
+            synthetic_archive.generate(database, config)
+        else:
+            print(f"Copying {args.database}")
+            copy_database(args.database, database)
+
+        recap.db_path = recap.cache_path = database
+        year = dt.datetime.now().year
+        print(f"Benchmarking {database} (best of {args.repeat})")
+        results = [run(name, function, args.repeat) for name, function in recap_benchmarks(year).items()]
+        size = database_size(database)
+        # Last, since these add rows
+        results += archiver_benchmarks(database, args.repeat, args.seed)
+
+    output = {
+        "meta": {
+            "date": dt.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "config": config._asdict() if args.database is None else None,
+        },
+        "size": size,
+        "results": [result._asdict() for result in results],
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2))
+    print(f"Size: {size['bytes']:,} bytes, {size['bytesPerRow']:.1f} bytes/row")
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        regressions = compare(output, args.compare)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+What's running: the commit, when it was committed, and which Python and host it's on
+
+Resolved once at startup (Goonbot.build_info), and again only when the checked out commit changes, which is
+noticed by the mtimes of `.git/HEAD` and the branch's ref file. Reading it is just an attribute lookup, so
+/meta, logs, and error reports can use it freely.
+
+> "Why not just run `git log` when it's needed?"
+/meta used to spawn a `git log` subprocess (and read /etc/issue) on every use. Neither changes while the bot
+is running, unless it's updated in place, which is what the mtime check is for.
+"""
+
+import datetime as dt
+import logging
+import pathlib
+import platform
+import subprocess
+from typing import NamedTuple
+
+GIT_DIR = pathlib.Path(".git")
+
+
+class BuildInfo(NamedTuple):
+    version: str
+    commit: str | None
+    commitTime: dt.datetime | None
+    python: str
+    kernel: str
+    os: str | None
+
+    def __str__(self) -> str:
+        commit = self.commit[:7] if self.commit else "unknown commit"
+        return f"goonbot {self.version} ({commit}), Python {self.python}, {self.kernel}"
+
+
+def read_os() -> str | None:
+    issue_file = pathlib.Path("/etc/issue")
+    if not issue_file.exists():
+        return None
+    # The issue file on raspberry Pi has artifacts which aren't removed by str.strip()
+    issue_file_text = issue_file.read_text()
+    return issue_file_text[: -issue_file_text.find("Linux")]  # Debian GNU/Linux
+
+
+def read_commit(git_dir: pathlib.Path) -> tuple[str | None, dt.datetime | None]:
+    """The checked out commit's hash and time. Blocking"""
+    try:
+        output = subprocess.run(
+            ["git", "log", "-1", "--format=%H %ct"],
+            cwd=git_dir.parent,
+            capture_output=True,
+            text=True,
+            timeout=10,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError):
+        logging.warning("Unable to retrieve the last commit. Are you in a Git repository?")
+        return None, None
+    commit, timestamp = output.stdout.split()
+    return commit, dt.datetime.fromtimestamp(int(timestamp))
+
+
+def watched_files(git_dir: pathlib.Path) -> list[pathlib.Path]:
+    """.git/HEAD, and the ref it points to (plus packed-refs, where refs go after a `git gc`)"""
+    head = git_dir / "HEAD"
+    files = [head, git_dir / "packed-refs"]
+    try:
+        contents = head.read_text().strip()
+    except OSError:
+        return files
+    if contents.startswith("ref: "):
+        files.append(git_dir / contents.removeprefix("ref: "))
+    return files
+
+
+class BuildInfoProvider:
+    """Holds the current BuildInfo, see refresh_if_changed"""
+
+    def __init__(self, version: str, git_dir: pathlib.Path = GIT_DIR):
+        self.version = version
+        self.git_dir = git_dir
+        self.stamp = self.read_stamp()
+        self.info = self.load()
+
+    def read_stamp(self) -> tuple[tuple[str, float], ...]:
+        stamp = []
+        for path in watched_files(self.git_dir):
+            try:
+                stamp.append((str(path), path.stat().st_mtime))
+            except OSError:
+                continue
+        return tuple(stamp)
+
+    def load(self) -> BuildInfo:
+        commit, commit_time = read_commit(self.git_dir)
+        return BuildInfo(
+            version=self.version,
+            commit=commit,
+            commitTime=commit_time,
+            python=platform.python_version(),
+            kernel=f"{platform.system()} {platform.release()}",  # Linux 0.00.00-v0+
+            os=read_os(),
+        )
+
+    def refresh_if_changed(self) -> bool:
+        """Reloads if HEAD or its ref changed since the last load. Blocking, returns if it reloaded"""
+        stamp = self.read_stamp()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        self.info = self.load()
+        return True
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Any, Iterator
+
+# Each record is a header (payload length, crc32 of the payload) followed by the payload
+HEADER = struct.Struct("<II")
+
+type Batch = dict[str, list[tuple[Any, ...]]]
+
+
+class Spool:
+    """
+    Append-only file the archiver falls back to when a batch can't be written because gbdb.sqlite is
+    locked (a backup, a long recap query, etc.). Batches are replayed into the database once the lock clears,
+    or the next time the bot starts if it went down with batches still spooled.
+
+    Each batch is one length-prefixed record, `HEADER` then the batch as JSON. A record that was only half
+    written when the bot crashed fails its length/checksum check, and it (and anything after it) is skipped.
+
+    How far replaying has gotten is kept in a small `.offset` file next to the spool, replaced atomically
+    after every record. So a crash mid-replay replays at most one batch twice, instead of the whole spool.
+    Once everything is replayed both files are emptied.
+
+    All of the methods here do (small) blocking file I/O, so the write-behind queue calls them in a thread.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = Path(path)
+        self.offset_path = self.path.with_name(self.path.name + ".offset")
+        # Appends can land while a replay is reading, this keeps them from racing the final truncate
+        self.lock = threading.Lock()
+
+    @property
+    def offset(self) -> int:
+        """Bytes of the spool that have already been replayed"""
+        try:
+            return int(self.offset_path.read_text() or 0)
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def pending_bytes(self) -> int:
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+        return max(size - self.offset, 0)
+
+    def append(self, batch: Batch) -> None:
+        """Adds a batch to the end of the spool, and syncs it to disk"""
+        payload = json.dumps(batch, separators=(",", ":")).encode()
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock, self.path.open("ab") as file:
+            # One write call per record, so a crash can only ever tear the last record
+            file.write(record)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def records(self, start: int) -> Iterator[tuple[Batch, int]]:
+        """
+        Yields every complete batch after byte `start`, along with the offset just past it.
+        Stops at the first incomplete record, which is either torn (see repair) or still being appended.
+        """
+        try:
+            file = self.path.open("rb")
+        except FileNotFoundError:
+            return
+
+        with file:
+            file.seek(start)
+            while len(header := file.read(HEADER.size)) == HEADER.size:
+                length, checksum = HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    return
+                batch = {table: [tuple(row) for row in rows] for table, rows in json.loads(payload).items()}
+                yield batch, file.tell()
+
+    def repair(self) -> None:
+        """
+        Cuts off a torn record left at the end of the spool by a crash, otherwise everything appended after
+        it would never be replayed. Ran once on startup, before replaying.
+        """
+        with self.lock:
+            end = self.offset
+            for _, end in self.records(end):
+                pass
+            if self.path.exists() and self.path.stat().st_size > end:
+                logging.warning(f"Cut a torn record off the end of {self.path}")
+                with self.path.open("r+b") as file:
+                    file.truncate(end)
+
+    def mark_replayed(self, offset: int) -> None:
+        temporary = self.offset_path.with_name(self.offset_path.name + ".tmp")
+        temporary.write_text(str(offset))
+        os.replace(temporary, self.offset_path)
+
+    def truncate_if_replayed(self, offset: int) -> bool:
+        """Empties the spool if nothing was appended past `offset` while replaying. Returns if it did"""
+        with self.lock:
+            if self.path.exists() and self.path.stat().st_size > offset:
+                return False
+            self.path.unlink(missing_ok=True)
+            self.offset_path.unlink(missing_ok=True)
+            return True
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import defaultdict
+from contextlib import suppress
+from typing import Any, Awaitable, Callable
+
+from .spool import Spool
+
+# Called with every row collected for a batch, grouped by the table the rows belong in
+type BatchWriter = Callable[[dict[str, list[tuple[Any, ...]]]], Awaitable[None]]
+
+
+def is_contention(error: Exception) -> bool:
+    """If a write failed because something else is holding the database, rather than a bug in the batch"""
+    return isinstance(error, sqlite3.OperationalError) and any(
+        reason in str(error) for reason in ("database is locked", "database is busy")
+    )
+
+
+class WriteBehindQueue:
+    """
+    In-memory queue the archiver listeners push rows onto, instead of writing to the database themselves.
+
+    A single background task drains the queue and hands the rows to `writer` in batches, which is
+    expected to do one executemany per table and a single commit. A batch is written once it has
+    `max_rows` rows, or once the oldest row in it has waited `max_delay` seconds, whichever comes first.
+
+    > "Why bother?"
+    Every insert used to be its own connection and commit, which means an fsync on the Pi's SD card for
+    every message, reaction, and command. Batching turns hundreds of those a minute into a handful.
+
+    If a batch can't be written because the database is locked, it's appended to `spool` instead, and
+    replayed every `retry_interval` seconds until it goes through (see spool.py).
+    """
+
+    def __init__(
+        self,
+        writer: BatchWriter,
+        *,
+        max_rows: int,
+        max_delay: float,
+        spool: Spool | None = None,
+        retry_interval: float = 30.0,
+    ):
+        self.writer = writer
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.queue: asyncio.Queue[tuple[str, tuple[Any, ...]] | None] = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+        self.replay_task: asyncio.Task | None = None
+
+        # Stats, shown by the .archiver command
+        self.rows_written = 0
+        self.batches_written = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+        self.total_flush_duration = 0.0
+        self.batches_spooled = 0
+        self.batches_replayed = 0
+
+    @property
+    def depth(self) -> int:
+        """Rows waiting to be written"""
+        return self.queue.qsize()
+
+    @property
+    def average_flush_duration(self) -> float:
+        if not self.batches_written:
+            return 0.0
+        return self.total_flush_duration / self.batches_written
+
+    def put(self, table: str, row: tuple[Any, ...]) -> None:
+        """Queue a row to be written to `table`. Never blocks, safe to call from any listener"""
+        self.queue.put_nowait((table, row))
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.drain(), name="archiver-write-behind")
+        if self.spool:
+            self.replay_task = asyncio.create_task(self.replay_spool(), name="archiver-spool-replay")
+
+    async def close(self) -> None:
+        """Stop accepting new batches, write everything still queued, and wait for the drain task to finish"""
+        if self.task is None:
+            return
+        # The sentinel lands behind every row already queued, so they're all written before the task exits
+        self.queue.put_nowait(None)
+        await self.task
+        self.task = None
+
+        # Whatever is still spooled gets replayed the next time the bot starts
+        if self.replay_task:
+            self.replay_task.cancel()
+            # Waited on so a replay that was mid-transaction has rolled back before the database is closed
+            with suppress(asyncio.CancelledError):
+                await self.replay_task
+            self.replay_task = None
+
+    async def drain(self) -> None:
+        """Background task, collects batches and writes them until the sentinel is reached"""
+        while True:
+            batch, closing = await self.collect_batch()
+            if batch:
+                await self.flush(batch)
+            if closing:
+                return
+
+    async def collect_batch(self) -> tuple[list[tuple[str, tuple[Any, ...]]], bool]:
+        """
+        Waits for the first row, then keeps pulling rows until the batch is full or the deadline passes.
+        Returns the batch, and whether the sentinel (shutdown) was reached.
+        """
+        loop = asyncio.get_running_loop()
+
+        first = await self.queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_rows:
+            # Grab whatever is already waiting without yielding to the loop
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), remaining)
+                except TimeoutError:
+                    break
+
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    async def flush(self, batch: list[tuple[str, tuple[Any, ...]]]) -> None:
+        rows_by_table = defaultdict(list)
+        for table, row in batch:
+            rows_by_table[table].append(row)
+
+        start = time.perf_counter()
+        try:
+            await self.writer(rows_by_table)
+        except Exception as error:
+            if self.spool and is_contention(error):
+                await asyncio.to_thread(self.spool.append, rows_by_table)
+                self.batches_spooled += 1
+                logging.warning(f"Database is locked, spooled a batch of {len(batch)} rows ({error})")
+                return
+            logging.exception(f"Archiver failed to write a batch of {len(batch)} rows")
+            return
+        elapsed = time.perf_counter() - start
+
+        self.rows_written += len(batch)
+        self.batches_written += 1
+        self.last_flush_duration = elapsed
+        self.max_flush_duration = max(self.max_flush_duration, elapsed)
+        self.total_flush_duration += elapsed
+        logging.debug(
+            f"Archiver wrote {len(batch)} rows in {round(elapsed * 1000, 1)}ms ({self.depth} still queued)"
+        )
+
+    async def replay_spool(self) -> None:
+        """Background task, replays spooled batches (starting with any left over from before a restart)"""
+        await asyncio.to_thread(self.spool.repair)
+        while True:
+            if await asyncio.to_thread(lambda: self.spool.pending_bytes):
+                await self.replay()
+            await asyncio.sleep(self.retry_interval)
+
+    async def replay(self) -> None:
+        """Writes spooled batches in order, stopping at the first one the database is still too busy for"""
+        offset = await asyncio.to_thread(lambda: self.spool.offset)
+        records = await asyncio.to_thread(lambda: list(self.spool.records(offset)))
+        for rows_by_table, end in records:
+            try:
+                await self.writer(rows_by_table)
+            except Exception as error:
+                if is_contention(error):
+                    return
+                # Retrying a batch that can't be written would hold up everything spooled after it
+                logging.exception("Archiver failed to replay a spooled batch, skipping it")
+            else:
+                self.batches_replayed += 1
+            await asyncio.to_thread(self.spool.mark_replayed, end)
+            offset = end
+
+        if records and await asyncio.to_thread(self.spool.truncate_if_replayed, offset):
+            logging.info(f"Replayed every spooled batch ({self.batches_replayed} so far)")
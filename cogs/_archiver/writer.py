@@ -0,0 +1,76 @@
+import logging
+
+import archive
+import rollups
+from database import Database
+
+
+class ArchiveWriter:
+    """
+    Writes batches of archiver rows, what the write-behind queue hands its batches to. Also used by
+    benchmarks.py, so it times the same write path the bot uses.
+
+    Keeps the message partitions (year -> MessagePartition), which decide where each message goes.
+    The archiver cog updates them as years are finalized.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.partitions: dict[int, archive.MessagePartition] = {}
+
+    async def load_partitions(self):
+        rows = await self.database.fetchall(archive.SELECT_PARTITIONS)
+        self.partitions = {row[0]: archive.MessagePartition(*row) for row in rows}
+
+    def live_message_tables(self) -> list[str]:
+        """Partitions still being written to. Read-only ones were fully counted into the rollups when finalized"""
+        return [partition.qualified for partition in self.partitions.values() if not partition.readOnly]
+
+    async def write_rows(self, rows_by_table: dict[str, list[tuple]]):
+        """
+        Writes a batch of queued rows, one executemany per table and a single commit.
+        The daily rollups are caught up in the same transaction (see rollups.py)
+        """
+        new_partitions = {}
+        async with self.database.transaction() as db:
+            for table, rows in rows_by_table.items():
+                if table == "message":
+                    new_partitions = await self.write_messages(db, rows)
+                    continue
+                # Make sure any reaction/command names in this batch have a lookup id first
+                if names := archive.new_names(table, rows):
+                    await db.executemany(archive.INSERT_NAME[table], names)
+                await db.executemany(archive.INSERT_ROW[table], rows)
+
+            live_tables = self.live_message_tables() + [partition.table for partition in new_partitions.values()]
+            for statement in rollups.catch_up_statements(live_tables):
+                await db.execute(statement)
+
+        # Only once they're committed
+        self.partitions.update(new_partitions)
+
+    async def write_messages(self, db, rows: list[tuple]) -> dict[int, archive.MessagePartition]:
+        """
+        Writes messages into their year's partition, creating it if this is the first message of the year.
+        Returns the partitions that were created.
+        """
+        new_partitions = {}
+        for year, year_rows in archive.rows_by_year(rows).items():
+            partition = self.partitions.get(year)
+            if partition and partition.readOnly:
+                logging.warning(f"Dropped {len(year_rows)} message(s) from {year}, its partition is read-only")
+                continue
+
+            if partition is None:
+                partitions = [*self.partitions.values(), *new_partitions.values()]
+                new_partitions[year] = archive.MessagePartition(year)
+                statements = [
+                    *archive.new_partition_statements(year, partitions),
+                    *archive.temp_view_statements([*partitions, new_partitions[year]]),
+                ]
+                for statement in statements:
+                    await db.execute(statement)
+                logging.info(f"Created message partition for {year}")
+
+            await db.executemany(archive.insert_message(year), year_rows)
+        return new_partitions
@@ -1,66 +1,194 @@
+import asyncio
 import datetime as dt
-import uuid
+import logging
+import time
+from pathlib import Path
 
-import aiosqlite
 import discord
-from discord.ext import commands
+import humanize
+from dateutil import tz
+from discord.ext import commands, tasks
 
+import archive
+import rollups
 from goonbot import Goonbot
+from metrics import Sample
+from text_processing import join_lines
+
+from ._archiver.spool import Spool
+from ._archiver.write_behind import WriteBehindQueue
+from ._archiver.writer import ArchiveWriter
+
+five_past_midnight_cst = dt.time(hour=0, minute=5, second=0, tzinfo=tz.gettz("America/Chicago"))
 
 
 class CommandUsage(commands.Cog):
     """
     Listeners used for tracking stats for an eventual "Goonbot Wrapped"
+
+    The listeners don't write to the database themselves, they push rows onto a write-behind queue
+    which writes them in batches (see cogs/_archiver/write_behind.py and writer.py)
     """
 
     def __init__(self, bot: Goonbot):
         self.bot = bot
+        self.writer = ArchiveWriter(self.bot.database)
+        self.write_queue = WriteBehindQueue(
+            self.writer.write_rows,
+            max_rows=self.bot.archiver_flush_rows,
+            max_delay=self.bot.archiver_flush_interval,
+            spool=Spool(self.bot.archiver_spool_path),
+        )
 
     async def cog_load(self):
-        await self.ensure_archiver_tables()
-
-    async def ensure_archiver_tables(self):
-        """Ensure database and tables exist"""
-
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            # command table
-            await db.execute(
-                """
-            CREATE TABLE IF NOT EXISTS command (
-                id TEXT PRIMARY KEY,
-                userID INTEGER,
-                commandName TEXT,
-                timestamp TEXT
-            )
-            """
-            )
+        # Tables are created by migrations (see migrations.py)
+        await self.writer.load_partitions()
+        self.write_queue.start()
+        self.finalize_past_years.start()
+        self.bot.metrics.collectors["archiver"] = self.collect_metrics
 
-            # reaction table
-            await db.execute(
-                """
-            CREATE TABLE IF NOT EXISTS reaction (
-                id TEXT PRIMARY KEY,
-                userID INTEGER,
-                reactionStr TEXT,
-                messageID INTEGER,
-                timestamp TEXT
-            )
-            """
-            )
+    async def cog_unload(self):
+        # Called as the bot shuts down, makes sure nothing still queued is lost
+        self.bot.metrics.collectors.pop("archiver", None)
+        self.finalize_past_years.cancel()
+        await self.write_queue.close()
 
-            # message message
-            await db.execute(
-                """
-            CREATE TABLE IF NOT EXISTS message (
-                id TEXT PRIMARY KEY,
-                userID INTEGER,
-                messageID INTEGER,
-                channelID INTEGER,
-                timestamp TEXT
-            )
-            """
-            )
-            await db.commit()
+    def collect_metrics(self) -> list[Sample]:
+        queue = self.write_queue
+        counters = [
+            ("goonbot_archiver_rows_written_total", "Rows written", queue.rows_written),
+            ("goonbot_archiver_batches_written_total", "Batches written", queue.batches_written),
+            ("goonbot_archiver_batches_spooled_total", "Batches spooled", queue.batches_spooled),
+            ("goonbot_archiver_batches_replayed_total", "Spooled batches replayed", queue.batches_replayed),
+        ]
+        return [
+            Sample("goonbot_archiver_queue_depth", "Rows waiting to be written", queue.depth),
+            Sample("goonbot_archiver_last_flush_seconds", "Last batch write", queue.last_flush_duration),
+            *[Sample(name, help, value, type="counter") for name, help, value in counters],
+        ]
+
+    @property
+    def partitions(self) -> dict[int, archive.MessagePartition]:
+        return self.writer.partitions
+
+    def live_message_tables(self) -> list[str]:
+        return self.writer.live_message_tables()
+
+    @tasks.loop(time=five_past_midnight_cst)
+    async def finalize_past_years(self):
+        """
+        Finalizes last year's partition, once the new year is a week old. The week is a grace period, so the
+        recap can still be re-ran, and stragglers (time zones, clock skew) still have somewhere to go.
+        """
+        cutoff = (dt.datetime.now() - dt.timedelta(days=7)).year
+        for partition in list(self.partitions.values()):
+            if partition.year >= cutoff:
+                continue
+            # Finalized, but the move didn't finish (or message_archive_dir was set since)
+            unmoved = self.bot.message_archive_dir and partition.readOnly and not partition.file
+            if not partition.readOnly or unmoved:
+                await self.finalize_partition(partition)
+
+    async def finalize_partition(self, partition: archive.MessagePartition):
+        """
+        Makes a finished year's partition read-only, and compacts it. If `Goonbot.message_archive_dir` is set,
+        the partition is moved into its own database file there, which is attached by every connection from
+        then on.
+
+        Each step commits on its own, and it picks up where it left off (the next night) if the bot stops:
+        - Kept in gbdb.sqlite: its indexes are rebuilt, then it's made read-only
+        - Moved: it's made read-only, copied into its own file (compacted, and checked), and only then dropped
+          from gbdb.sqlite and marked as moved
+
+        > "Why not copy, drop, and mark it moved in one transaction?"
+        With WAL, a transaction across attached databases is only atomic per file. Stopping between the two
+        commits could leave gbdb.sqlite saying the year was moved, with its table dropped, and nothing in the
+        new file.
+        """
+        start = time.perf_counter()
+        if self.bot.message_archive_dir:
+            if not partition.readOnly:
+                partition = await self.make_read_only(partition)
+            partition = await self.move_partition(partition, Path(self.bot.message_archive_dir))
+        else:
+            await self.reindex_partition(partition)
+            partition = await self.make_read_only(partition)
+
+        elapsed = time.perf_counter() - start
+        location = partition.file or "gbdb.sqlite"
+        logging.info(f"Finalized message partition for {partition.year} ({location}) in {elapsed:.1f}s")
+
+    async def make_read_only(self, partition: archive.MessagePartition) -> archive.MessagePartition:
+        finalized = partition._replace(readOnly=True)
+        async with self.bot.database.transaction() as db:
+            # Otherwise sqlite3 runs the DDL below outside of the transaction
+            await db.execute("BEGIN")
+            # Count anything that hasn't been yet, rows can't be added to the partition after this
+            for statement in rollups.catch_up_statements(self.live_message_tables()):
+                await db.execute(statement)
+            for statement in archive.read_only_statements(finalized):
+                await db.execute(statement)
+            await db.execute("UPDATE message_partition SET readOnly = 1 WHERE year = ?", (partition.year,))
+        self.partitions[partition.year] = finalized
+        return finalized
+
+    async def reindex_partition(self, partition: archive.MessagePartition):
+        """
+        Compacts a partition that's staying in gbdb.sqlite. Its rows were appended in order, so the table is
+        already packed, but its indexes were filled in out of order. Each index is rebuilt in its own
+        transaction, so the write lock is only held for one at a time.
+
+        > "Why not VACUUM?"
+        That rewrites all of gbdb.sqlite, holding the write lock the whole time. The pages the old indexes
+        leave behind get reused by the new year's writes.
+        """
+        for statement in archive.reindex_statements(partition):
+            async with self.bot.database.transaction() as db:
+                await db.execute(statement)
+
+    async def move_partition(
+        self, partition: archive.MessagePartition, directory: Path
+    ) -> archive.MessagePartition:
+        """Moves a read-only partition into its own file in `directory`, see finalize_partition"""
+        database = self.bot.database
+        directory.mkdir(parents=True, exist_ok=True)
+        moved = partition._replace(file=str((directory / f"message_{partition.year}.sqlite").resolve()))
+
+        # The partition is read-only, so it's copied on a connection of its own without the write lock
+        await asyncio.to_thread(archive.copy_partition, database.path, partition.year, moved.file)
+
+        # Can't attach inside a transaction
+        async with database.write_lock:
+            await database.connection.execute(archive.attach_statement(moved))
+        partitions = [moved if p.year == partition.year else p for p in self.partitions.values()]
+        try:
+            async with database.transaction() as db:
+                await db.execute("BEGIN")
+                cursor = await db.execute(archive.count_statement(partition, moved))
+                old_count, new_count = await cursor.fetchone()
+                if old_count != new_count:
+                    raise RuntimeError(f"{moved.file} has {new_count} of {old_count} rows, not moving it")
+                # Only gbdb.sqlite is written to here, so this commits (or doesn't) as a whole
+                await db.execute(f"DROP TABLE {partition.qualified}")
+                await db.execute(
+                    "UPDATE message_partition SET file = ? WHERE year = ?", (moved.file, moved.year)
+                )
+                views = archive.view_statements(partitions) + archive.temp_view_statements(partitions)
+                for statement in views:
+                    await db.execute(statement)
+        except BaseException:
+            # So it can be copied (and attached) again next time
+            async with database.write_lock:
+                await database.connection.execute(f"DETACH DATABASE {moved.schema}")
+            raise
+
+        # The dropped table's pages are reused by the new year's writes, instead of vacuuming gbdb.sqlite
+        self.partitions[partition.year] = moved
+        return moved
+
+    @finalize_past_years.before_loop
+    async def before_finalize(self):
+        await self.bot.wait_until_ready()
 
     @commands.Cog.listener("on_app_command_completion")
     async def app_command_used(self, interaction: discord.Interaction, command: discord.app_commands.Command):
@@ -68,18 +196,8 @@ class CommandUsage(commands.Cog):
         if interaction.guild != self.bot.GOON_HQ:
             return
 
-        timestamp = dt.datetime.now().isoformat()
-
-        # Insert into database
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            await db.execute(
-                """
-                INSERT INTO command (id, userID, commandName, timestamp) 
-                VALUES (?, ?, ?, ?)
-                """,
-                (str(uuid.uuid4()), interaction.user.id, command.name, timestamp),
-            )
-            await db.commit()
+        # Queue for insert
+        self.write_queue.put("command", (interaction.user.id, command.name, interaction.id))
 
     @commands.Cog.listener("on_raw_reaction_add")
     async def reaction_used(self, payload: discord.RawReactionActionEvent):
@@ -88,22 +206,15 @@ class CommandUsage(commands.Cog):
         if payload.guild_id != self.bot.GOON_HQ.id:
             return
 
-        timestamp = dt.datetime.now().isoformat()
-
         # Resolve reaction the literal emoji character (which is just a string) or
         # the name of the custom reaction
         reaction_str = payload.emoji if isinstance(payload.emoji, str) else payload.emoji.name
 
-        # Insert into database
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            await db.execute(
-                """
-                INSERT INTO reaction (id, userID, reactionStr, messageID, timestamp) 
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (str(uuid.uuid4()), payload.user_id, reaction_str, payload.message_id, timestamp),
-            )
-            await db.commit()
+        # Queue for insert
+        self.write_queue.put(
+            "reaction",
+            (payload.user_id, reaction_str, payload.message_id, archive.now_snowflake()),
+        )
 
     @commands.Cog.listener("on_message")
     async def message_sent(self, message: discord.Message):
@@ -111,18 +222,48 @@ class CommandUsage(commands.Cog):
         if message.guild != self.bot.GOON_HQ or message.author == self.bot:
             return
 
-        timestamp = dt.datetime.now().isoformat()
+        # Queue for insert
+        self.write_queue.put(
+            "message",
+            (message.author.id, message.id, message.channel.id),
+        )
 
-        # Insert into database
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            await db.execute(
-                """
-                INSERT INTO message (id, userID, messageID, channelID, timestamp) 
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (str(uuid.uuid4()), message.author.id, message.id, message.channel.id, timestamp),
+    @commands.command(name="archiver", description="[Meta] Archiver write queue stats")
+    @commands.is_owner()
+    async def archiver_stats(self, ctx: commands.Context):
+        """Shows how far behind the archiver's write-behind queue is, and how long its flushes take"""
+        queue = self.write_queue
+        await ctx.send(
+            embed=self.bot.embed(
+                title="Archiver",
+                description=join_lines(
+                    [
+                        f"**Queued rows** {queue.depth:,}",
+                        f"**Rows written** {queue.rows_written:,} in {queue.batches_written:,} batches",
+                        f"**Last flush** {round(queue.last_flush_duration * 1000, 1)}ms",
+                        f"**Average flush** {round(queue.average_flush_duration * 1000, 1)}ms",
+                        f"**Slowest flush** {round(queue.max_flush_duration * 1000, 1)}ms",
+                        f"**Cadence** every {queue.max_rows} rows or {queue.max_delay}s",
+                        f"**Spooled** {queue.batches_spooled:,} batches while locked, "
+                        f"{queue.batches_replayed:,} replayed",
+                        f"**Spool backlog** {humanize.naturalsize(queue.spool.pending_bytes)}",
+                    ]
+                ),
             )
-            await db.commit()
+        )
+
+    @commands.command(name="rebuild_rollups", description="[Meta] Recount the recap rollups from the archive")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def rebuild_rollups(self, ctx: commands.Context):
+        """Throws away the daily rollups and regenerates them from the raw archive rows"""
+        start = time.perf_counter()
+        async with self.bot.database.transaction() as db:
+            all_tables = [partition.qualified for partition in self.partitions.values()]
+            for statement in rollups.rebuild_statements(all_tables):
+                await db.execute(statement)
+        elapsed = time.perf_counter() - start
+        await ctx.send(embed=self.bot.embed(title="Rollups rebuilt ✅", description=f"Took {elapsed:.1f}s"))
 
 
 async def setup(bot):
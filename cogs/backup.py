@@ -0,0 +1,240 @@
+import asyncio
+import datetime as dt
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import NamedTuple
+
+import humanize
+from dateutil import tz
+from discord.ext import commands, tasks
+
+import archive
+from goonbot import Goonbot
+from text_processing import join_lines
+
+three_am_cst = dt.time(hour=3, minute=0, second=0, tzinfo=tz.gettz("America/Chicago"))
+
+# Times a stepped backup can start over before the rest is copied in a single step
+MAX_RESTARTS = 3
+
+
+class BackupCancelled(Exception):
+    """Raised from the progress callback, stopping a backup part way, when the cog is unloaded"""
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+class BackupResult(NamedTuple):
+    path: Path
+    duration: float
+    database_bytes: int
+    compressed_bytes: int
+    # How many times sqlite had to start over, because something wrote to the database mid-backup
+    restarts: int
+    # If it started over too many times, and the rest was copied in one step
+    single_step: bool
+    # Moved message partitions backed up for the first time (see Backup.backup_partitions)
+    partitions: list[Path]
+
+
+def backup_database(
+    source: str, destination: Path, pages: int, sleep: float, cancelled: threading.Event
+) -> tuple[int, bool]:
+    """
+    Copies `source` into `destination` with sqlite's online backup API, `pages` at a time, sleeping
+    between each step so the bot's writes get the lock in between. Blocking, returns the restart count and
+    if it fell back to a single step.
+
+    > "Why sleep in the progress callback, instead of backup()'s `sleep`?"
+    That one only applies when a step comes back busy or locked. Otherwise every step runs back to back.
+
+    Any commit from another connection (the bot's) makes sqlite start the copy over. After MAX_RESTARTS, the
+    rest is copied in a single step. With WAL that holds a read transaction, which doesn't block the bot's
+    writes, it just holds off checkpoints until it's done.
+    """
+    restarts = 0
+    last_remaining = None
+
+    def progress(status: int, remaining: int, total: int):
+        nonlocal restarts, last_remaining
+        # Raising stops the backup
+        if cancelled.is_set():
+            raise BackupCancelled
+        # Pages left going back up means a write from another connection made sqlite start over
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise TooManyRestarts
+        last_remaining = remaining
+        if remaining:
+            time.sleep(sleep)
+
+    with closing(sqlite3.connect(source)) as source_conn, closing(sqlite3.connect(destination)) as copy:
+        source_conn.execute("PRAGMA busy_timeout = 5000")
+        try:
+            source_conn.backup(copy, pages=pages, progress=progress)
+        except TooManyRestarts:
+            # -1 is every page at once
+            source_conn.backup(copy, pages=-1)
+            return restarts, True
+    return restarts, False
+
+
+def compress(path: Path) -> Path:
+    """gzips `path` next to itself (path.gz), and removes the original. Blocking"""
+    compressed = path.with_name(path.name + ".gz")
+    partial = compressed.with_name(compressed.name + ".tmp")
+    with path.open("rb") as file, gzip.open(partial, "wb") as gz:
+        shutil.copyfileobj(file, gz)
+    # Only ever a complete .gz under the real name
+    os.replace(partial, compressed)
+    path.unlink()
+    return compressed
+
+
+def prune_backups(directory: Path, retention_days: int) -> list[Path]:
+    """Deletes backups older than the retention period. Blocking, returns what was deleted"""
+    cutoff = time.time() - retention_days * 24 * 60 * 60
+    pruned = []
+    # .db is what bin/backup-db.sh used to leave behind
+    for pattern in ("backup_*.db.gz", "backup_*.db"):
+        for path in directory.glob(pattern):
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                pruned.append(path)
+    return pruned
+
+
+class Backup(commands.Cog):
+    """
+    Nightly backup of gbdb.sqlite, replaces bin/backup-db.sh (which ran `sqlite3 .backup` from cron)
+
+    > "Why not keep the cron job?"
+    `sqlite3 .backup` copies the whole database in a single step, holding a read lock the entire time, and
+    it had no idea when the bot was busy. This copies a few hundred pages at a time with sleeps in between,
+    from inside the bot, so the archiver's writes are never held up for more than a step. If the bot's writes
+    keep making the copy start over, the rest is copied in one step (see backup_database).
+
+    Finished backups are gzipped, and anything older than `Goonbot.backup_retention_days` is deleted.
+
+    Message partitions moved to their own file (`Goonbot.message_archive_dir`, see archive.py) are attached,
+    so the backup API doesn't copy them. They're read-only once moved, so each is backed up once, the first
+    night after it's moved, as `message_<year>.sqlite.gz`, and kept.
+    """
+
+    def __init__(self, bot: Goonbot):
+        self.bot = bot
+        # The nightly task and .backup could otherwise both write today's file
+        self.lock = asyncio.Lock()
+        # Set on unload, stops a backup that's still running (it's in a thread, so it can't be cancelled)
+        self.cancelled = threading.Event()
+
+    async def cog_load(self):
+        self.nightly_backup.start()
+
+    async def cog_unload(self):
+        self.cancelled.set()
+        self.nightly_backup.cancel()
+
+    async def run_backup(self) -> BackupResult:
+        backup_dir = Path(self.bot.backup_dir)
+        if not backup_dir.is_dir():
+            raise FileNotFoundError(f"{backup_dir} does not exist, is the backup USB drive mounted?")
+
+        async with self.lock:
+            start = time.perf_counter()
+            path = backup_dir / f"backup_{dt.date.today().isoformat()}.db"
+            path.unlink(missing_ok=True)
+
+            restarts, single_step = await asyncio.to_thread(
+                backup_database,
+                self.bot.database_path,
+                path,
+                self.bot.backup_pages_per_step,
+                self.bot.backup_step_sleep,
+                self.cancelled,
+            )
+            database_bytes = path.stat().st_size
+            compressed = await asyncio.to_thread(compress, path)
+            partitions = await self.backup_partitions(backup_dir)
+            pruned = await asyncio.to_thread(prune_backups, backup_dir, self.bot.backup_retention_days)
+            duration = time.perf_counter() - start
+
+        result = BackupResult(
+            compressed, duration, database_bytes, compressed.stat().st_size, restarts, single_step, partitions
+        )
+        sizes = f"{humanize.naturalsize(database_bytes)} -> {humanize.naturalsize(result.compressed_bytes)}"
+        logging.info(
+            f"Backed up {self.bot.database_path} to {compressed} in {duration:.1f}s ({sizes} written, "
+            f"{restarts} restart(s){', finished in one step' if single_step else ''}, "
+            f"{len(partitions)} moved partition(s) backed up, {len(pruned)} old backup(s) deleted)"
+        )
+        return result
+
+    async def backup_partitions(self, backup_dir: Path) -> list[Path]:
+        """
+        Backs up the message partitions that were moved to their own file and don't have a backup yet.
+        Returns the new backups
+        """
+        rows = await self.bot.database.fetchall(archive.SELECT_PARTITIONS)
+        backed_up = []
+        for partition in (archive.MessagePartition(*row) for row in rows):
+            if not partition.file:
+                continue
+            path = backup_dir / Path(partition.file).name
+            # compress only ever leaves a complete .gz, so one being there means it's done
+            if path.with_name(path.name + ".gz").exists():
+                continue
+            path.unlink(missing_ok=True)
+            await asyncio.to_thread(
+                backup_database,
+                partition.file,
+                path,
+                self.bot.backup_pages_per_step,
+                self.bot.backup_step_sleep,
+                self.cancelled,
+            )
+            backed_up.append(await asyncio.to_thread(compress, path))
+        return backed_up
+
+    @tasks.loop(time=three_am_cst)
+    async def nightly_backup(self):
+        try:
+            await self.run_backup()
+        except Exception:
+            logging.exception("Nightly database backup failed")
+
+    @commands.command(name="backup", description="[Meta] Back up the database now")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def backup_now(self, ctx: commands.Context):
+        """Runs the nightly backup right away"""
+        result = await self.run_backup()
+        await ctx.send(
+            embed=self.bot.embed(
+                title="Backup complete ✅",
+                description=join_lines(
+                    [
+                        f"**File** {result.path}",
+                        f"**Took** {result.duration:.1f}s ({result.restarts} restarts"
+                        + (", finished in one step)" if result.single_step else ")"),
+                        f"**Size** {humanize.naturalsize(result.database_bytes)}"
+                        f" -> {humanize.naturalsize(result.compressed_bytes)} compressed",
+                        f"**Moved partitions** {len(result.partitions)} backed up for the first time",
+                    ]
+                ),
+            )
+        )
+
+
+async def setup(bot):
+    await bot.add_cog(Backup(bot))
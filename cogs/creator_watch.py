@@ -2,6 +2,7 @@
 We have wide variety of content creators that we like to share with one another. This family of commands
 are simply provide links to either the creator's youtube channel, twitch channel, or both.
 """
+import asyncio
 import datetime as dt
 
 import discord
@@ -121,7 +122,8 @@ class CreatorView(discord.ui.View):
 
     @discord.ui.button(label="Youtube", style=discord.ButtonStyle.red)
     async def youtube_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        latest_upload_url = get_latest_youtube_video(self.youtube_channel_id)
+        # The YouTube client is blocking
+        latest_upload_url = await asyncio.to_thread(get_latest_youtube_video, self.youtube_channel_id)
 
         # Send embed, remove view
         assert interaction.message
@@ -173,7 +175,8 @@ class CreatorWatch(commands.Cog):
             )
 
         if youtube_id:
-            return await interaction.response.send_message(get_latest_youtube_video(youtube_id))
+            latest_upload_url = await asyncio.to_thread(get_latest_youtube_video, youtube_id)
+            return await interaction.response.send_message(latest_upload_url)
 
         if twitch_username:
             streamer, stream = await get_streamer(twitch_username)
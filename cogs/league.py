@@ -1,14 +1,18 @@
 import asyncio
 import datetime as dt
 import time
+from collections import Counter
+from typing import Callable
 
 import discord
 from aiohttp.client_exceptions import ClientResponseError
 from discord import app_commands
 from discord.ext import commands
-from pulsefire.caches import DiskCache
+from pulsefire.caches import BaseCache, DiskCache
 from pulsefire.clients import CDragonClient, RiotAPIClient, RiotAPISchema
+from pulsefire.invocation import Invocation
 from pulsefire.middlewares import (
+    MiddlewareCallable,
     cache_middleware,
     http_error_middleware,
     json_response_middleware,
@@ -18,6 +22,7 @@ from pulsefire.ratelimiters import RiotAPIRateLimiter
 from pulsefire.taskgroups import TaskGroup
 
 from goonbot import Goonbot
+from metrics import Sample
 from text_processing import html_to_md
 
 from ._league.calculators import duration
@@ -34,8 +39,67 @@ REGION_NA1 = "na1"
 REGION_AMERICAS = "americas"
 
 
+class CacheStats:
+    """Counts the league cache's hits and misses, by API, for the metrics endpoint"""
+
+    def __init__(self):
+        # (api, "hit" or "miss") -> lookups
+        self.lookups: Counter[tuple[str, str]] = Counter()
+
+    def middleware(self, api: str, cache: BaseCache, rules: list[tuple[Callable[[Invocation], bool], float]]):
+        """
+        pulsefire's cache_middleware, counting lookups for `api`. It was a miss if the request went on to
+        the next middleware. Only endpoints with a rule caching them (ttl above 0) are counted.
+
+        > "Why not count in the cache's get?"
+        cache_middleware looks up every request, even the ones no rule caches, which would all count as misses
+        """
+
+        def ttl_of(invocation: Invocation) -> float:
+            # cache_middleware uses the first rule that matches, and doesn't cache anything else
+            return next((ttl for matches, ttl in rules if matches(invocation)), 0)
+
+        caching = cache_middleware(cache, rules)
+
+        def constructor(next: MiddlewareCallable):
+            # Invocations that weren't in the cache
+            fetched: set[int] = set()
+
+            async def fetch(invocation: Invocation):
+                fetched.add(id(invocation))
+                return await next(invocation)
+
+            cached = caching(fetch)
+
+            async def middleware(invocation: Invocation):
+                try:
+                    return await cached(invocation)
+                finally:
+                    missed = id(invocation) in fetched
+                    fetched.discard(id(invocation))
+                    if ttl_of(invocation) > 0:
+                        self.lookups[api, "miss" if missed else "hit"] += 1
+
+            return middleware
+
+        return constructor
+
+    def collect_metrics(self) -> list[Sample]:
+        samples = []
+        for (api, result), count in self.lookups.items():
+            labels = {"api": api, "result": result}
+            samples.append(Sample("goonbot_league_cache_lookups_total", "Lookups", count, labels, "counter"))
+        for api in sorted({api for api, _ in self.lookups}):
+            hits, misses = self.lookups[api, "hit"], self.lookups[api, "miss"]
+            ratio = hits / (hits + misses)
+            samples.append(Sample("goonbot_league_cache_hit_ratio", "Hits over lookups", ratio, {"api": api}))
+        return samples
+
+
 cache = DiskCache("cache")
-riot_cache_middleware = cache_middleware(
+cache_stats = CacheStats()
+riot_cache_middleware = cache_stats.middleware(
+    "riot",
     cache,
     [
         (lambda inv: inv.invoker.__name__ == "get_lol_summoner_v4_by_name", duration(days=1)),  # type: ignore
@@ -45,7 +109,8 @@ riot_cache_middleware = cache_middleware(
     ],
 )
 
-cdragon_cache_middleware = cache_middleware(
+cdragon_cache_middleware = cache_stats.middleware(
+    "cdragon",
     cache,
     [
         # Get champion pool
@@ -80,6 +145,12 @@ class League(commands.Cog):
             ],
         )
 
+    async def cog_load(self):
+        self.bot.metrics.collectors["league_cache"] = cache_stats.collect_metrics
+
+    async def cog_unload(self):
+        self.bot.metrics.collectors.pop("league_cache", None)
+
     async def get_summoner(self, riot_username: str) -> RiotAPISchema.LolSummonerV4Summoner | None:
         game_name, tag_line = riot_username.split("#")
         async with self.client_lock:
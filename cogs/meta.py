@@ -3,10 +3,12 @@ import datetime as dt
 import logging
 import os
 import pathlib
-import platform
+import sqlite3
 import time
+from collections import Counter
+from contextlib import closing, suppress
+from typing import NamedTuple
 
-import aiosqlite
 import discord
 import humanize
 from dateutil import tz
@@ -19,48 +21,29 @@ from text_processing import join_lines
 eight_am_cst = dt.time(hour=8, minute=0, second=0, tzinfo=tz.gettz("America/Chicago"))
 
 
-async def get_cache_file_count() -> int | None:
-    """
-    The diskcache used for Pulsefire is made up of a series of directories, eaching having a database
-    file. This function returns the count of these directories, if any.
-    """
-    cache_dir_path = pathlib.Path("cache")
-    if not cache_dir_path.exists():
-        return None
-    cache_files = [file for file in cache_dir_path.glob("*") if file.is_dir()]
-    return len(cache_files)
+# Pulsefire's DiskCache is a series of directories, each having a database file (cache/001/cache.db)
+LEAGUE_CACHE_DIR = pathlib.Path("cache")
 
 
-async def matches_cached(path: str) -> list[str]:
-    """
-    The diskcache used for Pulsefire is made up of a series of directories, eaching having a database
-    file. This function takes the path to one of these database files and returns a list rows, each
-    row being a cached league match.
-    """
-    async with aiosqlite.connect(path) as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT key FROM Cache")
-            keys = await cur.fetchall()
-            keys = [key for key in keys if "match/v5/matches" in key[0]]
-    return [key[0] for key in keys]
+class ShardCount(NamedTuple):
+    # Latest mtime of the shard's database & WAL files when it was counted
+    modified: float
+    matches: int
 
 
-async def total_league_matches_cached(cache_file_count: int) -> int:
-    """
-    In congution with the `matches_cached` function, this function takes the count of cache files
-    (provided by `get_cache_file_count`) and returns the total number of league matches cached across
-    all of them.
-    """
-    all_links = []
-    for n in range(cache_file_count):
-        # The database file path format "cache/001/cache.db"
-        path = f"cache/{n:03}/cache.db"
-        all_links.extend(await matches_cached(path))
+def shard_modified(path: pathlib.Path) -> float:
+    """When a shard was last written to. Writes land in the WAL first, so that's checked too"""
+    wal = path.with_name(path.name + "-wal")
+    return max(path.stat().st_mtime, wal.stat().st_mtime if wal.exists() else 0)
+
 
-    # At time of writing, the cache doesn't store duplicate entries.
-    # In the event the pulsefire author implements some sort of redundancy, let's make sure
-    # we're only counting unique matches
-    return len(set(all_links))
+def count_matches_cached(path: pathlib.Path) -> int:
+    """Cached league matches in one shard. Blocking, ran in a thread"""
+    with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+        conn.execute("PRAGMA busy_timeout = 5000")
+        # Keys are the request urls, so matches are the ones with this in them
+        query = "SELECT COUNT(DISTINCT key) FROM Cache WHERE instr(key, 'match/v5/matches') > 0"
+        return conn.execute(query).fetchone()[0]
 
 
 def format_uptime(uptime_in_seconds: int) -> str:
@@ -85,50 +68,8 @@ def format_uptime(uptime_in_seconds: int) -> str:
     return f"{days} {'day' if days == 1 else 'days'},\n" + formatted_time
 
 
-def get_host_info() -> dict[str, str]:
-    info = {}
-    # info["Hostname"] = platform.node() # this just says "raspberry"
-    info["Model"] = "[RPi 4B](https://www.raspberrypi.com/products/raspberry-pi-4-model-b/)"
-    info["Kernel"] = f"{platform.system()} {platform.release()}"  # Linux 0.00.00-v0+
-    issue_file = pathlib.Path("/etc/issue")
-    if issue_file.exists():
-        # The issue file on raspberry Pi has artifacts which aren't removed by str.strip()
-        issue_file_text = issue_file.read_text()
-        info["OS"] = issue_file_text[: -issue_file_text.find("Linux")]  # Debian GNU/Linux
-    return info
-
-
-async def get_last_commit_time() -> dt.datetime | None:
-    # Run the Git command to get the timestamp of the last commit
-    process = await asyncio.create_subprocess_shell(
-        "git log -1 --format=%ct",
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-
-    # Wait for the command to finish
-    stdout, _ = await process.communicate()
-
-    # Check for errors
-    if process.returncode != 0:
-        print("Error: Unable to retrieve last commit time. Are you in a Git repository?")
-        return None
-
-    # Extract the timestamp
-    commit_timestamp = int(stdout.strip())
-
-    # Convert to a datetime object
-    return dt.datetime.fromtimestamp(commit_timestamp)
-
-
-async def time_since_last_commit():
-    last_commit_time = await get_last_commit_time()
-    if last_commit_time:
-        now = dt.datetime.now()
-        time_difference = now - last_commit_time
-        return humanize.naturaltime(time_difference)
-    else:
-        print("Could not determine time since last commit.")
+# Model isn't something Linux can tell us
+PI_MODEL = "[RPi 4B](https://www.raspberrypi.com/products/raspberry-pi-4-model-b/)"
 
 
 class Meta(commands.Cog):
@@ -136,43 +77,70 @@ class Meta(commands.Cog):
         self.bot = bot
         self.db_size_check.start()
 
+        # League matches cached, counted in the background so /meta doesn't have to open every shard
+        self.shard_counts: dict[pathlib.Path, ShardCount] = {}
+        self.matches_cached: int | None = None
+        self.matches_counted_at: dt.datetime | None = None
+        self.count_league_cache.start()
+        self.watch_build_info.start()
+
+        # Commands served, counted in memory and flushed every minute (and on shutdown). Loaded in cog_load
+        self.commands_served = 0
+        self.command_counts: Counter[str] = Counter()
+        # Counted since the last flush
+        self.unflushed: Counter[str] = Counter()
+
         # Get precise timestamp for uptime
         self.startup_time = time.perf_counter()
 
     async def cog_load(self):
-        await self.ensure_command_usage_legacy_table()
-
-    async def ensure_command_usage_legacy_table(self):
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS command_usage_legacy (
-                    id INTEGER PRIMARY KEY,
-                    count INTEGER
+        row = await self.bot.database.fetchone("SELECT count FROM command_usage_legacy WHERE id = 1")
+        self.commands_served = row[0] if row else 0
+        self.command_counts = Counter(
+            dict(await self.bot.database.fetchall("SELECT name, count FROM command_usage_count"))
+        )
+        self.flush_command_counts.start()
+
+    async def cog_unload(self):
+        # Called as the bot shuts down, so the last minute of commands isn't lost
+        task = self.flush_command_counts.get_task()
+        self.flush_command_counts.cancel()
+        # Waited on so a flush it was in the middle of has put its counts back (see flush_counts) first
+        if task:
+            with suppress(asyncio.CancelledError):
+                await task
+        await self.flush_counts()
+
+    async def flush_counts(self):
+        """Adds the commands counted since the last flush to the database"""
+        if not self.unflushed:
+            return
+        # Swapped out first, commands finishing mid-flush count towards the next one
+        unflushed, self.unflushed = self.unflushed, Counter()
+        committed = False
+        try:
+            async with self.bot.database.transaction() as db:
+                await db.execute(
+                    "UPDATE command_usage_legacy SET count = count + ? WHERE id = 1",
+                    (unflushed.total(),),
                 )
-                """
-            )
-
-            # Create the single row, with id 1, value of 0
-            # Existing row error ignored
-            await db.execute(
-                """
-                INSERT OR IGNORE INTO command_usage_legacy (id, count) 
-                VALUES (1, 0)
-                """
-            )
-            await db.commit()
-
-    async def get_count(self):
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            async with db.execute("SELECT count FROM command_usage_legacy WHERE id = 1") as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else 0
-
-    async def increment_count(self):
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            await db.execute("UPDATE command_usage_legacy SET count = count + 1 WHERE id = 1")
-            await db.commit()
+                await db.executemany(
+                    "INSERT INTO command_usage_count (name, count) VALUES (?, ?)"
+                    " ON CONFLICT (name) DO UPDATE SET count = count + excluded.count",
+                    list(unflushed.items()),
+                )
+            committed = True
+        finally:
+            # Try again next flush. Also when cancelled, which isn't an Exception
+            if not committed:
+                self.unflushed.update(unflushed)
+
+    @tasks.loop(minutes=1)
+    async def flush_command_counts(self):
+        try:
+            await self.flush_counts()
+        except Exception:
+            logging.exception("Couldn't flush command counts")
 
     @commands.Cog.listener("on_app_command_completion")
     async def counter_ticker(self, interaction: discord.Interaction, command: app_commands.Command):
@@ -182,8 +150,9 @@ class Meta(commands.Cog):
             if interaction.guild == self.bot.BOTTING_TOGETHER:
                 return
 
-        # Inc commands processed file
-        await self.increment_count()
+        self.commands_served += 1
+        self.command_counts[command.qualified_name] += 1
+        self.unflushed[command.qualified_name] += 1
 
     @app_commands.command(name="meta")
     async def meta(self, interaction: discord.Interaction):
@@ -204,8 +173,7 @@ class Meta(commands.Cog):
         meta_embed.add_field(name="Total\nCommands", value=total_commands)
 
         # Commands served
-        amount = await self.get_count()
-        meta_embed.add_field(name="Commands\nServed (6.0)", value=f"{amount:,}")
+        meta_embed.add_field(name="Commands\nServed (6.0)", value=f"{self.commands_served:,}")
 
         # Bot uptime
         now = time.perf_counter()
@@ -216,17 +184,22 @@ class Meta(commands.Cog):
         meta_embed.add_field(name="Latency", value=f"{round(self.bot.latency * 1000, 2)}ms")
 
         # League matches cached
-        if cache_file_count := await get_cache_file_count():
-            matches_cached_count = await total_league_matches_cached(cache_file_count)
+        if self.matches_cached is not None and self.matches_counted_at:
+            counted = humanize.naturaltime(dt.datetime.now() - self.matches_counted_at)
             meta_embed.add_field(
                 name="League Games\nCached",
-                value=matches_cached_count,
+                value=f"{self.matches_cached:,}\n({counted})",
             )
 
+        # Commands served, broken down
+        if self.command_counts:
+            most_used = [f"/{name} {count:,}" for name, count in self.command_counts.most_common(5)]
+            meta_embed.add_field(name="Most\nUsed", value=join_lines(most_used))
+
         # Host info
         meta_embed.add_field(
             name="Hosted on Raspberry Pi <:rpi:1194061870831763486>",
-            value=join_lines([f"**{name}** {value}" for name, value in get_host_info().items()]),
+            value=join_lines([f"**{name}** {value}" for name, value in self.host_info().items()]),
             inline=False,
         )
 
@@ -243,13 +216,59 @@ class Meta(commands.Cog):
             meta_embed.set_thumbnail(url=self.bot.user.avatar.url)
 
         # Set footer (last commit time)
-        meta_embed.set_footer(
-            text=f"Last commit: {await time_since_last_commit()}",
-        )
+        if commit_time := self.bot.build_info.info.commitTime:
+            last_commit = humanize.naturaltime(dt.datetime.now() - commit_time)
+            meta_embed.set_footer(text=f"Last commit: {last_commit}")
 
         # Send it
         await interaction.response.send_message(embed=meta_embed)
 
+    def host_info(self) -> dict[str, str]:
+        build_info = self.bot.build_info.info
+        # "Hostname" just says "raspberry"
+        info = {"Model": PI_MODEL, "Kernel": build_info.kernel}
+        if build_info.os:
+            info["OS"] = build_info.os
+        return info
+
+    @tasks.loop(minutes=1)
+    async def watch_build_info(self):
+        """Picks up a new commit if the bot was updated in place (pulled without restarting)"""
+        if await asyncio.to_thread(self.bot.build_info.refresh_if_changed):
+            logging.info(f"Now running {self.bot.build_info.info}")
+
+    @tasks.loop(minutes=10)
+    async def count_league_cache(self):
+        """
+        Recounts the league matches cached, only opening shards that were written to since the last count.
+        Shards are counted concurrently, each in its own thread.
+
+        > "Why not just count them in /meta?"
+        Every shard was opened one after another, and every key pulled into Python to be filtered. The cache
+        only grows, so /meta got a little slower every week.
+        """
+        try:
+            shards = {path: shard_modified(path) for path in LEAGUE_CACHE_DIR.glob("*/cache.db")}
+            stale = [
+                path
+                for path, modified in shards.items()
+                if path not in self.shard_counts or self.shard_counts[path].modified != modified
+            ]
+            counts = await asyncio.gather(*[asyncio.to_thread(count_matches_cached, path) for path in stale])
+        except (OSError, sqlite3.Error):
+            logging.exception("Couldn't count the league matches cached")
+            return
+
+        for path, matches in zip(stale, counts):
+            self.shard_counts[path] = ShardCount(shards[path], matches)
+        # Shards that were deleted
+        for path in self.shard_counts.keys() - shards.keys():
+            del self.shard_counts[path]
+
+        # A key only ever lives in the shard it hashes to, so the shard counts don't overlap
+        self.matches_cached = sum(count.matches for count in self.shard_counts.values()) if shards else None
+        self.matches_counted_at = dt.datetime.now()
+
     @tasks.loop(time=eight_am_cst)
     async def db_size_check(self):
         """Log database size, message josh if database exceeds limit"""
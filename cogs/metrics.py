@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import time
+import tracemalloc
+
+import humanize
+from discord.ext import commands, tasks
+
+import memory
+import metrics
+from goonbot import Goonbot
+from text_processing import md_codeblock
+
+
+def format_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return "-"
+    return f"{seconds * 1000:.0f}ms" if seconds < 10 else f"{seconds:.0f}s"
+
+
+def latency_row(label: str, histogram: metrics.Histogram) -> str:
+    percentiles = [format_seconds(histogram.quantile(q)) for q in (0.5, 0.95, 0.99)]
+    return f"{label:<18}{histogram.count:>6}" + "".join(f"{p:>8}" for p in percentiles)
+
+
+class Metrics(commands.Cog):
+    """
+    Saves the app command latency histograms (Goonbot.metrics, see metrics.py) every minute, loads them back
+    on startup, and shows them with `.latency`. Also home to the other owner diagnostics, `.stalls` and `.mem`
+    """
+
+    def __init__(self, bot: Goonbot):
+        self.bot = bot
+        # Latest tracemalloc snapshot, what `.mem diff` compares against
+        self.memory_snapshot: tracemalloc.Snapshot | None = None
+        # When expired slices were last deleted from the database, 0 so the first save does
+        self.pruned_at = 0.0
+
+    async def cog_load(self):
+        since = metrics.slice_of(time.time() - max(metrics.WINDOWS.values()))
+        self.bot.metrics.load(await self.bot.database.fetchall(metrics.SELECT_SLICES, (since,)))
+        self.save_metrics.start()
+
+    async def cog_unload(self):
+        # Called as the bot shuts down, so the last minute of timings isn't lost
+        self.save_metrics.cancel()
+        await self.save()
+
+    async def save(self):
+        self.bot.metrics.prune()
+        rows = self.bot.metrics.take_dirty()
+        now = time.time()
+        prune = now - self.pruned_at >= metrics.PRUNE_SECONDS
+        # No commands in the last minute, no need for the write lock
+        if not rows and not prune:
+            return
+        try:
+            async with self.bot.database.transaction() as db:
+                if rows:
+                    await db.executemany(metrics.UPSERT_SLICE, rows)
+                if prune:
+                    expired = metrics.slice_of(now - metrics.RETENTION_SECONDS)
+                    await db.execute(metrics.DELETE_EXPIRED, (expired,))
+            if prune:
+                self.pruned_at = now
+        except Exception:
+            # Try again next save
+            self.bot.metrics.dirty.update((command, phase, start) for command, phase, start, *_ in rows)
+            raise
+
+    @tasks.loop(minutes=1)
+    async def save_metrics(self):
+        try:
+            await self.save()
+        except Exception:
+            logging.exception("Couldn't save command latency metrics")
+
+    @commands.command(name="latency", description="[Meta] App command latency percentiles")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def latency(self, ctx: commands.Context, command: str | None = None):
+        """
+        Without a command, every command's total time over the last 24h.
+        With one (`.latency aram`), each phase of that command over every window.
+        """
+        registry = self.bot.metrics
+        header = f"{'':<18}{'n':>6}{'p50':>8}{'p95':>8}{'p99':>8}"
+        if command is None:
+            title = "Command latency, last 24h"
+            histograms = [
+                (name, registry.window(name, "total", metrics.WINDOWS["24h"])) for name in registry.commands()
+            ]
+            histograms.sort(key=lambda item: item[1].count, reverse=True)
+            rows = [latency_row(name, histogram) for name, histogram in histograms if histogram.count]
+        else:
+            command = command.removeprefix("/")
+            title = f"/{command} latency"
+            rows = []
+            for phase in metrics.PHASES:
+                for window, seconds in metrics.WINDOWS.items():
+                    histogram = registry.window(command, phase, seconds)
+                    if histogram.count:
+                        rows.append(latency_row(f"{phase} {window}", histogram))
+
+        await ctx.send(
+            embed=self.bot.embed(
+                title=title,
+                description=md_codeblock("\n".join([header, *rows])) if rows else "Nothing timed yet",
+            )
+        )
+
+    @commands.command(name="stalls", description="[Meta] Recent event loop stalls")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def stalls(self, ctx: commands.Context, number: int | None = None):
+        """
+        Recent times something blocked the event loop (see loop_watchdog.py), newest first.
+        `.stalls 1` shows the whole stack of the newest one.
+        """
+        stalls = list(reversed(self.bot.watchdog.stalls))
+        if not stalls:
+            return await ctx.send(embed=self.bot.embed(title="No stalls 🎉"))
+
+        if number is not None:
+            if not 1 <= number <= len(stalls):
+                return await ctx.send(f"There are only {len(stalls)} stalls.")
+            stall = stalls[number - 1]
+            # Innermost frames are the interesting ones, so anything cut off is from the start
+            stack = "".join(stall.stack)[-3900:]
+            return await ctx.send(
+                embed=self.bot.embed(
+                    title=f"{stall.duration:.2f}s in {stall.command or 'unknown command'}",
+                    description=md_codeblock(stack, "py"),
+                ).set_footer(text=f"{stall.at:%Y-%m-%d %H:%M:%S}")
+            )
+
+        lines = []
+        for i, stall in enumerate(stalls[:20], start=1):
+            # Last line of the innermost frame, usually the blocking call itself
+            culprit = stall.stack[-1].strip().splitlines()[-1] if stall.stack else ""
+            lines.append(f"{i:>2}. {stall.at:%m-%d %H:%M:%S} {stall.duration:>6.2f}s {stall.command or '?'}")
+            lines.append(f"      {culprit[:70]}")
+        await ctx.send(
+            embed=self.bot.embed(
+                title=f"Event loop stalls ({self.bot.watchdog.stall_count} since startup)",
+                description=md_codeblock("\n".join(lines)),
+            )
+        )
+
+    # With invoke_without_command the group's checks don't run before a subcommand, each has its own
+    @commands.group(name="mem", description="[Meta] Memory growth", invoke_without_command=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def mem(self, ctx: commands.Context):
+        """`.mem start`, `.mem snap`, `.mem diff`, `.mem stop`, see memory.py. On its own, just the summary"""
+        await ctx.send(embed=self.memory_embed("Memory"))
+
+    @mem.command(name="start")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def mem_start(self, ctx: commands.Context):
+        if tracemalloc.is_tracing():
+            return await ctx.send("Already tracing, `.mem stop` first to start over.")
+        tracemalloc.start(memory.TRACE_FRAMES)
+        self.memory_snapshot = await asyncio.to_thread(memory.take_snapshot)
+        await ctx.send(embed=self.memory_embed("Tracing allocations from now on, `.mem diff` later"))
+
+    @mem.command(name="stop")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def mem_stop(self, ctx: commands.Context):
+        tracemalloc.stop()
+        self.memory_snapshot = None
+        await ctx.send(embed=self.memory_embed("Stopped tracing"))
+
+    @mem.command(name="snap")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def mem_snap(self, ctx: commands.Context):
+        """The biggest allocation sites right now, also the new baseline for `.mem diff`"""
+        if not tracemalloc.is_tracing():
+            return await ctx.send("Not tracing, `.mem start` first.")
+        self.memory_snapshot = await asyncio.to_thread(memory.take_snapshot)
+        sites = await asyncio.to_thread(memory.top_sites, self.memory_snapshot)
+        rows = [f"{humanize.naturalsize(site.size):>10} {site.count:>9,}  {site.location}" for site in sites]
+        header = f"{'size':>10} {'blocks':>9}  site"
+        await ctx.send(embed=self.memory_embed("Biggest allocation sites", [header, *rows], cog_objects=True))
+
+    @mem.command(name="diff")
+    @commands.is_owner()
+    @commands.dm_only()
+    async def mem_diff(self, ctx: commands.Context):
+        """Which allocation sites grew the most since the last snapshot (`.mem start`, `snap`, or `diff`)"""
+        if not tracemalloc.is_tracing() or self.memory_snapshot is None:
+            return await ctx.send("Not tracing, `.mem start` first.")
+        previous = self.memory_snapshot
+        self.memory_snapshot = await asyncio.to_thread(memory.take_snapshot)
+        sites = await asyncio.to_thread(memory.top_growth, previous, self.memory_snapshot)
+        rows = [
+            f"{'+' + humanize.naturalsize(site.size_diff):>11} {site.count_diff:>+9,}  {site.location}"
+            for site in sites
+        ]
+        header = f"{'growth':>11} {'blocks':>9}  site"
+        if not rows:
+            embed = self.memory_embed("Nothing grew since the last snapshot", cog_objects=True)
+            return await ctx.send(embed=embed)
+        title = "Allocation growth since the last snapshot"
+        await ctx.send(embed=self.memory_embed(title, [header, *rows], cog_objects=True))
+
+    def memory_embed(self, title: str, rows: list[str] | None = None, cog_objects: bool = False):
+        """`cog_objects` walks the cogs' objects on the loop (memory.cog_objects), so only snap and diff do"""
+        embed = self.bot.embed(title=title)
+        if rows:
+            # Sites are the interesting part, the summary goes below them
+            embed.description = md_codeblock("\n".join(rows))
+
+        summary = [f"Peak RSS {humanize.naturalsize(memory.peak_rss())}"]
+        if (rss := memory.rss()) is not None:
+            summary.insert(0, f"RSS {humanize.naturalsize(rss)}")
+        if tracemalloc.is_tracing():
+            traced, peak = tracemalloc.get_traced_memory()
+            summary.append(f"Traced {humanize.naturalsize(traced)} (peak {humanize.naturalsize(peak)})")
+        embed.add_field(name="Process", value="\n".join(summary), inline=False)
+
+        generations = [
+            f"gen{i}: {count:,} pending, {collections:,} collections, {collected:,} collected"
+            for i, (count, collections, collected) in enumerate(memory.gc_generations())
+        ]
+        embed.add_field(name="gc", value=md_codeblock("\n".join(generations)), inline=False)
+        if not cog_objects:
+            return embed
+
+        # Everything reachable from the bot's connection state is shared, not held by one cog
+        shared = [self.bot, self.bot._connection, self.bot.http, self.bot.database, self.bot.metrics]
+        cogs = dict(self.bot.cogs)
+        counts = memory.cog_objects(cogs, shared)
+        limit = memory.cog_limit(cogs)
+        # Field values cap out at 1024 characters
+        cog_rows = [
+            f"{name:<20}{count:>9,}{'+' if count >= limit else ''}"
+            for name, count in list(counts.items())[:20]
+        ]
+        embed.add_field(name="Objects held per cog", value=md_codeblock("\n".join(cog_rows)), inline=False)
+        return embed
+
+
+async def setup(bot):
+    await bot.add_cog(Metrics(bot))
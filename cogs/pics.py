@@ -1,3 +1,4 @@
+import asyncio
 import pathlib
 
 import discord
@@ -8,6 +9,11 @@ from bex_tools import CycleRandom
 from goonbot import Goonbot
 
 
+def append_link(file_path: str, link: str):
+    with open(file_path, mode="a") as file:
+        file.write(f"\n{link}")
+
+
 class Pics(commands.Cog):
     # > Why not have a generator here? it'd be much more memory efficient
     # Because users can add new images on the fly, I want them to be able to add images directly into the live queue of images
@@ -44,8 +50,7 @@ class Pics(commands.Cog):
                 file_path += f"{categories.value}.txt"
                 self.paranormal_links.items.append(link)
 
-        with open(file_path, mode="a") as file:
-            file.write(f"\n{link}")
+        await asyncio.to_thread(append_link, file_path, link)
 
         await interaction.response.send_message(
             embed=self.bot.embed(
@@ -0,0 +1,162 @@
+import asyncio
+import datetime as dt
+import json
+import logging
+import time
+
+import discord
+import humanize
+from discord import app_commands
+from discord.ext import commands, tasks
+
+import analytics
+import archive
+import recap
+from goonbot import Goonbot
+from text_processing import join_lines
+
+
+class Recap(commands.Cog):
+    """
+    /recap, this year's server wide recap or your own
+
+    > "Why not just run the recap when someone asks?"
+    Counting a year of the archive on the Pi takes a while, and the interaction has to be responded to
+    within 3 seconds. So recaps are served from a snapshot (recap_cache, see recap.py), which a background
+    task refreshes every 15 minutes, only recounting users who have done something since the last refresh.
+    Using the command is a single primary key lookup.
+
+    Counting is done against the analytics copy of the database (see analytics.py), which is retaken before
+    a refresh once it's `Goonbot.analytics_snapshot_minutes` old. So recaps are as of that snapshot, which is
+    what the footer shows.
+    """
+
+    def __init__(self, bot: Goonbot):
+        self.bot = bot
+        # recap.py reads the analytics copy through its own (blocking) connections
+        recap.db_path = self.bot.analytics_path
+        recap.cache_path = self.bot.database_path
+
+    async def cog_load(self):
+        self.refresh_snapshot.start()
+
+    async def cog_unload(self):
+        self.refresh_snapshot.cancel()
+
+    @tasks.loop(minutes=15)
+    async def refresh_snapshot(self):
+        try:
+            await self.refresh()
+        except Exception:
+            logging.exception("Recap snapshot refresh failed")
+
+    async def refresh(self):
+        start = time.perf_counter()
+        year = dt.datetime.now().year
+        age = await asyncio.to_thread(analytics.snapshot_age, self.bot.analytics_path)
+        if age is None or age > dt.timedelta(minutes=self.bot.analytics_snapshot_minutes):
+            await asyncio.to_thread(analytics.take_snapshot, self.bot.database_path, self.bot.analytics_path)
+            logging.info(f"Took an analytics snapshot in {time.perf_counter() - start:.2f}s")
+        marks = dict(await self.bot.database.fetchall("SELECT source, lastID FROM recap_state"))
+
+        # Counting happens in a thread, only the (small) snapshot write goes through the shared connection
+        snapshot = await asyncio.to_thread(recap.refresh_snapshot, year, marks)
+        # createdAt is how current the recap is, so the snapshot's age
+        created_at = snapshot.takenAt or archive.now_ms()
+        async with self.bot.database.transaction() as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO recap_cache (userID, year, recap, createdAt) VALUES (?, ?, ?, ?)",
+                [(*row, created_at) for row in snapshot.recaps],
+            )
+            await db.executemany(
+                "INSERT OR REPLACE INTO recap_state (source, lastID) VALUES (?, ?)",
+                list(snapshot.marks.items()),
+            )
+
+        elapsed = time.perf_counter() - start
+        # One of the recaps is the server's, the rest are users
+        recounted = len(snapshot.recaps) - 1
+        logging.info(f"Refreshed recap snapshot ({recounted} user(s) recounted) in {elapsed:.2f}s")
+
+    @app_commands.command(name="recap", description="Goon HQ's year in review")
+    @app_commands.describe(who="The whole server's recap, or just yours")
+    @app_commands.choices(
+        who=[
+            app_commands.Choice(name="Server", value="server"),
+            app_commands.Choice(name="Me", value="me"),
+        ]
+    )
+    async def recap_command(
+        self,
+        interaction: discord.Interaction,
+        who: app_commands.Choice[str] | None = None,
+    ):
+        """Goon HQ's year in review!"""
+        year = dt.datetime.now().year
+        mine = who is not None and who.value == "me"
+        user_id = interaction.user.id if mine else recap.SERVER
+
+        row = await self.bot.database.fetchone(
+            "SELECT recap, createdAt FROM recap_cache WHERE userID = ? AND year = ?",
+            (user_id, year),
+        )
+        if row is None:
+            return await interaction.response.send_message(
+                embed=self.bot.embed(
+                    title="No recap yet",
+                    description="Check back later, recaps are updated every 15 minutes.",
+                    color=discord.Color.greyple(),
+                ),
+                ephemeral=True,
+            )
+
+        snapshot, created_at = json.loads(row[0]), row[1]
+        if mine:
+            embed = self.user_embed(interaction.user, year, snapshot)
+        else:
+            embed = self.server_embed(year, snapshot)
+        updated = dt.datetime.fromtimestamp(created_at / 1000)
+        embed.set_footer(text=f"As of {humanize.naturaltime(dt.datetime.now() - updated)}")
+        await interaction.response.send_message(embed=embed)
+
+    def server_embed(self, year: int, snapshot: dict) -> discord.Embed:
+        days = (dt.datetime.now() - dt.datetime(year, 1, 1)).days or 1
+        lines = [
+            f"**Messages** {snapshot['messages']:,} ({round(snapshot['messages'] / days, 1)} a day)",
+            f"**Commands** {snapshot['commands']:,}",
+            f"**Reactions** {snapshot['reactions']:,}",
+        ]
+        if snapshot["busiestDay"]:
+            day, count = snapshot["busiestDay"]
+            lines.append(f"**Busiest day** {dt.date.fromisoformat(day):%B %d} ({count:,} messages)")
+
+        embed = self.bot.embed(title=f"Goon HQ's {year} recap", description=join_lines(lines))
+        for name, key, label in [
+            ("Top chatters", "topChatters", "<@{}>"),
+            ("Top reactions", "topReactions", "{}"),
+            ("Top commands", "topCommands", "/{}"),
+        ]:
+            ranking = [f"{label.format(item)} {count:,}" for item, count in snapshot[key]]
+            embed.add_field(name=name, value=join_lines(ranking) or "-")
+        return embed
+
+    def user_embed(self, user: discord.User | discord.Member, year: int, snapshot: dict) -> discord.Embed:
+        lines = [f"**Messages** {snapshot['messages']:,}"]
+        if snapshot["topChannel"]:
+            lines.append(f"**Top channel** <#{snapshot['topChannel']}> ({snapshot['topChannelCount']:,})")
+        lines.append(f"**Commands** {snapshot['commands']:,}")
+        if snapshot["favoriteCommand"]:
+            command, count = snapshot["favoriteCommand"], snapshot["favoriteCommandCount"]
+            lines.append(f"**Favorite command** /{command} ({count:,})")
+        lines.append(f"**Reactions** {snapshot['reactions']:,}")
+        if favorite_reactions := snapshot["favoriteReactions"]:
+            favorites = ", ".join(f"{reaction} ({count:,})" for reaction, count in favorite_reactions)
+            lines.append(f"**Favorite reactions** {favorites}")
+
+        embed = self.bot.embed(title=f"{user.display_name}'s {year} recap", description=join_lines(lines))
+        embed.set_thumbnail(url=user.display_avatar.url)
+        return embed
+
+
+async def setup(bot):
+    await bot.add_cog(Recap(bot))
@@ -1,6 +1,5 @@
 import datetime as dt
 
-import aiosqlite
 import discord
 import humanize
 from discord import app_commands
@@ -36,26 +35,6 @@ class SuggestionBox(commands.Cog):
     def __init__(self, bot: Goonbot):
         self.bot = bot
 
-    async def cog_load(self):
-        await self.ensure_suggestion_table()
-
-    async def ensure_suggestion_table(self):
-        async with aiosqlite.connect(self.bot.database_path) as db:
-            # Ensure "suggestion" table exists
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS suggestion (
-                    id INTEGER PRIMARY KEY,
-                    userID INTEGER,
-                    details TEXT,
-                    devNotes TEXT,
-                    timestamp TEXT
-                )
-                """
-            )
-            # Commit changes
-            await db.commit()
-
     @app_commands.command(name="suggest", description="Suggest a feature or improvement")
     async def suggest(self, interaction: discord.Interaction):
         # Present modal
@@ -72,15 +51,13 @@ class SuggestionBox(commands.Cog):
         timestamp = dt.datetime.now().isoformat()
 
         # Make entry in database
-        async with aiosqlite.connect(Goonbot.database_path) as db:
-            await db.execute(
-                """
-                INSERT INTO suggestion (id, userID, details, devNotes, timestamp) 
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (interaction.id, interaction.user.id, details, None, timestamp),
-            )
-            await db.commit()
+        await self.bot.database.execute(
+            """
+            INSERT INTO suggestion (id, userID, details, devNotes, timestamp) 
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (interaction.id, interaction.user.id, details, None, timestamp),
+        )
 
         # Alert owner of new suggestion
         assert self.bot.owner_id
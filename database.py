@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Iterable, Sequence
+
+import aiosqlite
+
+import archive
+
+
+class Database:
+    """
+    The single, long-lived connection to gbdb.sqlite that every cog goes through.
+
+    Created (and connected) in `Goonbot.setup_hook`, closed when the bot shuts down.
+
+    > "Why not just aiosqlite.connect() wherever it's needed?"
+    Every aiosqlite connection spins up its own thread and opens the database file from scratch, so
+    connection setup ended up being a big chunk of each write. One connection also means sqlite's
+    prepared statement cache actually gets reused.
+
+    Writes go through a lock, so two cogs can't interleave statements inside each other's transactions.
+    Reads skip the lock, aiosqlite already runs everything on the connection's thread one at a time.
+    """
+
+    # Applied to the connection once it's opened
+    PRAGMAS = {
+        # Readers don't block the writer (and vice versa), and commits are appends to the WAL
+        "journal_mode": "WAL",
+        # With WAL, NORMAL only syncs on checkpoint. Still safe from corruption, just not durable across power loss
+        "synchronous": "NORMAL",
+        # Wait on locks held by other processes (recap, backups) instead of failing right away
+        "busy_timeout": 5000,
+        # Negative means KiB, so ~16MB of page cache
+        "cache_size": -16_000,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    }
+
+    # How many prepared statements sqlite3 keeps around for reuse
+    CACHED_STATEMENTS = 256
+
+    def __init__(self, path: str):
+        self.path = path
+        self.write_lock = asyncio.Lock()
+        self._connection: aiosqlite.Connection | None = None
+
+    @property
+    def connection(self) -> aiosqlite.Connection:
+        if self._connection is None:
+            raise RuntimeError("Database hasn't been connected yet, call Database.connect() first")
+        return self._connection
+
+    async def connect(self) -> None:
+        self._connection = await aiosqlite.connect(self.path, cached_statements=self.CACHED_STATEMENTS)
+        for pragma, value in self.PRAGMAS.items():
+            await self._connection.execute(f"PRAGMA {pragma} = {value}")
+
+        # Finished years of messages can live in their own file (see archive.py)
+        partitions = [archive.MessagePartition(*row) for row in await self.fetchall(archive.SELECT_PARTITIONS)]
+        for statement in archive.attach_statements(partitions):
+            await self._connection.execute(statement)
+        logging.info(f"Connected to {self.path}")
+
+    async def close(self) -> None:
+        if self._connection is None:
+            return
+        async with self.write_lock:
+            # Fold the WAL back into the main file, so backups of the .sqlite file alone are complete
+            await self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await self._connection.close()
+            self._connection = None
+        logging.info(f"Closed {self.path}")
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Hold the write lock for several statements, which are committed together (or rolled back on error)
+
+        Example
+        ```py
+        async with bot.database.transaction() as db:
+            await db.execute(...)
+            await db.executemany(...)
+        ```
+        """
+        async with self.write_lock:
+            try:
+                yield self.connection
+            except BaseException:
+                await self.connection.rollback()
+                raise
+            else:
+                await self.connection.commit()
+
+    async def execute(self, sql: str, parameters: Sequence[Any] = ()) -> None:
+        """Run and commit a single write"""
+        async with self.transaction() as db:
+            await db.execute(sql, parameters)
+
+    async def executemany(self, sql: str, parameters: Iterable[Sequence[Any]]) -> None:
+        """Run and commit a single write, once for each set of parameters"""
+        async with self.transaction() as db:
+            await db.executemany(sql, parameters)
+
+    async def fetchone(self, sql: str, parameters: Sequence[Any] = ()) -> aiosqlite.Row | None:
+        async with self.connection.execute(sql, parameters) as cursor:
+            return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, parameters: Sequence[Any] = ()) -> list[aiosqlite.Row]:
+        async with self.connection.execute(sql, parameters) as cursor:
+            return list(await cursor.fetchall())
@@ -1,10 +1,12 @@
 import asyncio
+import datetime as dt
+import io
 import logging
+import os
 import random
 import re
-import time
+import threading
 import traceback
-from collections import defaultdict
 from functools import partial
 from pathlib import Path
 from typing import Iterator, Literal
@@ -13,8 +15,14 @@ import discord
 import humanize
 from discord.ext import commands
 
-from bex_tools import frontloaded_batched
+import log_reader
+import migrations
+import profiler
+from build_info import BuildInfoProvider
+from database import Database
 from keys import Keys
+from loop_watchdog import Watchdog
+from metrics import MetricsRegistry, MetricsServer, Sample, instrument_responses
 from text_processing import acronymize, join_lines, md_codeblock
 
 
@@ -32,9 +40,30 @@ class Goonbot(commands.Bot):
     # Database path
     database_path = "gbdb.sqlite"
 
-    # Used to calculate command execution times with on_interaction & on_app_command_completion
-    command_timer_lock = asyncio.Lock()
-    command_timer_journal = defaultdict(time.perf_counter)
+    # Archiver write-behind cadence. Queued rows are written every N rows or T seconds, whichever comes first
+    archiver_flush_rows = 200
+    archiver_flush_interval = 5.0
+    # Batches that couldn't be written because the database was locked wait here, see cogs/_archiver/spool.py
+    archiver_spool_path = "archiver.spool"
+
+    # Nightly backups (see cogs/backup.py). N pages per step, sleeping between steps so writes get a turn
+    backup_dir = "/mnt/gbdb-backup"
+    backup_retention_days = 7
+    backup_pages_per_step = 256
+    backup_step_sleep = 0.05
+
+    # Read-only copy of the database that recap counts from (see analytics.py), retaken every N minutes
+    analytics_path = "gbdb.analytics.sqlite"
+    analytics_snapshot_minutes = 60
+
+    # Localhost Prometheus endpoint (see metrics.py), None to not serve one
+    metrics_port: int | None = None
+    # Event loop stalls longer than this (seconds) are logged with their stack, see loop_watchdog.py
+    watchdog_threshold = 0.25
+
+    # Where finished years of messages are moved to, a .sqlite file each. None keeps them in gbdb.sqlite
+    # The nightly backup copies each of those once, next to the gbdb.sqlite backups (see cogs/backup.py)
+    message_archive_dir: str | None = None
 
     # A default embed that will sprinkled around (so I don't have to manually set the color every time)
     embed = partial(discord.Embed, color=discord.Color.blurple())
@@ -47,6 +76,29 @@ class Goonbot(commands.Bot):
             intents=intents,
             **kwargs,
         )
+        # Shared connection every cog reads & writes through, connected in setup_hook
+        self.database = Database(self.database_path)
+        # Commit, Python, and host details, for /meta and error reports. Kept current by the Meta cog
+        self.build_info = BuildInfoProvider(".".join(map(str, self.VERSION)))
+        # App command latency histograms (see metrics.py), saved and shown by cogs/metrics.py
+        self.metrics = MetricsRegistry()
+        instrument_responses(self.metrics)
+        self.metrics.collectors["bot"] = self.collect_metrics
+        self.metrics_server: MetricsServer | None = None
+        self.watchdog = Watchdog(self.watchdog_threshold)
+        self.metrics.collectors["watchdog"] = self.watchdog.collect_metrics
+
+    def collect_metrics(self) -> list[Sample]:
+        """Gateway latency and database size, for the metrics endpoint"""
+        samples = [Sample("goonbot_gateway_latency_seconds", "Discord gateway heartbeat", self.latency)]
+        for suffix in ("", "-wal"):
+            try:
+                size = os.path.getsize(self.database_path + suffix)
+            except OSError:
+                continue
+            labels = {"file": f"gbdb.sqlite{suffix}"}
+            samples.append(Sample("goonbot_database_bytes", "Size of gbdb.sqlite on disk", size, labels))
+        return samples
 
     def ping_owner(self) -> str:
         return f"<@{self.owner_id}>"
@@ -73,9 +125,28 @@ class Goonbot(commands.Bot):
     async def setup_hook(self):
         """
         Called while the bot is logging in, but before it's ready to be used by users.
-        Handles startup actions like call load_cogs()
+        Handles startup actions like connecting to the database and calling load_cogs()
         """
+        logging.info(f"Starting {self.build_info.info}")
+        self.watchdog.start()
+        # Cogs use the database while loading, so this comes first
+        await asyncio.to_thread(migrations.migrate_database, self.database_path)
+        await self.database.connect()
         await self.load_cogs()
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            await self.metrics_server.start()
+
+    async def close(self):
+        """
+        Shuts the bot down.
+        Cogs are unloaded first (flushing anything they have queued), then the database is closed
+        """
+        await super().close()
+        if self.metrics_server:
+            await self.metrics_server.close()
+        self.watchdog.stop()
+        await self.database.close()
 
     async def on_ready(self):
         """Called after the bot is finished logging in and is ready to use"""
@@ -108,7 +179,7 @@ async def on_app_command_error(interaction: discord.Interaction, error: discord.
         ),
         ephemeral=True,
     )
-    logging.error(traceback.format_exc())
+    logging.error(f"{traceback.format_exc()}Running {goonbot.build_info.info}")
 
 
 # Prefix commands
@@ -188,53 +259,54 @@ async def log(ctx: commands.Context, *, flags: LogFlags):
     """
     Crude way for me to read logs remotely.
 
-    Batched into "pages" of N lines
+    Batched into "pages" of N lines, counting back from the end of the log. Only reads as much of the log
+    as the page needs (see log_reader.py)
     """
-    # How many lines of the log to include per 'page'
-    page_line_length = flags.line_count
+    if flags.page_num < 1 or flags.line_count < 1:
+        return await ctx.send("Invalid page number.")
 
-    # Read in log file and split into lines
-    log_lines = Path("bot.log").read_text().splitlines()
+    # Various filters, applied to each line as it's read
+    def matches(line: str) -> bool:
+        # Basic grep
+        if flags.search and flags.search.lower() not in line.lower():
+            return False
+        # Timestamp or date..stamp?
+        if flags.timestamp and flags.timestamp not in line:
+            return False
+        # INFO, ERROR, etc.
+        if flags.entry_type and f"[{flags.entry_type.lower()}" not in line.lower():
+            return False
+        return True
 
-    # Various filters
-    # Basic grep
-    if flags.search:
-        log_lines = [line for line in log_lines if flags.search.lower() in line.lower()]
+    try:
+        log_page = await asyncio.to_thread(
+            log_reader.read_page, "bot.log", flags.page_num, flags.line_count, matches
+        )
+    except FileNotFoundError:
+        return await ctx.send("There's no log file.")
 
-    # Timestamp or date..stamp?
-    if flags.timestamp:
-        log_lines = [line for line in log_lines if flags.timestamp in line]
+    # Handle if all pages are filtered out
+    if not log_page.lines:
+        if flags.page_num == 1:
+            return await ctx.send("No log pages match this query.")
+        # Prevent out of bounds error
+        return await ctx.send("Invalid page number.")
 
-    # INFO, ERROR, etc.
-    if flags.entry_type:
-        log_lines = [line for line in log_lines if f"[{flags.entry_type.lower()}" in line.lower()]
+    page = log_page.lines
 
     # Remove timestamps
     if flags.consice == 1:
         timestamp_length = 22  # "[2025-01-19 20:03:10] "
-        log_lines = [line[timestamp_length:] for line in log_lines]
+        page = [line[timestamp_length:] for line in page]
 
     # Remove timestamp and INFO, ERROR, etc.
     if flags.consice == 2:
         timestamp_and_entry_type_length = 33  # "[2025-01-19 20:03:10] [INFO    ] "
-        log_lines = [line[timestamp_and_entry_type_length:] for line in log_lines]
-
-    # Similar to batched, but odd-numbered group is at the start
-    # Otherwise, since the log pages are served back-to-front, the first page may just be a few lines
-    log_pages = frontloaded_batched(log_lines, page_line_length)
-
-    # Handle if all pages are filtered out
-    if not log_pages:
-        return await ctx.send("No log pages match this query.")
-
-    # Prevent out of bounds error
-    if flags.page_num > len(log_pages):
-        return await ctx.send("Invalid page number.")
-
-    # Because it's a log file, we serve back-to-front
-    page = log_pages[-flags.page_num]
+        page = [line[timestamp_and_entry_type_length:] for line in page]
 
     # Send "page" of log file (with backticks for formatting)
+    # The total isn't known without reading the whole log, just whether there's an older page
+    oldest = "" if log_page.has_more else " (the oldest)"
     try:
         await ctx.send(
             md_codeblock(
@@ -242,7 +314,7 @@ async def log(ctx: commands.Context, *, flags: LogFlags):
                     page,
                 )
             )
-            + f"Page **{flags.page_num}** of **{len(log_pages)}**",
+            + f"Page **{flags.page_num}**{oldest}",
         )
     except discord.HTTPException as e:
         if re.search(r"Must be \d+ or fewer in length", e.text):
@@ -254,6 +326,55 @@ async def log(ctx: commands.Context, *, flags: LogFlags):
             )
 
 
+# Only one profile at a time, two samplers would just get in each other's way
+profile_lock = asyncio.Lock()
+
+
+def profile_table(title: str, rows: list[tuple[profiler.Function, float]]) -> str:
+    return join_lines([title, *[f"{share:>6.1%}  {str(function)[:80]}" for function, share in rows]])
+
+
+@goonbot.command(name="profile", description="[Meta] Profile the event loop for a few seconds")
+@commands.is_owner()
+async def profile(ctx: commands.Context, seconds: float = 10):
+    """
+    Samples what the event loop is running for `seconds` (see profiler.py), then DMs the top functions by
+    self and cumulative time, and the collapsed stacks for a flamegraph.
+
+    Run it, then use the slow command while it's sampling. No restart needed, and nothing is left running after.
+    """
+    if not 0 < seconds <= profiler.MAX_SECONDS:
+        return await ctx.send(f"Profile for between 0 and {profiler.MAX_SECONDS} seconds.")
+    if profile_lock.locked():
+        return await ctx.send("Already profiling.")
+
+    async with profile_lock:
+        await ctx.send(embed=goonbot.embed(title=f"Profiling for {seconds:g}s... ⏱️"))
+        result = await profiler.profile_loop(threading.get_ident(), seconds)
+
+    if not result.busy:
+        return await ctx.author.send(embed=goonbot.embed(title="The loop was idle the whole time 😴"))
+
+    tables = [
+        profile_table("Self", result.top(result.self_time)),
+        profile_table("Cumulative", result.top(result.cumulative)),
+    ]
+    collapsed = discord.File(
+        io.BytesIO(result.collapsed().encode()),
+        filename=f"profile-{dt.datetime.now():%Y%m%d-%H%M%S}.collapsed",
+    )
+    await ctx.author.send(
+        embed=goonbot.embed(
+            title=f"Event loop profile, {seconds:g}s",
+            description=md_codeblock("\n\n".join(tables)),
+        ).set_footer(
+            text=f"{result.samples:,} samples, busy {result.busy / result.samples:.0%} of the time. "
+            "The attached stacks work with flamegraph.pl or speedscope.app"
+        ),
+        file=collapsed,
+    )
+
+
 # This catches and processes ext (or "prefixed") commands
 @goonbot.event
 async def on_command_error(ctx: commands.Context, error: commands.CommandError):
@@ -274,31 +395,23 @@ async def on_command_error(ctx: commands.Context, error: commands.CommandError):
     else:
         # Without this line, prefixed commands throwing exceptions that will get gobbled
         # up by this event and make me real mad later when I break something
-        logging.error(error)
+        logging.error(f"{error} (running {goonbot.build_info.info})")
 
 
-# The following commands are used to log command execution time. `track_command_start` adds a
-# timestamp and interaction ID pair to `command_timer` when a command interaction begins, then
-# `log_command_elapsed_time` finds this pair and calculates the elapsed time.
+# The following listeners time app commands (see metrics.py). `track_command_start` notes when a command
+# interaction arrives, and `log_command_elapsed_time` records how long each phase took once it's done
+# (when it was deferred/responded to is recorded by metrics.instrument_responses)
 @goonbot.listen("on_interaction")
 async def track_command_start(interaction: discord.Interaction):
-    # Logs the time when an app command starts an interation
-    async with goonbot.command_timer_lock:
-        if interaction.type == discord.InteractionType.application_command:
-            assert interaction.command
-            goonbot.command_timer_journal[interaction.id] = time.perf_counter()
+    if interaction.type == discord.InteractionType.application_command:
+        goonbot.metrics.started(interaction.id)
 
 
 @goonbot.listen("on_app_command_completion")
 async def log_command_elapsed_time(interaction: discord.Interaction, command: discord.app_commands.Command):
-    # When an app command is done processing and ready to send, check the command timer dict for the
-    # interaction id. If interaction id present, we can calculate the execution time for the log
-    async with goonbot.command_timer_lock:
-        if command_start_time := goonbot.command_timer_journal.get(interaction.id):
-            del goonbot.command_timer_journal[interaction.id]
-            command_end_time = time.perf_counter()
-            command_elapsed_time = command_end_time - command_start_time
-            logging.info(f"{command.name} execution time: {round(command_elapsed_time, 3)}s")
+    command_elapsed_time = goonbot.metrics.completed(interaction.id, command.qualified_name)
+    if command_elapsed_time is not None:
+        logging.info(f"{command.name} execution time: {round(command_elapsed_time, 3)}s")
 
 
 # Context menus
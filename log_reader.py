@@ -0,0 +1,79 @@
+"""
+Reads bot.log backwards, for `.log`
+
+bot.log is only ever appended to, so it gets to hundreds of MB, and `.log` almost always wants the end of it.
+`reverse_lines` seeks back from the end of the file a block at a time and yields lines newest first, and
+`read_page` filters them as they come and stops as soon as it has the page asked for. Page 1 of an unfiltered
+log is a block or two of reading, no matter how big the file is.
+
+> "Why not read the whole file and take the end?"
+That's what `.log` used to do, on the event loop, every time. Then filter and batch every line, to show 20.
+
+Usage
+    page = read_page("bot.log", page=1, per_page=20, matches=lambda line: "ERROR" in line)
+"""
+
+import os
+from typing import Callable, Iterator, NamedTuple
+
+BLOCK_SIZE = 8 * 1024
+
+
+def reverse_lines(path: str | os.PathLike, block_size: int = BLOCK_SIZE) -> Iterator[str]:
+    """Lines of `path`, last line first. Blank lines are included, like str.splitlines(). Blocking"""
+    with open(path, "rb") as file:
+        position = file.seek(0, os.SEEK_END)
+        if position == 0:
+            return
+        # Start of the line the previous block ended in the middle of
+        partial = b""
+        last_block = True
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            file.seek(position)
+            lines = (file.read(read_size) + partial).split(b"\n")
+            # The first line may continue into the block before this one
+            partial = lines.pop(0)
+            # A newline at the end of the file ends the last line, it doesn't start an empty one
+            if last_block and lines and lines[-1] == b"":
+                lines.pop()
+            last_block = False
+            for line in reversed(lines):
+                # Split on bytes so a multibyte character across blocks is never cut in half
+                yield line.decode("utf-8", errors="replace").rstrip("\r")
+        yield partial.decode("utf-8", errors="replace").rstrip("\r")
+
+
+class LogPage(NamedTuple):
+    # Oldest first
+    lines: list[str]
+    page: int
+    # If there are older lines matching, on the next page
+    has_more: bool
+
+
+def read_page(
+    path: str | os.PathLike,
+    page: int,
+    per_page: int,
+    matches: Callable[[str], bool] = lambda line: True,
+) -> LogPage:
+    """
+    The `page`th page of `per_page` lines matching `matches`, counting back from the end of the log, like
+    `.log` serves them. Reads only as far back as it needs to. Blocking, ran in a thread
+    """
+    skip = (page - 1) * per_page
+    lines = []
+    for line in reverse_lines(path):
+        # Blank lines are kept, they're part of tracebacks and multi-line records
+        if not matches(line):
+            continue
+        if skip:
+            skip -= 1
+            continue
+        if len(lines) == per_page:
+            # One more matching line, so there's another page
+            return LogPage(lines[::-1], page, has_more=True)
+        lines.append(line)
+    return LogPage(lines[::-1], page, has_more=False)
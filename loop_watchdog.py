@@ -0,0 +1,138 @@
+"""
+Event loop watchdog, for finding code that blocks the event loop (and with it the gateway heartbeat)
+
+A heartbeat task on the loop notes the time every INTERVAL. A helper thread checks on it just as often, and
+if the heartbeat is more than `threshold` late, the loop is stuck in something. The thread grabs the loop
+thread's stack right then (sys._current_frames), while the blocking call is still on it, along with which
+command was running. Once the loop is free again, the heartbeat logs the stall with how long it lasted.
+`.stalls` lists the recent ones.
+
+> "Why a thread?"
+Anything running on the loop can only look once the loop is free again, by which point whatever blocked it
+is long gone from the stack.
+
+How late each heartbeat was is also the event loop's lag, which the metrics endpoint reports (see metrics.py).
+"""
+
+import asyncio
+import datetime as dt
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from types import FrameType
+from typing import NamedTuple
+
+import discord
+from discord.ext import commands
+
+from metrics import Sample
+
+INTERVAL = 0.1
+# How many lag measurements the metrics endpoint's max is over, a minute's worth
+LAG_SAMPLES = 600
+# How many stalls are kept for .stalls
+STALL_HISTORY = 50
+
+
+class Stall(NamedTuple):
+    at: dt.datetime
+    duration: float
+    # The command that was running, if it could be found
+    command: str | None
+    stack: list[str]
+
+
+def command_name(frame: FrameType | None) -> str | None:
+    """The command being run somewhere in `frame`'s stack, found by its `interaction` or `ctx` argument"""
+    while frame is not None:
+        local = frame.f_locals
+        interaction = local.get("interaction")
+        if isinstance(interaction, discord.Interaction) and interaction.command:
+            return f"/{interaction.command.qualified_name}"
+        ctx = local.get("ctx")
+        if isinstance(ctx, commands.Context) and ctx.command:
+            return f".{ctx.command.qualified_name}"
+        frame = frame.f_back
+    return None
+
+
+class Watchdog:
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        # How late each heartbeat was
+        self.lags: deque[float] = deque(maxlen=LAG_SAMPLES)
+        self.stalls: deque[Stall] = deque(maxlen=STALL_HISTORY)
+        self.stall_count = 0
+        # Command & stack the thread captured for the stall in progress, logged by the heartbeat once it ends
+        self.captured: tuple[str | None, list[str]] | None = None
+        self.loop_thread_id: int | None = None
+        self.heartbeat_task: asyncio.Task | None = None
+        self.stopped = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def start(self):
+        """Called from the event loop"""
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopped.clear()
+        self.heartbeat_task = asyncio.create_task(self.heartbeat(), name="watchdog-heartbeat")
+        self.thread = threading.Thread(target=self.watch, name="watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(INTERVAL)
+            now = time.monotonic()
+            lag = max(now - self.last_beat - INTERVAL, 0.0)
+            self.last_beat = now
+            self.lags.append(lag)
+            if lag > self.threshold:
+                self.record(lag)
+            # Whatever the thread caught belongs to this heartbeat, never the next one
+            self.captured = None
+
+    def record(self, duration: float):
+        # A stall barely over the threshold can end before the thread gets a look
+        command, stack = self.captured or (None, ["(ended before its stack could be captured)\n"])
+        self.stall_count += 1
+        self.stalls.append(Stall(dt.datetime.now(), duration, command, stack))
+        logging.warning(
+            f"Event loop blocked for {duration:.2f}s in {command or 'unknown command'}, "
+            f"stack when it was caught:\n{''.join(stack)}"
+        )
+
+    def watch(self):
+        """The helper thread. Captures the loop thread's stack once the heartbeat is late"""
+        while not self.stopped.wait(INTERVAL):
+            late = time.monotonic() - self.last_beat - INTERVAL
+            if late <= self.threshold or self.captured:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            try:
+                self.captured = (command_name(frame), traceback.format_stack(frame))
+            except Exception:
+                # The frames can change under us if the loop gets going again mid-capture
+                continue
+
+    def collect_metrics(self) -> list[Sample]:
+        if not self.lags:
+            return []
+        return [
+            Sample("goonbot_event_loop_lag_seconds", "How late the last heartbeat was", self.lags[-1]),
+            Sample("goonbot_event_loop_lag_max_seconds", "Worst lag of the last minute", max(self.lags)),
+            Sample(
+                "goonbot_event_loop_stalls_total", "Stalls since startup", self.stall_count, type="counter"
+            ),
+        ]
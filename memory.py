@@ -0,0 +1,154 @@
+"""
+Memory growth tooling for `.mem` (cogs/metrics.py)
+
+The bot runs for weeks with Intents.all(), so "RSS keeps creeping up" needs answering without a restart:
+- `.mem start` turns on tracemalloc and takes a baseline snapshot
+- `.mem snap` takes a snapshot, and shows the biggest allocation sites right now
+- `.mem diff` takes a snapshot, and shows which sites grew the most since the previous one
+- `.mem stop` turns tracemalloc back off, it costs memory and a little speed while it's on
+
+Sites are grouped by file and line. Only allocations made after `.mem start` are traced, so start it, let the
+bot run for a while (an hour, a day), then diff.
+
+Every report also has RSS and gc's generation counts. Snaps and diffs also have how many objects each cog
+holds on to (see `objects_held`), which is usually the quickest way to spot a list or dict that only ever
+grows.
+
+> "Why not just tracemalloc from startup?"
+It roughly doubles the memory of every allocation it traces, which on a 4GB Pi is its own leak.
+"""
+
+import gc
+import pathlib
+import resource
+import tracemalloc
+import types
+from typing import Any, NamedTuple
+
+# Frames kept per allocation, 1 is enough to group by file and line and is the cheapest
+TRACE_FRAMES = 1
+TOP_SITES = 10
+# Objects walked for all the cogs together, split evenly between them. It's walked on the event loop, this
+# many takes tens of ms (more on the Pi)
+OBJECT_BUDGET = 50_000
+
+# Allocations made by tracemalloc itself, and imports
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+class Site(NamedTuple):
+    # "cogs/archiver.py:120"
+    location: str
+    size: int
+    count: int
+    # Change since the previous snapshot, 0 for `.mem snap`
+    size_diff: int = 0
+    count_diff: int = 0
+
+
+def location(trace: tracemalloc.Traceback) -> str:
+    frame = trace[0]
+    filename = frame.filename
+    if "site-packages" in filename:
+        filename = filename.split("site-packages/", 1)[1]
+    elif filename.startswith(str(pathlib.Path.cwd())):
+        filename = str(pathlib.Path(filename).relative_to(pathlib.Path.cwd()))
+    return f"{filename}:{frame.lineno}"
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    """Blocking, ran in a thread"""
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+
+def top_sites(snapshot: tracemalloc.Snapshot, limit: int = TOP_SITES) -> list[Site]:
+    stats = snapshot.statistics("lineno")
+    return [Site(location(stat.traceback), stat.size, stat.count) for stat in stats[:limit]]
+
+
+def top_growth(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot, limit: int = TOP_SITES) -> list[Site]:
+    """Sites that grew the most from `old` to `new`. Blocking, ran in a thread"""
+    stats = new.compare_to(old, "lineno")
+    # compare_to sorts by the absolute difference, a site that shrank isn't interesting here
+    grew = [stat for stat in stats if stat.size_diff > 0]
+    return [
+        Site(location(stat.traceback), stat.size, stat.count, stat.size_diff, stat.count_diff)
+        for stat in grew[:limit]
+    ]
+
+
+def rss() -> int | None:
+    """Resident set size in bytes, None off Linux"""
+    try:
+        for line in pathlib.Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss() -> int:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def gc_generations() -> list[tuple[int, int, int]]:
+    """Per generation: objects waiting to be collected, collections so far, objects collected so far"""
+    return [
+        (count, stats["collections"], stats["collected"])
+        for count, stats in zip(gc.get_count(), gc.get_stats())
+    ]
+
+
+# Shared with the rest of the bot (or the interpreter), not something a cog holds on to
+SKIPPED_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+    types.CodeType,
+    types.FrameType,
+)
+
+
+def objects_held(root: Any, skip: set[int], limit: int) -> int:
+    """
+    How many objects are reachable from `root`'s attributes, not counting anything in `skip` (ids of the bot,
+    its connection state, and the other cogs, which everything refers to) or classes, modules, and functions.
+    Stops at `limit`.
+
+    > "Why not sys.getsizeof?"
+    It only counts the container, not what's in it, so a dict of a million Messages looks the same as a dict
+    of a million ints.
+    """
+    seen: set[int] = set(skip)
+    stack = list(vars(root).values()) if hasattr(root, "__dict__") else []
+    count = 0
+    while stack and count < limit:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        count += 1
+        stack.extend(gc.get_referents(obj))
+    return count
+
+
+def cog_limit(cogs: dict[str, Any], budget: int = OBJECT_BUDGET) -> int:
+    """Objects walked per cog, its share of `budget`"""
+    return budget // max(len(cogs), 1)
+
+
+def cog_objects(cogs: dict[str, Any], shared: list[Any], budget: int = OBJECT_BUDGET) -> dict[str, int]:
+    """Objects held by each cog (see objects_held), biggest first. Walks at most `budget` objects in all"""
+    skip = {id(obj) for obj in [*shared, *cogs.values()]}
+    limit = cog_limit(cogs, budget)
+    counts = {name: objects_held(cog, skip, limit) for name, cog in cogs.items()}
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
@@ -0,0 +1,326 @@
+"""
+Latency histograms for app commands, and the localhost Prometheus endpoint
+
+Every app command is timed in three phases, from when the interaction arrives (on_interaction):
+- defer: until it's deferred, for commands that defer
+- response: until its first response of any kind (a defer, message, or modal), which Discord wants within 3s
+- total: until the command finishes (on_app_command_completion)
+
+Each phase is a fixed-bucket histogram (BUCKETS), one per SLICE_SECONDS slice of time, so percentiles can be
+given over rolling windows (WINDOWS) by adding up the slices in them. Slices are saved to the command_latency
+table every minute by cogs/metrics.py, and loaded back on startup, so "did /aram get slower after the last
+update" can be answered across restarts. `.latency` shows them.
+
+> "Why buckets instead of keeping every duration?"
+A histogram is a dozen counts no matter how many times a command is used, and adding two together is exact.
+Percentiles are estimated within a bucket, which is plenty to tell 200ms from 2s.
+
+If `Goonbot.metrics_port` is set, MetricsServer serves everything in Prometheus' text format on
+127.0.0.1:<port>/metrics, for the local monitoring stack to scrape. The histograms there are cumulative since
+startup (Prometheus does the windows), and anything else comes from collectors cogs register
+(`MetricsRegistry.collectors`). Collectors only read numbers already in memory, a scrape never touches the
+database or waits on anything.
+"""
+
+import json
+import logging
+import math
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Callable, Iterable, NamedTuple, Sequence
+
+import discord
+from aiohttp import web
+
+# Upper bounds (seconds) of each bucket. Anything slower lands in one last, unbounded bucket
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0, 60.0)
+PHASES = ("defer", "response", "total")
+
+SLICE_SECONDS = 5 * 60
+WINDOWS = {"1h": 60 * 60, "24h": 24 * 60 * 60, "7d": 7 * 24 * 60 * 60}
+# Slices older than this are deleted from the database. Only the longest window is kept in memory
+RETENTION_SECONDS = 30 * 24 * 60 * 60
+# How often those are deleted, they're only ever minutes past the retention
+PRUNE_SECONDS = 60 * 60
+
+# Interactions that never complete (errors) are forgotten after this, their tokens have expired anyway
+TIMING_TIMEOUT = 15 * 60
+
+SELECT_SLICES = "SELECT command, phase, slice, counts, total FROM command_latency WHERE slice >= ?"
+UPSERT_SLICE = """
+    INSERT OR REPLACE INTO command_latency (command, phase, slice, counts, total) VALUES (?, ?, ?, ?, ?)
+"""
+DELETE_EXPIRED = "DELETE FROM command_latency WHERE slice < ?"
+
+
+class Histogram:
+    __slots__ = ("counts", "total")
+
+    def __init__(self, counts: Sequence[int] | None = None, total: float = 0.0):
+        self.counts = list(counts) if counts else [0] * (len(BUCKETS) + 1)
+        # Sum of every observation, for the mean
+        self.total = total
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def merge(self, other: "Histogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Estimated `q` quantile (0.95 for p95), interpolated within the bucket it falls in. None if empty.
+        The last bucket has no upper bound, so anything in it is reported as the last bound.
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                if i == len(BUCKETS):
+                    return lower
+                return lower + (BUCKETS[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return BUCKETS[-1]
+
+
+class Sample(NamedTuple):
+    """One value for the metrics endpoint"""
+
+    name: str
+    help: str
+    value: float
+    labels: dict[str, str] | None = None
+    # gauge or counter
+    type: str = "gauge"
+
+
+type Collector = Callable[[], Iterable[Sample]]
+
+
+class Timing:
+    """When an interaction arrived, and was deferred/first responded to (perf_counter)"""
+
+    __slots__ = ("start", "deferred", "responded")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.deferred: float | None = None
+        self.responded: float | None = None
+
+
+def slice_of(timestamp: float) -> int:
+    """Start (epoch seconds) of the slice `timestamp` falls in"""
+    return int(timestamp // SLICE_SECONDS * SLICE_SECONDS)
+
+
+class MetricsRegistry:
+    """Every command's latency histograms, see the module docstring. Lives at Goonbot.metrics"""
+
+    def __init__(self):
+        # (command, phase) -> slice start -> Histogram
+        self.slices: dict[tuple[str, str], dict[int, Histogram]] = defaultdict(dict)
+        # (command, phase) -> Histogram of everything since startup, for the metrics endpoint
+        self.totals: dict[tuple[str, str], Histogram] = defaultdict(Histogram)
+        # Name -> function returning samples for the metrics endpoint, registered by cogs
+        self.collectors: dict[str, Collector] = {}
+        # (command, phase, slice start) changed since the last save
+        self.dirty: set[tuple[str, str, int]] = set()
+        # Interaction id -> Timing, for interactions still being processed
+        self.timings: dict[int, Timing] = {}
+
+    def started(self, interaction_id: int):
+        self.timings[interaction_id] = Timing(time.perf_counter())
+
+    def responded(self, interaction_id: int, deferred: bool):
+        timing = self.timings.get(interaction_id)
+        if timing is None:
+            return
+        now = time.perf_counter()
+        if timing.responded is None:
+            timing.responded = now
+        if deferred and timing.deferred is None:
+            timing.deferred = now
+
+    def completed(self, interaction_id: int, command: str) -> float | None:
+        """Records every phase of a finished command. Returns its total time, None if it wasn't timed"""
+        timing = self.timings.pop(interaction_id, None)
+        if timing is None:
+            return None
+        total = time.perf_counter() - timing.start
+        self.observe(command, "total", total)
+        if timing.responded is not None:
+            self.observe(command, "response", timing.responded - timing.start)
+        if timing.deferred is not None:
+            self.observe(command, "defer", timing.deferred - timing.start)
+        return total
+
+    def observe(self, command: str, phase: str, seconds: float, timestamp: float | None = None):
+        start = slice_of(time.time() if timestamp is None else timestamp)
+        histogram = self.slices[command, phase].get(start)
+        if histogram is None:
+            histogram = self.slices[command, phase][start] = Histogram()
+        histogram.observe(seconds)
+        self.dirty.add((command, phase, start))
+        self.totals[command, phase].observe(seconds)
+
+    def window(self, command: str, phase: str, seconds: int) -> Histogram:
+        """Everything observed in the last `seconds`, to the nearest slice"""
+        since = slice_of(time.time() - seconds)
+        merged = Histogram()
+        for start, histogram in self.slices.get((command, phase), {}).items():
+            if start >= since:
+                merged.merge(histogram)
+        return merged
+
+    def commands(self) -> list[str]:
+        return sorted({command for command, _ in self.slices})
+
+    def prune(self):
+        """Forgets slices older than the longest window, and interactions that never completed"""
+        since = slice_of(time.time() - max(WINDOWS.values()))
+        for slices in self.slices.values():
+            for start in [start for start in slices if start < since]:
+                del slices[start]
+        stale = time.perf_counter() - TIMING_TIMEOUT
+        for interaction_id in [i for i, timing in self.timings.items() if timing.start < stale]:
+            del self.timings[interaction_id]
+
+    def load(self, rows: Iterable[Sequence[Any]]):
+        """Loads saved slices (rows of SELECT_SLICES)"""
+        for command, phase, start, counts, total in rows:
+            self.slices[command, phase][start] = Histogram(json.loads(counts), total)
+
+    def take_dirty(self) -> list[tuple[str, str, int, str, float]]:
+        """Rows for UPSERT_SLICE of every slice changed since the last call"""
+        rows = []
+        for command, phase, start in self.dirty:
+            histogram = self.slices[command, phase].get(start)
+            if histogram is not None:
+                rows.append((command, phase, start, json.dumps(histogram.counts), histogram.total))
+        self.dirty.clear()
+        return rows
+
+
+def instrument_responses(registry: MetricsRegistry):
+    """
+    Records when interactions are deferred and first responded to.
+
+    > "Why patch discord.py?"
+    There's no event for an interaction being responded to, and InteractionResponse uses __slots__, so the
+    methods that respond are wrapped once, on the class.
+    """
+
+    def wrap(method, deferred: bool):
+        async def wrapper(self: discord.InteractionResponse, *args, **kwargs):
+            result = await method(self, *args, **kwargs)
+            registry.responded(self._parent.id, deferred)
+            return result
+
+        wrapper.__wrapped__ = method
+        return wrapper
+
+    for name in ("defer", "send_message", "send_modal", "edit_message"):
+        method = getattr(discord.InteractionResponse, name)
+        # Don't wrap twice if the bot is set up again
+        method = getattr(method, "__wrapped__", method)
+        setattr(discord.InteractionResponse, name, wrap(method, deferred=name == "defer"))
+
+
+# Metrics endpoint
+
+HOST = "127.0.0.1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_METRIC = "goonbot_command_latency_seconds"
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels: dict[str, str] | None) -> str:
+    if not labels:
+        return ""
+    escaped = {
+        name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for name, value in labels.items()
+    }
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def exposition(registry: MetricsRegistry, samples: Iterable[Sample]) -> str:
+    """Every metric in Prometheus' text format"""
+    lines = [
+        f"# HELP {LATENCY_METRIC} App command latency since startup, by phase (defer, response, total)",
+        f"# TYPE {LATENCY_METRIC} histogram",
+    ]
+    for (command, phase), histogram in sorted(registry.totals.items()):
+        labels = {"command": command, "phase": phase}
+        cumulative = 0
+        for bound, count in zip([*BUCKETS, math.inf], histogram.counts):
+            cumulative += count
+            bucket_labels = format_labels({**labels, "le": format_value(bound)})
+            lines.append(f"{LATENCY_METRIC}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{LATENCY_METRIC}_sum{format_labels(labels)} {format_value(histogram.total)}")
+        lines.append(f"{LATENCY_METRIC}_count{format_labels(labels)} {cumulative}")
+
+    # Samples with the same name share a HELP/TYPE header
+    by_name: dict[str, list[Sample]] = defaultdict(list)
+    for sample in samples:
+        by_name[sample.name].append(sample)
+    for name, named in by_name.items():
+        lines.append(f"# HELP {name} {named[0].help}")
+        lines.append(f"# TYPE {name} {named[0].type}")
+        lines.extend(f"{name}{format_labels(sample.labels)} {format_value(sample.value)}" for sample in named)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves /metrics on localhost, started in Goonbot.setup_hook if `Goonbot.metrics_port` is set"""
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = HOST):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner: web.AppRunner | None = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def samples(self) -> list[Sample]:
+        samples = []
+        for name, collector in list(self.registry.collectors.items()):
+            try:
+                samples.extend(collector())
+            except Exception:
+                logging.exception(f"Metrics collector {name} failed")
+        return samples
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = exposition(self.registry, self.samples())
+        return web.Response(body=body.encode(), headers={"Content-Type": CONTENT_TYPE})
@@ -0,0 +1,264 @@
+"""
+One-shot migrator that copies the v1 archiver tables (uuid keys, ISO-8601 timestamps) into the v2 schema
+(integer keys, snowflake time columns, dictionary encoded names). See archive.py for the schema.
+
+Rows are copied in chunks, each chunk committed along with how far the migrator got. If it's stopped
+(or crashes) part way, running it again picks up where it left off. Best ran while the bot is stopped.
+
+Once every table is copied, the v1 tables are dropped and the database is vacuumed, and the size
+difference is reported.
+
+Usage
+    python migrate_archive.py [--database gbdb.sqlite] [--chunk-size 10000] [--no-vacuum]
+    python migrate_archive.py --benchmark 100000
+"""
+
+import argparse
+import datetime as dt
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import humanize
+
+import archive
+import migrations
+
+PROGRESS_TABLE = """
+    CREATE TABLE IF NOT EXISTS archive_migration (
+        tableName TEXT PRIMARY KEY,
+        lastRowID INTEGER
+    )
+"""
+
+# Only used to benchmark against
+V1_SCHEMA = [
+    "CREATE TABLE command (id TEXT PRIMARY KEY, userID INTEGER, commandName TEXT, timestamp TEXT)",
+    """
+    CREATE TABLE reaction (id TEXT PRIMARY KEY, userID INTEGER, reactionStr TEXT, messageID INTEGER, timestamp TEXT)
+    """,
+    """
+    CREATE TABLE message (id TEXT PRIMARY KEY, userID INTEGER, messageID INTEGER, channelID INTEGER, timestamp TEXT)
+    """,
+]
+
+
+def iso_to_ms(timestamp: str) -> int:
+    """v1 timestamps were naive local time ISO strings"""
+    return int(dt.datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+def convert_v1_row(table: str, row: tuple[Any, ...]) -> tuple[Any, ...]:
+    """
+    v1 rows are (id, ...columns, timestamp). The uuid is dropped, which leaves the columns in the order
+    insert_rows() expects.
+
+    Messages don't need their timestamp, the messageID is their time axis. Commands and reactions get a
+    snowflake made from their timestamp (v1 didn't record the interaction id).
+    """
+    _, *columns, timestamp = row
+    if table == "message":
+        return tuple(columns)
+    return (*columns, archive.ms_to_snowflake(iso_to_ms(timestamp)))
+
+
+def v1_tables(conn: sqlite3.Connection) -> list[str]:
+    """
+    Archive tables that still need migrating. Runs the schema migrations first, which renames the v1 tables
+    (if the bot hasn't already) and creates the v2 ones.
+    """
+    migrations.migrate(conn)
+    return [
+        table
+        for table in archive.ARCHIVE_TABLES
+        if conn.execute(archive.V1_CHECK, (f"{table}_v1",)).fetchone()
+    ]
+
+
+def insert_rows(
+    conn: sqlite3.Connection,
+    table: str,
+    rows: list[tuple],
+    partitions: dict[int, archive.MessagePartition],
+):
+    """Inserts converted rows, messages into their year's partition (created if needed)"""
+    if table != "message":
+        if names := archive.new_names(table, rows):
+            conn.executemany(archive.INSERT_NAME[table], names)
+        conn.executemany(archive.INSERT_ROW[table], rows)
+        return
+
+    for year, year_rows in archive.rows_by_year(rows).items():
+        if year not in partitions:
+            for statement in archive.new_partition_statements(year, list(partitions.values())):
+                conn.execute(statement)
+            partitions[year] = archive.MessagePartition(year)
+        conn.executemany(archive.insert_message(year), year_rows)
+
+
+def migrate_table(conn: sqlite3.Connection, table: str, chunk_size: int) -> int:
+    """Copies {table}_v1 into {table} chunk by chunk, returns how many rows were copied this run"""
+    row = conn.execute("SELECT lastRowID FROM archive_migration WHERE tableName = ?", (table,)).fetchone()
+    last_rowid = row[0] if row else 0
+    partitions = {partition.year: partition for partition in archive.load_partitions(conn)}
+
+    copied = 0
+    while True:
+        chunk = conn.execute(
+            f"SELECT rowid, * FROM {table}_v1 WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, chunk_size),
+        ).fetchall()
+        if not chunk:
+            return copied
+
+        rows = [convert_v1_row(table, row[1:]) for row in chunk]
+        last_rowid = chunk[-1][0]
+
+        # The chunk and the progress marker are committed together, so a chunk is never copied twice
+        with conn:
+            conn.execute("BEGIN")
+            insert_rows(conn, table, rows, partitions)
+            conn.execute(
+                "INSERT OR REPLACE INTO archive_migration (tableName, lastRowID) VALUES (?, ?)",
+                (table, last_rowid),
+            )
+
+        copied += len(rows)
+        print(f"  {table}: {copied:,} rows copied", end="\r")
+
+
+def migrate(database: str, chunk_size: int, vacuum: bool):
+    size_before = os.path.getsize(database)
+
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA busy_timeout = 5000")
+
+    pending = v1_tables(conn)
+    if not pending:
+        print("Nothing to migrate, the archive is already v2.")
+        return
+    conn.execute(PROGRESS_TABLE)
+
+    start = time.perf_counter()
+    total = 0
+    for table in pending:
+        copied = migrate_table(conn, table, chunk_size)
+        total += copied
+        print(f"  {table}: {copied:,} rows copied")
+
+    # Everything made it across, clean up after ourselves
+    with conn:
+        for table in pending:
+            conn.execute(f"DROP TABLE {table}_v1")
+        conn.execute("DROP TABLE archive_migration")
+    elapsed = time.perf_counter() - start
+
+    if vacuum:
+        print("Vacuuming..")
+        conn.execute("VACUUM")
+    conn.close()
+
+    size_after = os.path.getsize(database)
+    print(f"Migrated {total:,} rows in {elapsed:.1f}s ({total / (elapsed or 1):,.0f} rows/s)")
+    print(f"Size: {humanize.naturalsize(size_before)} -> {humanize.naturalsize(size_after)}")
+
+
+def synthetic_v1_rows(table: str, count: int) -> list[tuple]:
+    """Fake v1 rows, drawn from a small pool of users/channels/names like the real archive"""
+    user_ids = [random.getrandbits(60) for _ in range(20)]
+    channel_ids = [random.getrandbits(60) for _ in range(30)]
+    reactions = ["💀", "😂", "🔥", "clueless", "chatting", "KEKW", "❤️", "👍"]
+    commands = ["rat", "cat", "real", "lastgame", "aram", "summoner", "meta", "watch"]
+    start = dt.datetime.now() - dt.timedelta(seconds=count)
+
+    rows = []
+    for i in range(count):
+        uuid = f"{random.getrandbits(128):032x}"
+        sent_at = start + dt.timedelta(seconds=i)
+        timestamp = sent_at.isoformat()
+        message_id = archive.datetime_to_snowflake(sent_at) | random.getrandbits(22)
+        user_id = random.choice(user_ids)
+        match table:
+            case "message":
+                rows.append((uuid, user_id, message_id, random.choice(channel_ids), timestamp))
+            case "reaction":
+                rows.append((uuid, user_id, random.choice(reactions), message_id, timestamp))
+            case "command":
+                rows.append((uuid, user_id, random.choice(commands), timestamp))
+    return rows
+
+
+def benchmark(row_count: int, batch_size: int = 200):
+    """
+    Inserts the same synthetic rows into a fresh v1 and v2 database, in batches like the archiver does,
+    and reports insert throughput and bytes per row for both
+    """
+    v1_insert = {
+        "command": "INSERT INTO command VALUES (?, ?, ?, ?)",
+        "reaction": "INSERT INTO reaction VALUES (?, ?, ?, ?, ?)",
+        "message": "INSERT INTO message VALUES (?, ?, ?, ?, ?)",
+    }
+
+    v1_rows = {table: synthetic_v1_rows(table, row_count) for table in archive.ARCHIVE_TABLES}
+    v2_rows = {table: [convert_v1_row(table, row) for row in rows] for table, rows in v1_rows.items()}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for version in ("v1", "v2"):
+            path = Path(tmp) / f"{version}.sqlite"
+            conn = sqlite3.connect(path)
+            if version == "v1":
+                for statement in V1_SCHEMA:
+                    conn.execute(statement)
+                conn.commit()
+            else:
+                migrations.migrate(conn)
+                partitions = {partition.year: partition for partition in archive.load_partitions(conn)}
+
+            start = time.perf_counter()
+            for table in archive.ARCHIVE_TABLES:
+                rows = v1_rows[table] if version == "v1" else v2_rows[table]
+                for i in range(0, row_count, batch_size):
+                    batch = rows[i : i + batch_size]
+                    with conn:
+                        if version == "v1":
+                            conn.executemany(v1_insert[table], batch)
+                            continue
+                        insert_rows(conn, table, batch, partitions)
+            elapsed = time.perf_counter() - start
+            conn.execute("VACUUM")
+            conn.close()
+
+            total_rows = row_count * len(archive.ARCHIVE_TABLES)
+            results[version] = (total_rows / elapsed, path.stat().st_size / total_rows)
+
+    for version, (rows_per_second, bytes_per_row) in results.items():
+        print(f"{version}: {rows_per_second:,.0f} rows/s, {bytes_per_row:.1f} bytes/row")
+    v1, v2 = results["v1"], results["v2"]
+    print(f"v2 inserts {v2[0] / v1[0]:.2f}x as fast, and is {v2[1] / v1[1]:.0%} the size")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the archiver tables to the v2 schema")
+    parser.add_argument("--database", default="gbdb.sqlite")
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--no-vacuum", action="store_true", help="Skip vacuuming once the migration is done")
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="ROWS",
+        help="Compare v1 and v2 insert throughput and size with synthetic rows, instead of migrating",
+    )
+    args = parser.parse_args()
+
+    if args.benchmark:
+        return benchmark(args.benchmark)
+    migrate(args.database, args.chunk_size, vacuum=not args.no_vacuum)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Schema migrations for gbdb.sqlite
+
+Every table and index the bot uses is created by a migration in MIGRATIONS, instead of cogs each running their
+own CREATE TABLE IF NOT EXISTS. The schema_version table records which migrations have been applied, so each
+one only ever runs once, in order.
+
+Migrations run automatically in `Goonbot.setup_hook`, before the database connection is opened. They're
+plain (blocking) sqlite3, so they can be reused by scripts like migrate_archive.py.
+
+> "How do I change the schema?"
+Append a new Migration to the end of MIGRATIONS, with the next version number. Never edit one that's
+already been released, databases that already applied it won't run it again.
+"""
+
+import datetime as dt
+import logging
+import sqlite3
+import time
+from typing import Callable, NamedTuple
+
+import archive
+import rollups
+
+# A step is either a SQL statement, or a function for anything that needs to look before it leaps
+type Step = str | Callable[[sqlite3.Connection], None]
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    steps: list[Step]
+
+
+SCHEMA_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        appliedAt INTEGER,
+        duration REAL
+    )
+"""
+
+
+def rename_v1_archive_tables(conn: sqlite3.Connection):
+    """Moves old (v1) archive tables out of the way, migrate_archive.py copies them into the new tables"""
+    for table in archive.ARCHIVE_TABLES:
+        id_type = conn.execute(archive.V1_CHECK, (table,)).fetchone()
+        if id_type and id_type[0] == "TEXT":
+            conn.execute(archive.V1_RENAME.format(table=table))
+            logging.warning(f"Renamed v1 {table} table to {table}_v1, run migrate_archive.py to copy it")
+
+
+def partition_message_table(conn: sqlite3.Connection):
+    """
+    Splits the message table up into a partition per year (see archive.py), and replaces it with a view.
+    The rollups' high-water mark for the message table is carried over to each partition.
+    """
+    row = conn.execute("SELECT lastID FROM rollup_state WHERE source = 'message'").fetchone()
+    counted = row[0] if row else 0
+
+    years = {dt.datetime.now().year}
+    first, last = conn.execute("SELECT MIN(messageID), MAX(messageID) FROM message").fetchone()
+    if first is not None:
+        years.update(range(archive.message_year(first), archive.message_year(last) + 1))
+
+    partitions = []
+    for year in sorted(years):
+        start, end = archive.year_range(year)
+        for statement in archive.partition_table_statements(year):
+            conn.execute(statement)
+        # Copied in id order, so the rows the rollups already counted are the first N of the partition
+        conn.execute(
+            f"""
+            INSERT INTO message_{year} (userID, messageID, channelID)
+            SELECT userID, messageID, channelID FROM message
+            WHERE messageID >= ? AND messageID < ? ORDER BY id
+            """,
+            (start, end),
+        )
+        already_counted = conn.execute(
+            "SELECT COUNT(*) FROM message WHERE messageID >= ? AND messageID < ? AND id <= ?",
+            (start, end, counted),
+        ).fetchone()[0]
+        conn.execute(
+            "INSERT OR REPLACE INTO rollup_state (source, lastID) VALUES (?, ?)",
+            (f"message_{year}", already_counted),
+        )
+        conn.execute("INSERT INTO message_partition (year) VALUES (?)", (year,))
+        partitions.append(archive.MessagePartition(year))
+
+    conn.execute("DROP TABLE message")
+    conn.execute("DELETE FROM rollup_state WHERE source = 'message'")
+    for statement in archive.view_statements(partitions):
+        conn.execute(statement)
+
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "Archive tables (v2)",
+        [rename_v1_archive_tables, *archive.SCHEMA],
+    ),
+    Migration(
+        2,
+        "Command usage (legacy) and suggestion tables",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS command_usage_legacy (
+                id INTEGER PRIMARY KEY,
+                count INTEGER
+            )
+            """,
+            # The single row, with id 1, value of 0
+            "INSERT OR IGNORE INTO command_usage_legacy (id, count) VALUES (1, 0)",
+            """
+            CREATE TABLE IF NOT EXISTS suggestion (
+                id INTEGER PRIMARY KEY,
+                userID INTEGER,
+                details TEXT,
+                devNotes TEXT,
+                timestamp TEXT
+            )
+            """,
+        ],
+    ),
+    Migration(
+        3,
+        "Recap indexes (user+time, channel+time, name+time)",
+        [
+            # Each index ends with the table's time column (see archive.TIME_COLUMN), so
+            # "this user/channel/command in this time range" is a single range scan,
+            # and counting them never touches the table itself
+            "CREATE INDEX IF NOT EXISTS message_user_time ON message (userID, messageID)",
+            "CREATE INDEX IF NOT EXISTS message_channel_time ON message (channelID, messageID)",
+            "CREATE INDEX IF NOT EXISTS reaction_user_time ON reaction (userID, snowflake)",
+            "CREATE INDEX IF NOT EXISTS reaction_name_time ON reaction (reactionID, snowflake)",
+            "CREATE INDEX IF NOT EXISTS command_user_time ON command (userID, interactionID)",
+            "CREATE INDEX IF NOT EXISTS command_name_time ON command (commandID, interactionID)",
+            "ANALYZE",
+        ],
+    ),
+    Migration(
+        4,
+        "Daily rollups (see rollups.py), backfilled from the archive",
+        [*rollups.CREATE, *rollups.catch_up_statements(["message"])],
+    ),
+    Migration(
+        5,
+        "Partition messages by year",
+        [archive.PARTITION_REGISTRY, partition_message_table],
+    ),
+    Migration(
+        6,
+        "Per-user recap cache",
+        [
+            # Filled by `python recap.py --users`, year 0 being all time
+            """
+            CREATE TABLE IF NOT EXISTS recap_cache (
+                userID INTEGER,
+                year INTEGER,
+                recap TEXT NOT NULL,
+                createdAt INTEGER,
+                PRIMARY KEY (userID, year)
+            )
+            """,
+        ],
+    ),
+    Migration(
+        7,
+        "Recap snapshot high-water marks",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS recap_state (
+                source TEXT PRIMARY KEY,
+                lastID INTEGER NOT NULL
+            )
+            """,
+        ],
+    ),
+    Migration(
+        8,
+        "Per-command usage counts",
+        [
+            # Commands served broken down by command, alongside command_usage_legacy's total
+            """
+            CREATE TABLE IF NOT EXISTS command_usage_count (
+                name TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+        ],
+    ),
+    Migration(
+        9,
+        "App command latency histograms",
+        [
+            # One row per command, phase, and 5 minute slice (see metrics.py). counts is the buckets as json
+            """
+            CREATE TABLE IF NOT EXISTS command_latency (
+                command TEXT,
+                phase TEXT,
+                slice INTEGER,
+                counts TEXT NOT NULL,
+                total REAL NOT NULL,
+                PRIMARY KEY (command, phase, slice)
+            )
+            """,
+        ],
+    ),
+]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    conn.execute(SCHEMA_VERSION_TABLE)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Applies every migration newer than the database's schema version, in order. Each migration is its own
+    transaction, so a failed one is rolled back entirely and nothing after it runs.
+
+    Returns the schema version the database ended up at.
+    """
+    version = current_version(conn)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+
+        start = time.perf_counter()
+        with conn:
+            # sqlite3 doesn't open a transaction for DDL on its own, without this CREATEs wouldn't roll back
+            conn.execute("BEGIN")
+            for step in migration.steps:
+                if isinstance(step, str):
+                    conn.execute(step)
+                else:
+                    step(conn)
+            duration = time.perf_counter() - start
+            conn.execute(
+                "INSERT INTO schema_version (version, name, appliedAt, duration) VALUES (?, ?, ?, ?)",
+                (migration.version, migration.name, archive.now_ms(), duration),
+            )
+
+        version = migration.version
+        logging.info(f"Applied migration {migration.version} ({migration.name}) in {duration * 1000:.1f}ms")
+    return version
+
+
+def migrate_database(path: str) -> int:
+    """Opens `path` and migrates it. Blocking, so the bot runs this in a thread"""
+    start = time.perf_counter()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    try:
+        version = migrate(conn)
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+    logging.info(f"{path} is at schema version {version} (migrations took {elapsed * 1000:.1f}ms)")
+    return version
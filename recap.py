@@ -1,11 +1,27 @@
+import argparse
 import datetime as dt
-import sqlite3
+import json
+import os
+import time
 from abc import ABC
-from typing import Any, Sequence
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from typing import Any, Iterable, Iterator, NamedTuple, Sequence
+
+import humanize
+import numpy as np
+
+import analytics
+import archive
+import rollups
 
 # Goon server year in a review!
 
-db_path = "gbdb.sqlite"
+# Everything is counted from the read-only analytics copy (see analytics.py), so recap never holds up the
+# archiver. Built recaps are saved to recap_cache in the live database, the copy is replaced every snapshot
+db_path = "gbdb.analytics.sqlite"
+cache_path = "gbdb.sqlite"
 
 """
 The recap will consist of 2 parts: a server wide and one for each user
@@ -31,156 +47,829 @@ User recap:
 """
 
 
+class Filter(NamedTuple):
+    # Snowflakes in [start, end), see archive.snowflake_range
+    between: tuple[int, int] | None = None
+    user_id: int | None = None
+
+
+def this_year() -> Filter:
+    return Filter(between=archive.year_range(dt.datetime.now().year))
+
+
+def where(table: str, filter: Filter) -> tuple[str, tuple[int, ...]]:
+    """WHERE clause (and parameters) for a filter, or nothing if it doesn't filter anything"""
+    clauses, parameters = [], []
+    if filter.between:
+        clauses.append(f"{archive.TIME_COLUMN[table]} >= ? AND {archive.TIME_COLUMN[table]} < ?")
+        parameters += filter.between
+    if filter.user_id is not None:
+        clauses.append("userID = ?")
+        parameters.append(filter.user_id)
+    if not clauses:
+        return "", ()
+    return "WHERE " + " AND ".join(clauses), tuple(parameters)
+
+
+# Rows
+# Rows are streamed straight off the cursor, one at a time, instead of fetching the whole table into a list.
+# Row classes use __slots__ (no per-row __dict__), and only turn their snowflake into a datetime if asked.
+
+
 class Row(ABC):
+    __slots__ = ("id", "userID", "snowflake")
 
-    def __init__(self, id: str, userID: int, timestamp: str):
+    def __init__(self, id: int, userID: int, snowflake: int):
         self.id = id
         self.userID = userID
-        self.timestamp = dt.datetime.fromisoformat(timestamp)
+        # Every archive row has a snowflake that says when it happened (see archive.TIME_COLUMN)
+        self.snowflake = snowflake
 
-    def __init_subclass__(cls, **kwargs):
-        super().__init_subclass__(**kwargs)
+    @property
+    def timestamp(self) -> dt.datetime:
+        return archive.snowflake_to_datetime(self.snowflake)
 
     def __repr__(self):
         return f"{self.__class__.__name__}(id={self.id}, userID={self.userID}, timestamp={self.timestamp})"
 
 
 class MessageRow(Row):
-    def __init__(self, id: str, userID: int, messageID: int, channelID: int, timestamp: str):
-        super().__init__(id, userID, timestamp)
-        self.messageID = messageID
+    __slots__ = ("channelID",)
+
+    def __init__(self, id: int, userID: int, messageID: int, channelID: int):
+        super().__init__(id, userID, messageID)
         self.channelID = channelID
 
+    @property
+    def messageID(self) -> int:
+        return self.snowflake
+
 
 class ReactionRow(Row):
-    def __init__(self, id: str, userID: int, reactionStr: str, messageID: int, timestamp: str):
-        super().__init__(id, userID, timestamp)
+    __slots__ = ("reactionStr", "messageID")
+
+    def __init__(self, id: int, userID: int, reactionStr: str, messageID: int, snowflake: int):
+        super().__init__(id, userID, snowflake)
         self.reactionStr = reactionStr
         self.messageID = messageID
 
 
 class CommandRow(Row):
-    def __init__(self, id: str, userID: int, commandName: str, timestamp: str):
-        super().__init__(id, userID, timestamp)
-        self.commandName = commandName
-
-
-def get_all_rows_from_table(table: str) -> list[Any]:
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT * FROM {table}")
-        return cursor.fetchall()
-
-
-def get_commands() -> list[CommandRow]:
-    command_rows = get_all_rows_from_table("command")
-    return [CommandRow(*row) for row in command_rows]
-
-
-def get_messages() -> list[MessageRow]:
-    message_rows = get_all_rows_from_table("message")
-    return [MessageRow(*row) for row in message_rows]
+    __slots__ = ("commandName",)
 
+    def __init__(self, id: int, userID: int, commandName: str, interactionID: int):
+        super().__init__(id, userID, interactionID)
+        self.commandName = commandName
+
+    @property
+    def interactionID(self) -> int:
+        return self.snowflake
+
+
+ROW_CLASSES = {"message": MessageRow, "reaction": ReactionRow, "command": CommandRow}
+
+# Selects rows in the same column order as the Row classes, resolving dictionary encoded names (archive.py)
+SELECT_ROWS = {
+    "command": """
+        SELECT command.id, userID, command_name.name, interactionID
+        FROM command JOIN command_name ON command_name.id = command.commandID
+    """,
+    "reaction": """
+        SELECT reaction.id, userID, reaction_name.name, messageID, snowflake
+        FROM reaction JOIN reaction_name ON reaction_name.id = reaction.reactionID
+    """,
+    "message": "SELECT id, userID, messageID, channelID FROM message",
+}
+
+
+def iter_rows(table: str, filter: Filter = Filter()) -> Iterator[Row]:
+    """
+    Every row from an archive table matching `filter`. sqlite steps the cursor as it's iterated, so only
+    one row is ever in memory at a time. (No ORDER BY, sorting would make sqlite hold every row itself)
+    """
+    clause, parameters = where(table, filter)
+    row_class = ROW_CLASSES[table]
+    # Attaches the message partitions that were moved to their own file
+    with closing(archive.connect(db_path, read_only=True)) as conn:
+        for row in conn.execute(f"{SELECT_ROWS[table]} {clause}", parameters):
+            yield row_class(*row)
 
-def get_reactions() -> list[ReactionRow]:
-    reaction_rows = get_all_rows_from_table("reaction")
-    return [ReactionRow(*row) for row in reaction_rows]
 
+def iter_commands(filter: Filter = Filter()) -> Iterator[CommandRow]:
+    return iter_rows("command", filter)
+
+
+def iter_messages(filter: Filter = Filter()) -> Iterator[MessageRow]:
+    return iter_rows("message", filter)
 
-# Filters
+
+def iter_reactions(filter: Filter = Filter()) -> Iterator[ReactionRow]:
+    return iter_rows("reaction", filter)
 
 
-def filter_rows_this_year_only(rows: Sequence[Row]):
-    return [row for row in rows if row.timestamp.year == dt.datetime.now().year]
+# Queries
+# Filtering, grouping, sorting, and limiting are all pushed down into sqlite, so only the answer comes back
+# (a handful of rows) instead of every row in the archive. The time filter is an indexed range scan.
+#
+# The rollups (below) are faster for anything in whole days. These are for everything else, like a
+# single user, time of day, or a range that doesn't line up with days.
+
+# What each archive table is selected from, with names resolved (see archive.py)
+FROM = {
+    "message": "message",
+    "reaction": "reaction JOIN reaction_name ON reaction_name.id = reaction.reactionID",
+    "command": "command JOIN command_name ON command_name.id = command.commandID",
+}
+
+# What rows can be grouped by: (table, key) -> (selected column, grouped column)
+GROUP_KEYS = {
+    ("message", "user"): ("userID", "userID"),
+    ("message", "channel"): ("channelID", "channelID"),
+    ("reaction", "user"): ("userID", "userID"),
+    ("reaction", "reaction"): ("reaction_name.name", "reactionID"),
+    ("command", "user"): ("userID", "userID"),
+    ("command", "command"): ("command_name.name", "commandID"),
+}
+
+
+def query(sql: str, parameters: Sequence[Any] = ()) -> list[Any]:
+    with closing(archive.connect(db_path, read_only=True)) as conn:
+        return conn.execute(sql, parameters).fetchall()
+
+
+def count(table: str, filter: Filter = Filter()) -> int:
+    clause, parameters = where(table, filter)
+    return query(f"SELECT COUNT(*) FROM {table} {clause}", parameters)[0][0]
+
+
+def count_by(table: str, key: str, filter: Filter = Filter(), limit: int | None = None) -> dict[Any, int]:
+    """
+    Counts rows per `key` (see GROUP_KEYS), in decreasing order
+
+    Example
+    ```py
+    # Top 5 reactions this year
+    count_by("reaction", "reaction", this_year(), limit=5)
+    ```
+    """
+    column, group = GROUP_KEYS[(table, key)]
+    clause, parameters = where(table, filter)
+    rows = query(
+        f"""
+        SELECT {column}, COUNT(*) AS total FROM {FROM[table]} {clause}
+        GROUP BY {group} ORDER BY total DESC LIMIT ?
+        """,
+        # sqlite treats a negative LIMIT as no limit
+        (*parameters, -1 if limit is None else limit),
+    )
+    return dict(rows)
+
+
+def count_per_day(table: str, filter: Filter = Filter()) -> dict[dt.date, int]:
+    clause, parameters = where(table, filter)
+    day = rollups.day_expression(archive.TIME_COLUMN[table])
+    rows = query(f"SELECT {day} AS day, COUNT(*) FROM {table} {clause} GROUP BY day ORDER BY day", parameters)
+    return {dt.date.fromisoformat(day): total for day, total in rows}
+
+
+def count_per_hour(table: str, filter: Filter = Filter()) -> dict[int, int]:
+    """Rows per (local) hour of the day, 0-23"""
+    clause, parameters = where(table, filter)
+    ms = f"(({archive.TIME_COLUMN[table]} >> 22) + {archive.DISCORD_EPOCH})"
+    hour = f"CAST(strftime('%H', {ms} / 1000, 'unixepoch', 'localtime') AS INTEGER)"
+    rows = query(
+        f"SELECT {hour} AS hour, COUNT(*) FROM {table} {clause} GROUP BY hour ORDER BY hour",
+        parameters,
+    )
+    return dict(rows)
+
+
+# Rollups
+# Counts from the daily rollup tables (see rollups.py), which only hold a row per day per key instead of
+# a row per event. The archiver keeps them up to date as it writes, and they're caught up once more right
+# before an analytics snapshot is taken, so they're only ever read here.
+
+
+def query_rollups(query: str, parameters: Sequence[Any] = ()) -> list[Any]:
+    with closing(archive.connect(db_path, read_only=True)) as conn:
+        return conn.execute(query, parameters).fetchall()
+
+
+def year_filter(year: int | None) -> tuple[str, tuple[str, ...]]:
+    """WHERE clause (and parameters) limiting a rollup to one year, or nothing if year is None"""
+    if year is None:
+        return "", ()
+    return "WHERE day >= ? AND day < ?", rollups.year_days(year)
+
+
+def total_from_rollup(rollup: str, year: int | None = None) -> int:
+    where, parameters = year_filter(year)
+    rows = query_rollups(f"SELECT COALESCE(SUM(count), 0) FROM {rollup} {where}", parameters)
+    return rows[0][0]
+
+
+def messages_per_day(year: int | None = None) -> dict[dt.date, int]:
+    where, parameters = year_filter(year)
+    rows = query_rollups(
+        f"SELECT day, SUM(count) FROM message_daily {where} GROUP BY day ORDER BY day",
+        parameters,
+    )
+    return {dt.date.fromisoformat(day): count for day, count in rows}
+
+
+def top_chatters(limit: int = 5, year: int | None = None) -> dict[int, int]:
+    where, parameters = year_filter(year)
+    rows = query_rollups(
+        f"""
+        SELECT userID, SUM(count) AS total FROM message_daily {where}
+        GROUP BY userID ORDER BY total DESC LIMIT ?
+        """,
+        (*parameters, limit),
+    )
+    return dict(rows)
+
+
+def top_reactions(limit: int = 5, year: int | None = None) -> dict[str, int]:
+    where, parameters = year_filter(year)
+    rows = query_rollups(
+        f"""
+        SELECT reaction_name.name, SUM(count) AS total
+        FROM reaction_daily JOIN reaction_name ON reaction_name.id = reaction_daily.reactionID
+        {where} GROUP BY reactionID ORDER BY total DESC LIMIT ?
+        """,
+        (*parameters, limit),
+    )
+    return dict(rows)
+
+
+def top_commands(limit: int = 5, year: int | None = None) -> dict[str, int]:
+    where, parameters = year_filter(year)
+    rows = query_rollups(
+        f"""
+        SELECT command_name.name, SUM(count) AS total
+        FROM command_daily JOIN command_name ON command_name.id = command_daily.commandID
+        {where} GROUP BY commandID ORDER BY total DESC LIMIT ?
+        """,
+        (*parameters, limit),
+    )
+    return dict(rows)
 
 
-def filter_rows_by_user_id(rows: Sequence[Row], user_id: int):
-    return [row for row in rows if row.userID == user_id]
+# Fun stuff
+def get_messages_per_day(filter: Filter = Filter()) -> dict[dt.date, int]:
+    return count_per_day("message", filter)
 
 
-# Fun stuff
-def get_messages_per_day(messages: Sequence[MessageRow]) -> dict[dt.date, int]:
-    messages_per_day = {}
-    for message in messages:
-        date = message.timestamp.date()
-        if date not in messages_per_day:
-            messages_per_day[date] = 0
-        messages_per_day[date] += 1
-    return messages_per_day
-
-
-def avergage_messages_per_day(messages: Sequence[MessageRow]):
-    messages_this_year = len(filter_rows_this_year_only(messages))
-    if messages_this_year == 0:
-        return 0
+def avergage_messages_per_day(user_id: int | None = None) -> float:
+    messages_this_year = count("message", this_year()._replace(user_id=user_id))
     days_this_year = (dt.datetime.now() - dt.datetime(dt.datetime.now().year, 1, 1)).days
     return messages_this_year / (days_this_year or 1)
 
 
-def count_reactions(reactions: Sequence[ReactionRow]) -> dict[str, int]:
-    reaction_counts = {}
-    for reaction in reactions:
-        if reaction.reactionStr not in reaction_counts:
-            reaction_counts[reaction.reactionStr] = 0
-        reaction_counts[reaction.reactionStr] += 1
-    # Sort in decreasing order
-    reaction_counts = dict(sorted(reaction_counts.items(), key=lambda item: item[1], reverse=True))
-    return reaction_counts
-
-
-def count_chatters(messages: Sequence[MessageRow]) -> dict[int, int]:
-    chatters = {}
-    for message in messages:
-        if message.userID not in chatters:
-            chatters[message.userID] = 0
-        chatters[message.userID] += 1
-    # Sort in decreasing order
-    chatters = dict(sorted(chatters.items(), key=lambda item: item[1], reverse=True))
-    return chatters
-
-
-def count_commands(commands: Sequence[CommandRow]) -> dict[str, int]:
-    command_counts = {}
-    for command in commands:
-        if command.commandName not in command_counts:
-            command_counts[command.commandName] = 0
-        command_counts[command.commandName] += 1
-    # Sort in decreasing order
-    command_counts = dict(sorted(command_counts.items(), key=lambda item: item[1], reverse=True))
-    return command_counts
-
-
-def print_recap():
-    commands = get_commands()
-    messages = get_messages()
-    reactions = get_reactions()
-
-    commands_this_year = filter_rows_this_year_only(commands)
-    messages_this_year = filter_rows_this_year_only(messages)
-    reactions_this_year = filter_rows_this_year_only(reactions)
-
-    print("Commands this year:", len(commands_this_year))
-    print("Messages this year:", len(messages_this_year))
-    print("Messages per day this year:", round(avergage_messages_per_day(messages), 2))
+def count_reactions(filter: Filter = Filter(), limit: int | None = None) -> dict[str, int]:
+    return count_by("reaction", "reaction", filter, limit)
+
+
+def count_chatters(filter: Filter = Filter(), limit: int | None = None) -> dict[int, int]:
+    return count_by("message", "user", filter, limit)
+
+
+def count_commands(filter: Filter = Filter(), limit: int | None = None) -> dict[str, int]:
+    return count_by("command", "command", filter, limit)
+
+
+# Streaming
+# Computes every statistic the recap needs in one pass over the rows, for when the rollups aren't an option
+# (a rebuilt/migrated archive that hasn't been caught up yet, or double checking them). Memory stays flat,
+# it only ever holds the counters, which have an entry per user/channel/day/etc, never per row.
+
+
+class LocalHours:
+    """
+    Turns snowflakes into (local date, hour) without making a datetime for every row. Rows mostly arrive in
+    time order, so the last hour's snowflake range is remembered and almost every lookup is two comparisons.
+    """
+
+    __slots__ = ("start", "end", "day", "hour")
+
+    def __init__(self):
+        self.start = self.end = 0
+        self.day: dt.date | None = None
+        self.hour = 0
+
+    def __call__(self, snowflake: int) -> tuple[dt.date, int]:
+        if not self.start <= snowflake < self.end:
+            when = archive.snowflake_to_datetime(snowflake).replace(minute=0, second=0, microsecond=0)
+            self.start, self.end = archive.snowflake_range(when, when + dt.timedelta(hours=1))
+            self.day, self.hour = when.date(), when.hour
+        return self.day, self.hour
+
+
+class RecapAggregator:
+    """
+    Single pass aggregator, counts everything print_recap shows (and more) as rows stream by
+
+    Example
+    ```py
+    recap = RecapAggregator(this_year())
+    recap.consume(iter_messages(), iter_reactions(), iter_commands())
+    recap.chatters.most_common(5)
+    ```
+    """
+
+    __slots__ = (
+        "year",
+        "local_hours",
+        "messages_this_year",
+        "commands_this_year",
+        "reactions_this_year",
+        "chatters",
+        "channels",
+        "messages_per_day",
+        "messages_per_hour",
+        "reactions",
+        "commands",
+    )
+
+    def __init__(self, year: Filter | None = None):
+        # What counts as "this year" for the *_this_year totals, everything else counts all rows
+        self.year = (year or this_year()).between
+        self.local_hours = LocalHours()
+        self.messages_this_year = 0
+        self.commands_this_year = 0
+        self.reactions_this_year = 0
+        self.chatters = Counter()
+        self.channels = Counter()
+        self.messages_per_day = Counter()
+        self.messages_per_hour = Counter()
+        self.reactions = Counter()
+        self.commands = Counter()
+
+    def in_year(self, snowflake: int) -> bool:
+        return self.year[0] <= snowflake < self.year[1]
+
+    def add_message(self, message: MessageRow):
+        day, hour = self.local_hours(message.snowflake)
+        self.messages_per_day[day] += 1
+        self.messages_per_hour[hour] += 1
+        self.chatters[message.userID] += 1
+        self.channels[message.channelID] += 1
+        self.messages_this_year += self.in_year(message.snowflake)
+
+    def add_reaction(self, reaction: ReactionRow):
+        self.reactions[reaction.reactionStr] += 1
+        self.reactions_this_year += self.in_year(reaction.snowflake)
+
+    def add_command(self, command: CommandRow):
+        self.commands[command.commandName] += 1
+        self.commands_this_year += self.in_year(command.snowflake)
+
+    def consume(
+        self,
+        messages: Iterable[MessageRow] = (),
+        reactions: Iterable[ReactionRow] = (),
+        commands: Iterable[CommandRow] = (),
+    ) -> "RecapAggregator":
+        for message in messages:
+            self.add_message(message)
+        for reaction in reactions:
+            self.add_reaction(reaction)
+        for command in commands:
+            self.add_command(command)
+        return self
+
+
+def stream_recap(filter: Filter = Filter()) -> RecapAggregator:
+    """Streams every archive row matching `filter` through a RecapAggregator"""
+    return RecapAggregator().consume(iter_messages(filter), iter_reactions(filter), iter_commands(filter))
+
+
+# Arrays
+# For the heavier questions (busiest time of day, busiest day, weekday x hour heatmaps), the columns that
+# matter are loaded into typed numpy arrays and counted with bincount, instead of a dict lookup per row.
+# An array of 1M rows is ~8MB a column, which is fine for a recap ran on demand.
+
+# The (non-time) column each table's rows are keyed by
+KEY_COLUMN = {"message": "channelID", "reaction": "reactionID", "command": "commandID"}
+
+SECONDS_PER_HOUR = 60 * 60
+SECONDS_PER_DAY = 24 * SECONDS_PER_HOUR
+
+
+class Columns(NamedTuple):
+    # Index into `users`, per row. Codes instead of raw ids, so bincount can count them
+    user: np.ndarray
+    # The distinct user ids
+    users: np.ndarray
+    # channelID for messages, reactionID/commandID (name codes) for reactions/commands
+    key: np.ndarray
+    # When each row happened, as local time seconds since the epoch
+    local: np.ndarray
+
+
+def local_seconds(epoch_ms: np.ndarray) -> np.ndarray:
+    """
+    Epoch milliseconds to local epoch seconds. The UTC offset is looked up once per hour the rows span
+    (DST changes on the hour), not once per row.
+    """
+    seconds = epoch_ms // 1000
+    if not len(seconds):
+        return seconds
+    hours = seconds // SECONDS_PER_HOUR
+    first, last = int(hours.min()), int(hours.max())
+    offsets = np.array(
+        [time.localtime(hour * SECONDS_PER_HOUR).tm_gmtoff for hour in range(first, last + 1)],
+        dtype=np.int64,
+    )
+    return seconds + offsets[hours - first]
+
+
+def to_columns(user_ids: np.ndarray, keys: np.ndarray, epoch_ms: np.ndarray) -> Columns:
+    users, user_codes = np.unique(user_ids, return_inverse=True)
+    return Columns(user_codes, users, keys, local_seconds(epoch_ms))
+
+
+def load_columns(table: str, filter: Filter = Filter(), chunk_size: int = 100_000) -> Columns:
+    clause, parameters = where(table, filter)
+    epoch_ms = f"({archive.TIME_COLUMN[table]} >> 22) + {archive.DISCORD_EPOCH}"
+    chunks = []
+    with closing(archive.connect(db_path, read_only=True)) as conn:
+        cursor = conn.execute(
+            f"SELECT userID, {KEY_COLUMN[table]}, {epoch_ms} FROM {table} {clause}",
+            parameters,
+        )
+        while rows := cursor.fetchmany(chunk_size):
+            chunks.append(np.array(rows, dtype=np.int64))
+    data = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.int64)
+    return to_columns(data[:, 0], data[:, 1], data[:, 2])
+
+
+def hour_histogram(columns: Columns) -> np.ndarray:
+    """Rows per local hour of the day, index 0-23"""
+    return np.bincount((columns.local % SECONDS_PER_DAY) // SECONDS_PER_HOUR, minlength=24)
+
+
+def busiest_window(histogram: np.ndarray, window: int) -> tuple[int, int]:
+    """Start hour and row count of the busiest `window` hours in a row (wrapping past midnight), 1-24"""
+    # 0 hours has no busiest start, and more than 24 would count hours twice
+    if not 1 <= window <= 24:
+        raise ValueError(f"window must be between 1 and 24 hours, not {window}")
+    totals = sum(np.roll(histogram, -offset) for offset in range(window))
+    start = int(np.argmax(totals))
+    return start, int(totals[start])
+
+
+def busiest_day_of(columns: Columns) -> tuple[dt.date, int]:
+    days = columns.local // SECONDS_PER_DAY
+    first = int(days.min())
+    counts = np.bincount(days - first)
+    busiest = int(np.argmax(counts))
+    return dt.date(1970, 1, 1) + dt.timedelta(days=first + busiest), int(counts[busiest])
+
+
+def heatmap_of(columns: Columns) -> np.ndarray:
+    """7x24 rows per weekday (Monday first) and local hour"""
+    days = columns.local // SECONDS_PER_DAY
+    # 1970-01-01 was a Thursday
+    weekdays = (days + 3) % 7
+    hours = (columns.local % SECONDS_PER_DAY) // SECONDS_PER_HOUR
+    return np.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+
+
+def top_users_of(columns: Columns, limit: int) -> dict[int, int]:
+    counts = np.bincount(columns.user, minlength=len(columns.users))
+    top = np.argsort(counts)[::-1][:limit]
+    return {int(columns.users[code]): int(counts[code]) for code in top}
+
+
+def busiest_hours(filter: Filter = Filter(), window: int = 1, table: str = "message") -> tuple[int, int]:
+    """
+    The busiest `window` hour stretch of the day, as (start hour, count)
+
+    Example
+    ```py
+    # Busiest 3 hours of the day for messages this year, (21, 4096) being 9pm-midnight
+    busiest_hours(this_year(), window=3)
+    ```
+    """
+    return busiest_window(hour_histogram(load_columns(table, filter)), window)
+
+
+def busiest_day(filter: Filter = Filter(), table: str = "message") -> tuple[dt.date, int] | None:
+    columns = load_columns(table, filter)
+    if not len(columns.local):
+        return None
+    return busiest_day_of(columns)
+
+
+def weekday_hour_heatmap(user_id: int | None = None, filter: Filter = Filter(), table: str = "message"):
+    """7x24 array of rows per weekday (Monday first) and hour, for one user or everyone"""
+    return heatmap_of(load_columns(table, filter._replace(user_id=user_id)))
+
+
+def synthetic_columns(row_count: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fake (userID, channelID, epoch ms) columns spread across this year, for benchmarking"""
+    rng = np.random.default_rng()
+    user_ids = rng.integers(1 << 59, 1 << 60, size=20, dtype=np.int64)
+    channel_ids = rng.integers(1 << 59, 1 << 60, size=30, dtype=np.int64)
+    start = int(dt.datetime(dt.datetime.now().year, 1, 1).timestamp() * 1000)
+    epoch_ms = np.sort(rng.integers(start, start + 365 * SECONDS_PER_DAY * 1000, size=row_count))
+    return rng.choice(user_ids, row_count), rng.choice(channel_ids, row_count), epoch_ms
+
+
+def dict_loop_stats(user_ids: list[int], epoch_ms: list[int]) -> tuple:
+    """The same statistics as the numpy functions, counted the way recap used to (a datetime per row)"""
+    users, hours, days, heatmap = {}, {}, {}, {}
+    for user_id, ms in zip(user_ids, epoch_ms):
+        when = dt.datetime.fromtimestamp(ms / 1000)
+        users[user_id] = users.get(user_id, 0) + 1
+        hours[when.hour] = hours.get(when.hour, 0) + 1
+        days[when.date()] = days.get(when.date(), 0) + 1
+        cell = (when.weekday(), when.hour)
+        heatmap[cell] = heatmap.get(cell, 0) + 1
+    return users, hours, days, heatmap
+
+
+def benchmark(row_counts: Sequence[int]):
+    """Times the dict loops against numpy, for the busiest hour, busiest day, heatmap, and top users"""
+    for row_count in row_counts:
+        user_ids, channel_ids, epoch_ms = synthetic_columns(row_count)
+
+        start = time.perf_counter()
+        columns = to_columns(user_ids, channel_ids, epoch_ms)
+        busiest_window(hour_histogram(columns), 1)
+        busiest_day_of(columns)
+        heatmap_of(columns)
+        top_users_of(columns, 5)
+        numpy_elapsed = time.perf_counter() - start
+
+        # Converted to lists outside of the timing, the rows used to come out of the cursor as Python ints
+        python_elapsed = 0.0
+        for i in range(0, row_count, 1_000_000):
+            user_chunk, ms_chunk = user_ids[i : i + 1_000_000].tolist(), epoch_ms[i : i + 1_000_000].tolist()
+            start = time.perf_counter()
+            dict_loop_stats(user_chunk, ms_chunk)
+            python_elapsed += time.perf_counter() - start
+
+        print(
+            f"{row_count:,} rows: dict loops {python_elapsed:.2f}s, numpy {numpy_elapsed:.2f}s "
+            f"({python_elapsed / numpy_elapsed:.0f}x faster)"
+        )
+
+
+# Per-user recaps
+# Every member's recap is built in one batch, and saved to the recap_cache table (see migrations.py) so
+# handing one out is a single primary key lookup.
+#
+# Users are split into shards, and each shard is counted by its own process (the Pi has four cores). A
+# worker queries each table (and every message partition) once for its whole shard, grouped by (user, key)
+# in sqlite. Where sqlite scans rather than using the user+time indexes, that's the archive read once per
+# worker (four times), instead of once per user.
+
+
+class UserRecap(NamedTuple):
+    userID: int
+    commands: int
+    favoriteCommand: str | None
+    favoriteCommandCount: int
+    messages: int
+    topChannel: int | None
+    topChannelCount: int
+    reactions: int
+    # [(reaction, count), ...], most used first
+    favoriteReactions: list[tuple[str, int]]
+
+
+# (user, key, count) for a shard of users, keys are resolved to names (see archive.py)
+SELECT_USER_COUNTS = {
+    "command": "SELECT userID, command_name.name, COUNT(*) FROM {from_} {where} GROUP BY 1, commandID",
+    "message": "SELECT userID, channelID, COUNT(*) FROM {from_} {where} GROUP BY 1, 2",
+    "reaction": "SELECT userID, reaction_name.name, COUNT(*) FROM {from_} {where} GROUP BY 1, reactionID",
+}
+
+
+def recap_users(database: str, between: tuple[int, int] | None = None) -> list[int]:
+    """Everyone with at least one archived row (in `between`)"""
+    selects = []
+    parameters = []
+    for table in archive.ARCHIVE_TABLES:
+        clause, table_parameters = where(table, Filter(between))
+        selects.append(f"SELECT DISTINCT userID FROM {table} {clause}")
+        parameters += table_parameters
+    with closing(archive.connect(database, read_only=True)) as conn:
+        return [row[0] for row in conn.execute(" UNION ".join(selects), parameters)]
+
+
+def user_recaps(database: str, user_ids: list[int], between: tuple[int, int] | None) -> list[UserRecap]:
+    """Builds the recaps for a shard of users. Ran in a worker process, so it opens its own connection"""
+    counts = {table: {user_id: Counter() for user_id in user_ids} for table in archive.ARCHIVE_TABLES}
+    with closing(archive.connect(database, read_only=True)) as conn:
+        for table in archive.ARCHIVE_TABLES:
+            clause, parameters = where(table, Filter(between))
+            users = f"userID IN ({', '.join('?' * len(user_ids))})"
+            clause = f"{clause} AND {users}" if clause else f"WHERE {users}"
+            query = SELECT_USER_COUNTS[table].format(from_=FROM[table], where=clause)
+            for user_id, key, total in conn.execute(query, (*parameters, *user_ids)):
+                counts[table][user_id][key] = total
+
+    recaps = []
+    for user_id in user_ids:
+        commands = counts["command"][user_id]
+        messages = counts["message"][user_id]
+        reactions = counts["reaction"][user_id]
+        favorite_command, favorite_command_count = (commands.most_common(1) or [(None, 0)])[0]
+        top_channel, top_channel_count = (messages.most_common(1) or [(None, 0)])[0]
+        recaps.append(
+            UserRecap(
+                userID=user_id,
+                commands=commands.total(),
+                favoriteCommand=favorite_command,
+                favoriteCommandCount=favorite_command_count,
+                messages=messages.total(),
+                topChannel=top_channel,
+                topChannelCount=top_channel_count,
+                reactions=reactions.total(),
+                favoriteReactions=reactions.most_common(3),
+            )
+        )
+    return recaps
+
+
+def build_user_recaps(year: int | None = None, workers: int = 4) -> int:
+    """
+    Builds every user's recap for `year` (or all time), in parallel, and replaces them in recap_cache.
+    Returns how many were built.
+    """
+    between = archive.year_range(year) if year else None
+    user_ids = recap_users(db_path, between)
+    # Round robin, so one shard doesn't end up with every heavy hitter
+    shards = [shard for shard in (user_ids[i::workers] for i in range(workers)) if shard]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(user_recaps, db_path, shard, between) for shard in shards]
+        recaps = [recap for future in futures for recap in future.result()]
+
+    created_at = analytics.snapshot_taken_at(db_path) or archive.now_ms()
+    with closing(archive.connect(cache_path)) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO recap_cache (userID, year, recap, createdAt) VALUES (?, ?, ?, ?)",
+            [(recap.userID, year or 0, json.dumps(recap._asdict()), created_at) for recap in recaps],
+        )
+    return len(recaps)
+
+
+def cached_user_recap(user_id: int, year: int | None = None) -> UserRecap | None:
+    """A recap from build_user_recaps, or None if it hasn't been built. `year` None is all time"""
+    with closing(archive.connect(cache_path)) as conn:
+        row = conn.execute(
+            "SELECT recap FROM recap_cache WHERE userID = ? AND year = ?",
+            (user_id, year or 0),
+        ).fetchone()
+    if row is None:
+        return None
+    recap = json.loads(row[0])
+    recap["favoriteReactions"] = [tuple(reaction) for reaction in recap["favoriteReactions"]]
+    return UserRecap(**recap)
+
+
+# Snapshot
+# What /recap is served from (see cogs/recap.py). The server's recap, and each user's, for this year, saved in
+# recap_cache (the server as user 0). A background task keeps it fresh incrementally:
+#
+# - The server recap is counted from the rollups, which the archiver already keeps up to date a day at a time
+# - Users are only recounted if they have rows past the high-water marks in recap_state (like rollup_state),
+#   so a refresh costs the rows since the last one, plus the recount of whoever sent them
+
+SERVER = 0
+
+
+class RecapSnapshot(NamedTuple):
+    # (userID, year, recap as json), for recap_cache
+    recaps: list[tuple[int, int, str]]
+    # recap_state's new high-water marks, source table -> last id
+    marks: dict[str, int]
+    # When the analytics copy this was counted from was taken (epoch ms), None if it was the live database
+    takenAt: int | None
+
+
+def server_recap(year: int) -> dict[str, Any]:
+    """The server wide recap for `year`, from the rollups"""
+    per_day = messages_per_day(year)
+    busiest = max(per_day.items(), key=lambda day: day[1], default=None)
+    return {
+        "messages": total_from_rollup("message_daily", year),
+        "commands": total_from_rollup("command_daily", year),
+        "reactions": total_from_rollup("reaction_daily", year),
+        "topChatters": list(top_chatters(5, year).items()),
+        "topReactions": list(top_reactions(5, year).items()),
+        "topCommands": list(top_commands(5, year).items()),
+        "busiestDay": (busiest[0].isoformat(), busiest[1]) if busiest else None,
+    }
+
+
+def refresh_snapshot(year: int, marks: dict[str, int]) -> RecapSnapshot:
+    """
+    Recounts the server, and every user with rows past `marks`. Blocking, and it only reads the archive
+    (every connection is read-only, rollups included, see query_rollups), the caller writes the snapshot.
+    """
+    taken_at = analytics.snapshot_taken_at(db_path)
+    with closing(archive.connect(db_path, read_only=True)) as conn:
+        sources = [*rollups.message_tables(conn), "reaction", "command"]
+        changed_users = set()
+        new_marks = {}
+        for source in sources:
+            # Marks are per table, regardless of which database file it's in (like rollups.py)
+            state_key = source.split(".")[-1]
+            last_id = marks.get(state_key, 0)
+            # The new mark is read first, so rows written in between are left for the next refresh
+            new_mark = conn.execute(f"SELECT COALESCE(MAX(id), ?) FROM {source}", (last_id,)).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT DISTINCT userID FROM {source} WHERE id > ? AND id <= ?",
+                (last_id, new_mark),
+            )
+            changed_users.update(row[0] for row in rows)
+            new_marks[state_key] = new_mark
+
+    recaps = [(SERVER, year, json.dumps(server_recap(year)))]
+    if changed_users:
+        for user_recap in user_recaps(db_path, sorted(changed_users), archive.year_range(year)):
+            recaps.append((user_recap.userID, year, json.dumps(user_recap._asdict())))
+    return RecapSnapshot(recaps, new_marks, taken_at)
+
+
+def print_recap(streamed: bool = False):
+    """Prints the recap from the rollups, or from one streamed pass over the raw rows if `streamed`"""
+    year = dt.datetime.now().year
+    days_this_year = (dt.datetime.now() - dt.datetime(year, 1, 1)).days
+    if streamed:
+        recap = stream_recap()
+        commands_this_year, messages_this_year = recap.commands_this_year, recap.messages_this_year
+        reactions = dict(recap.reactions.most_common(5))
+        chatters = dict(recap.chatters.most_common(5))
+        commands = dict(recap.commands.most_common(5))
+    else:
+        commands_this_year = total_from_rollup("command_daily", year)
+        messages_this_year = total_from_rollup("message_daily", year)
+        reactions, chatters, commands = top_reactions(5), top_chatters(5), top_commands(5)
+
+    print("Commands this year:", commands_this_year)
+    print("Messages this year:", messages_this_year)
+    print("Messages per day this year:", round(messages_this_year / (days_this_year or 1), 2))
 
     # Top 5 reactions
-    reaction_counts = count_reactions(reactions)
     print("Top 5 reactions:")
-    for reaction, count in list(reaction_counts.items())[:5]:
+    for reaction, count in reactions.items():
         print(f"{reaction}: {count}")
 
     # Top 5 chatters
-    chatters = count_chatters(messages)
     print("Top 5 chatters:")
-    for chatter_id, count in list(chatters.items())[:5]:
+    for chatter_id, count in chatters.items():
         print(f"{chatter_id}: {count}")
 
     # Top 5 commands
-    command_counts = count_commands(commands)
     print("Top 5 commands:")
-    for command, count in list(command_counts.items())[:5]:
+    for command, count in commands.items():
         print(f"{command}: {count}")
 
+    print_snapshot_age()
+
+
+def print_snapshot_age():
+    age = analytics.snapshot_age(db_path)
+    if age is None:
+        print(f"Counted from {db_path} (live, not a snapshot)")
+    else:
+        print(f"Counted from a snapshot taken {humanize.naturaldelta(age)} ago")
+
 
 if __name__ == "__main__":
-    print_recap()
+    parser = argparse.ArgumentParser(description="Goon server year in review")
+    parser.add_argument("--database", default=cache_path, help="The live database, where recap_cache is")
+    parser.add_argument("--analytics", default=db_path, help="The analytics copy to count from")
+    parser.add_argument("--snapshot", action="store_true", help="Take a fresh analytics copy first")
+    parser.add_argument("--stream", action="store_true", help="Count the raw rows instead of the rollups")
+    parser.add_argument("--users", action="store_true", help="Build every user's recap into recap_cache")
+    parser.add_argument("--year", type=int, help="With --users, the year to recap (default is all time)")
+    parser.add_argument("--workers", type=int, default=4, help="With --users, how many processes to use")
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        nargs="+",
+        metavar="ROWS",
+        help="Compare the dict loop and numpy statistics on synthetic rows, instead of printing the recap",
+    )
+    args = parser.parse_args()
+
+    db_path, cache_path = args.analytics, args.database
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        if args.snapshot or not os.path.exists(db_path):
+            analytics.take_snapshot(cache_path, db_path)
+        if args.users:
+            start = time.perf_counter()
+            built = build_user_recaps(args.year, args.workers)
+            print(f"Built {built} user recaps in {time.perf_counter() - start:.2f}s ({args.workers} workers)")
+            print_snapshot_age()
+        else:
+            print_recap(streamed=args.stream)
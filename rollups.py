@@ -0,0 +1,131 @@
+"""
+Daily rollups of the archive tables, so recap statistics read O(days x keys) rows instead of every event.
+
+- message_daily: messages per day, user, and channel
+- reaction_daily: reactions per day, user, and reaction
+- command_daily: commands per day, user, and command
+
+Rollups are kept up to date with a high-water mark. rollup_state remembers the last archive row id that's
+been counted for each table (each message partition counts as its own table), and the catch-up statements
+fold every row after it into the rollups. The archiver runs them in the same transaction as each batch it
+writes, so the rollups never drift from the raw rows. Rows written by anything else (like
+migrate_archive.py) get picked up by the next catch-up.
+
+Everything here is plain SQL, so it runs the same through the bot's aiosqlite connection or sqlite3.
+
+Usage (regenerates every rollup from the raw rows)
+    python rollups.py [gbdb.sqlite]
+"""
+
+import sqlite3
+import sys
+from typing import Sequence
+
+import archive
+
+ROLLUP_TABLES = {
+    # rollup table: (archive table, key columns)
+    "message_daily": ("message", ("userID", "channelID")),
+    "reaction_daily": ("reaction", ("userID", "reactionID")),
+    "command_daily": ("command", ("userID", "commandID")),
+}
+
+
+def day_expression(column: str) -> str:
+    """SQL for the local date (YYYY-MM-DD) a snowflake column was created on"""
+    return f"date((({column} >> 22) + {archive.DISCORD_EPOCH}) / 1000, 'unixepoch', 'localtime')"
+
+
+def create_statements() -> list[str]:
+    statements = [
+        """
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            source TEXT PRIMARY KEY,
+            lastID INTEGER NOT NULL
+        )
+        """
+    ]
+    for rollup, (_, keys) in ROLLUP_TABLES.items():
+        statements.append(
+            f"""
+            CREATE TABLE IF NOT EXISTS {rollup} (
+                day TEXT,
+                {keys[0]} INTEGER,
+                {keys[1]} INTEGER,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (day, {keys[0]}, {keys[1]})
+            ) WITHOUT ROWID
+            """
+        )
+    return statements
+
+
+def sources(message_tables: Sequence[str]) -> dict[str, list[str]]:
+    """
+    Maps each rollup's archive table to the tables actually holding its rows. Messages are read from each
+    partition (rather than the view) so each one gets its own high-water mark. `message_tables` can be
+    schema qualified (archive_2025.message_2025), since old years can live in their own file.
+    """
+    return {"message": list(message_tables), "reaction": ["reaction"], "command": ["command"]}
+
+
+def catch_up_statements(message_tables: Sequence[str]) -> list[str]:
+    """Counts every archive row past the high-water mark into the rollups, then moves the mark"""
+    statements = []
+    for rollup, (archive_table, keys) in ROLLUP_TABLES.items():
+        key_columns = ", ".join(keys)
+        for source in sources(message_tables)[archive_table]:
+            # High-water marks are kept per table, regardless of which database file it's in
+            state_key = source.split(".")[-1]
+            statements += [
+                f"INSERT OR IGNORE INTO rollup_state (source, lastID) VALUES ('{state_key}', 0)",
+                f"""
+                INSERT INTO {rollup} (day, {key_columns}, count)
+                SELECT {day_expression(archive.TIME_COLUMN[archive_table])}, {key_columns}, COUNT(*)
+                FROM {source}
+                WHERE id > (SELECT lastID FROM rollup_state WHERE source = '{state_key}')
+                GROUP BY 1, 2, 3
+                ON CONFLICT (day, {key_columns}) DO UPDATE SET count = count + excluded.count
+                """,
+                f"""
+                UPDATE rollup_state
+                SET lastID = (SELECT COALESCE(MAX(id), 0) FROM {source})
+                WHERE source = '{state_key}'
+                """,
+            ]
+    return statements
+
+
+def rebuild_statements(message_tables: Sequence[str]) -> list[str]:
+    """Throws the rollups away and counts them again from scratch"""
+    statements = [f"DELETE FROM {rollup}" for rollup in ROLLUP_TABLES]
+    statements.append("DELETE FROM rollup_state")
+    return statements + catch_up_statements(message_tables)
+
+
+CREATE = create_statements()
+
+
+def message_tables(conn: sqlite3.Connection) -> list[str]:
+    """Every message partition, schema qualified. Use a connection from archive.connect(), so they're attached"""
+    return [partition.qualified for partition in archive.load_partitions(conn)]
+
+
+def year_days(year: int) -> tuple[str, str]:
+    """[start, end) day keys for filtering a rollup to a single year"""
+    return f"{year}-01-01", f"{year + 1}-01-01"
+
+
+def run(conn: sqlite3.Connection, statements: list[str]):
+    """Runs a list of the statements above as one transaction"""
+    with conn:
+        conn.execute("BEGIN")
+        for statement in statements:
+            conn.execute(statement)
+
+
+if __name__ == "__main__":
+    database = sys.argv[1] if len(sys.argv) > 1 else "gbdb.sqlite"
+    conn = archive.connect(database)
+    run(conn, rebuild_statements(message_tables(conn)))
+    print(f"Rebuilt {', '.join(ROLLUP_TABLES)} in {database}")
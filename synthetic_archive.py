@@ -0,0 +1,211 @@
+"""
+Generates a fake (but realistic looking) gbdb.sqlite, for seeing how recap and the archiver hold up at
+volumes we don't have yet. See benchmarks.py.
+
+The archive is filled day by day, for `years` years up to today
+- A few users and channels do most of the talking (zipf weighted), like the real server
+- Messages follow a time of day curve (dead in the morning, busy in the evening), come in conversation
+  bursts rather than evenly spaced, and some days are much busier than others
+- Reactions land on that day's messages shortly after they're sent, commands follow the same daily curve
+
+Rows go through the same schema, partitions, and rollups as the real archive (migrations.py).
+
+Usage
+    python synthetic_archive.py synthetic.sqlite [--years 3] [--messages-per-day 300] [--users 20] [--seed 1]
+"""
+
+import argparse
+import datetime as dt
+import os
+import sqlite3
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+import archive
+import migrate_archive
+import migrations
+import rollups
+
+# Most popular first
+REACTIONS = ["💀", "😂", "🔥", "clueless", "chatting", "KEKW", "❤️", "👍", "Sadge", "🐀", "👀", "monkaS", "🤔"]
+COMMANDS = ["rat", "cat", "real", "lastgame", "aram", "summoner", "meta", "watch", "wni", "wie", "today"]
+
+# Relative chance of a message being sent in each hour of the day, 0-23
+HOURLY_WEIGHTS = np.array(
+    [4, 2, 1, 0.5, 0.3, 0.3, 0.5, 1, 2, 3, 4, 5, 6, 6, 6, 6, 7, 8, 10, 12, 13, 13, 11, 7],
+    dtype=np.float64,
+)
+
+MS_PER_MINUTE = 60 * 1000
+MS_PER_DAY = 24 * 60 * MS_PER_MINUTE
+
+
+class SyntheticConfig(NamedTuple):
+    years: int = 3
+    users: int = 20
+    channels: int = 30
+    messages_per_day: float = 300
+    reactions_per_message: float = 0.3
+    commands_per_day: float = 40
+    # How quickly popularity drops off for users, channels, reactions and commands. Higher is more lopsided
+    zipf: float = 1.1
+    seed: int | None = None
+
+
+def zipf_weights(count: int, exponent: float) -> np.ndarray:
+    weights = 1 / np.arange(1, count + 1) ** exponent
+    return weights / weights.sum()
+
+
+def to_snowflakes(epoch_ms: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Snowflakes made at `epoch_ms`, with random low bits (worker/process/increment) like Discord's"""
+    return ((epoch_ms - archive.DISCORD_EPOCH) << 22) | rng.integers(0, 1 << 22, size=len(epoch_ms))
+
+
+class Generator:
+    def __init__(self, config: SyntheticConfig):
+        self.config = config
+        self.rng = np.random.default_rng(config.seed)
+        self.user_ids = self.rng.integers(1 << 56, 1 << 60, size=config.users)
+        self.channel_ids = self.rng.integers(1 << 56, 1 << 60, size=config.channels)
+        self.user_weights = zipf_weights(config.users, config.zipf)
+        self.channel_weights = zipf_weights(config.channels, config.zipf)
+        self.reaction_weights = zipf_weights(len(REACTIONS), config.zipf)
+        self.command_weights = zipf_weights(len(COMMANDS), config.zipf)
+        self.hour_weights = HOURLY_WEIGHTS / HOURLY_WEIGHTS.sum()
+
+    def activity(self, day: dt.date) -> float:
+        """How busy a day is compared to normal. Weekends are busier, and every so often something happens"""
+        multiplier = 1.3 if day.weekday() >= 5 else 1.0
+        multiplier *= self.rng.lognormal(0, 0.4)
+        if self.rng.random() < 0.03:
+            multiplier *= 4
+        return multiplier
+
+    def times_of_day(self, count: int, burst_size: float) -> np.ndarray:
+        """`count` ms offsets into a day, clumped into conversations around hours picked by HOURLY_WEIGHTS"""
+        bursts = max(1, round(count / burst_size))
+        hours = self.rng.choice(24, size=bursts, p=self.hour_weights)
+        centers = hours * 60 * MS_PER_MINUTE + self.rng.integers(0, 60 * MS_PER_MINUTE, size=bursts)
+        offsets = centers[self.rng.integers(0, bursts, size=count)]
+        offsets += self.rng.exponential(3 * MS_PER_MINUTE, size=count).astype(np.int64)
+        return np.sort(np.clip(offsets, 0, MS_PER_DAY - 1))
+
+    def day(self, day: dt.date) -> dict[str, list[tuple]]:
+        """Every archive row for one day, in the column order archive.py's inserts expect"""
+        config, rng = self.config, self.rng
+        start_ms = int(dt.datetime(day.year, day.month, day.day).timestamp() * 1000)
+        activity = self.activity(day)
+
+        message_count = rng.poisson(config.messages_per_day * activity)
+        message_ms = start_ms + self.times_of_day(message_count, burst_size=15)
+        message_ids = to_snowflakes(message_ms, rng)
+        message_users = rng.choice(self.user_ids, size=message_count, p=self.user_weights)
+        channels = rng.choice(self.channel_ids, size=message_count, p=self.channel_weights)
+
+        # Reactions are on today's messages, a few minutes after they were sent
+        reaction_count = rng.poisson(message_count * config.reactions_per_message) if message_count else 0
+        reacted_to = rng.integers(0, max(message_count, 1), size=reaction_count)
+        delays = rng.exponential(10 * MS_PER_MINUTE, size=reaction_count).astype(np.int64)
+        reaction_ms = message_ms[reacted_to] + delays
+        reaction_users = rng.choice(self.user_ids, size=reaction_count, p=self.user_weights)
+        reactions = rng.choice(len(REACTIONS), size=reaction_count, p=self.reaction_weights)
+
+        command_count = rng.poisson(config.commands_per_day * activity)
+        command_ms = start_ms + self.times_of_day(command_count, burst_size=3)
+        command_users = rng.choice(self.user_ids, size=command_count, p=self.user_weights)
+        commands = rng.choice(len(COMMANDS), size=command_count, p=self.command_weights)
+
+        return {
+            "message": list(zip(message_users.tolist(), message_ids.tolist(), channels.tolist())),
+            "reaction": list(
+                zip(
+                    reaction_users.tolist(),
+                    [REACTIONS[i] for i in reactions],
+                    message_ids[reacted_to].tolist(),
+                    to_snowflakes(reaction_ms, rng).tolist(),
+                )
+            ),
+            "command": list(
+                zip(
+                    command_users.tolist(),
+                    [COMMANDS[i] for i in commands],
+                    to_snowflakes(command_ms, rng).tolist(),
+                )
+            ),
+        }
+
+
+def generate(path: str, config: SyntheticConfig = SyntheticConfig(), quiet: bool = False) -> dict[str, int]:
+    """Creates a synthetic archive at `path` (replacing anything there). Returns rows written per table"""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    migrations.migrate(conn)
+
+    generator = Generator(config)
+    partitions = {partition.year: partition for partition in archive.load_partitions(conn)}
+    totals = dict.fromkeys(archive.ARCHIVE_TABLES, 0)
+
+    today = dt.date.today()
+    day = today - dt.timedelta(days=365 * config.years)
+    start = time.perf_counter()
+    while day <= today:
+        rows = generator.day(day)
+        with conn:
+            conn.execute("BEGIN")
+            for table, table_rows in rows.items():
+                if table_rows:
+                    migrate_archive.insert_rows(conn, table, table_rows, partitions)
+                totals[table] += len(table_rows)
+        if not quiet and day.day == 1:
+            print(f"  {day:%Y-%m}: {sum(totals.values()):,} rows", end="\r")
+        day += dt.timedelta(days=1)
+
+    rollups.run(conn, rollups.catch_up_statements(rollups.message_tables(conn)))
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    if not quiet:
+        elapsed = time.perf_counter() - start
+        counts = ", ".join(f"{count:,} {table}s" for table, count in totals.items())
+        print(f"\nGenerated {counts} in {elapsed:.1f}s")
+    return totals
+
+
+def main():
+    defaults = SyntheticConfig()
+    parser = argparse.ArgumentParser(description="Generate a synthetic archive database")
+    parser.add_argument("path", nargs="?", default="synthetic.sqlite")
+    parser.add_argument("--years", type=int, default=defaults.years)
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--channels", type=int, default=defaults.channels)
+    parser.add_argument("--messages-per-day", type=float, default=defaults.messages_per_day)
+    parser.add_argument("--reactions-per-message", type=float, default=defaults.reactions_per_message)
+    parser.add_argument("--commands-per-day", type=float, default=defaults.commands_per_day)
+    parser.add_argument("--zipf", type=float, default=defaults.zipf)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config = SyntheticConfig(
+        years=args.years,
+        users=args.users,
+        channels=args.channels,
+        messages_per_day=args.messages_per_day,
+        reactions_per_message=args.reactions_per_message,
+        commands_per_day=args.commands_per_day,
+        zipf=args.zipf,
+        seed=args.seed,
+    )
+    generate(args.path, config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Run with `python -m unittest discover -s tests`"""
+
+import os
+import tempfile
+import unittest
+
+import log_reader
+
+# A record whose traceback has a blank line in it, between two plain records
+LOG = (
+    "[2025-01-19 20:03:10] [INFO    ] Ready\n"
+    "[2025-01-19 20:03:11] [ERROR   ] Ignoring exception in command log\n"
+    "Traceback (most recent call last):\n"
+    '  File "goonbot.py", line 1, in log\n'
+    "\n"
+    "ValueError: bad page\n"
+    "[2025-01-19 20:03:12] [INFO    ] Still here\n"
+)
+
+
+class LogReaderTest(unittest.TestCase):
+    def write(self, text: str) -> str:
+        file = tempfile.NamedTemporaryFile("w", suffix=".log", delete=False, newline="")
+        with file:
+            file.write(text)
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def test_reverse_lines_matches_splitlines(self):
+        for text in (LOG, LOG.rstrip("\n"), LOG + "\n\n", "\n", "", "one line"):
+            path = self.write(text)
+            # Block sizes that split lines (and the blank line) across blocks
+            for block_size in (1, 3, 7, 64, log_reader.BLOCK_SIZE):
+                with self.subTest(text=text[-20:], block_size=block_size):
+                    lines = list(log_reader.reverse_lines(path, block_size))
+                    self.assertEqual(lines[::-1], text.splitlines())
+
+    def test_read_page_keeps_blank_lines(self):
+        path = self.write(LOG)
+        lines = LOG.splitlines()
+        page = log_reader.read_page(path, page=1, per_page=4)
+        self.assertEqual(page.lines, lines[-4:])
+        self.assertIn("", page.lines)
+        self.assertTrue(page.has_more)
+
+        last = log_reader.read_page(path, page=2, per_page=4)
+        self.assertEqual(last.lines, lines[:-4])
+        self.assertFalse(last.has_more)
+
+
+if __name__ == "__main__":
+    unittest.main()
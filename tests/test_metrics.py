@@ -0,0 +1,52 @@
+"""Run with `python -m unittest discover -s tests` (needs a keys.py, see keys.py.template)"""
+
+import asyncio
+import types
+import unittest
+
+from discord.ext import commands
+
+from cogs.metrics import Metrics
+
+OWNER_ID = 1
+MEMBER_ID = 2
+
+
+class FakeBot:
+    async def can_run(self, ctx, *, call_once=False):
+        return True
+
+    async def is_owner(self, user):
+        return user.id == OWNER_ID
+
+
+def context(command: commands.Command, author_id: int, guild=None):
+    bot = FakeBot()
+    author = types.SimpleNamespace(id=author_id)
+    return types.SimpleNamespace(bot=bot, author=author, guild=guild, command=command)
+
+
+class MemChecks(unittest.TestCase):
+    def setUp(self):
+        self.cog = Metrics(FakeBot())
+        self.mem = next(command for command in self.cog.get_commands() if command.name == "mem")
+
+    def test_subcommands_are_owner_only(self):
+        for command in self.mem.commands:
+            with self.subTest(command=command.qualified_name):
+                with self.assertRaises(commands.NotOwner):
+                    asyncio.run(command.can_run(context(command, MEMBER_ID)))
+
+    def test_subcommands_are_dm_only(self):
+        for command in self.mem.commands:
+            with self.subTest(command=command.qualified_name):
+                with self.assertRaises(commands.PrivateMessageOnly):
+                    asyncio.run(command.can_run(context(command, OWNER_ID, guild=object())))
+
+    def test_owner_can_start_in_dms(self):
+        start = self.mem.get_command("start")
+        self.assertTrue(asyncio.run(start.can_run(context(start, OWNER_ID))))
+
+
+if __name__ == "__main__":
+    unittest.main()